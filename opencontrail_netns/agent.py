@@ -0,0 +1,164 @@
+"""
+Resident agent keeping a warm API server session, namespace manager and
+vrouter connection. netns-daemon-start and netns-daemon-stop submit their
+requests to it over a unix socket (see agent_client) and only provision
+in-process when it is not running.
+"""
+
+import argparse
+import errno
+import json
+import logging
+import os
+import SocketServer
+import sys
+
+from agent_client import AGENT_SOCKET
+from contrail_lib import rpc_client_shared
+from daemon_ops import DaemonOperations
+from daemon_state import STATE_DIR, DaemonStateStore
+from instance_provisioner import Provisioner
+from lxc_manager import LxcManager
+from metrics import sinks_configure
+from netns_pool import NamespacePool
+from port_journal import PortApplier, PortJournal
+from reconcile import Reconciler
+
+
+class AgentRequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        operations = self.server.operations
+        try:
+            request = json.loads(self.rfile.readline())
+            op = request['op']
+            if op == 'start':
+                results = operations.start(request['items'],
+                                           **request['options'])
+            elif op == 'stop':
+                results = operations.stop(request['items'],
+                                          **request['options'])
+            elif op == 'stats':
+                provisioner = operations.provisioner
+                self._reply({'stats': {
+                    'api': provisioner.api_stats(),
+                    'cache': provisioner.cache_stats(),
+                }})
+                return
+            else:
+                raise ValueError('Unknown operation %s' % op)
+            reply = {'results': [[item, error]
+                                 for item, _, error in results]}
+        except (ValueError, KeyError, TypeError) as ex:
+            reply = {'error': str(ex)}
+        self._reply(reply)
+
+    def _reply(self, reply):
+        self.wfile.write(json.dumps(reply) + '\n')
+
+
+class AgentServer(SocketServer.ThreadingMixIn,
+                  SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, operations):
+        try:
+            os.unlink(path)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        SocketServer.UnixStreamServer.__init__(self, path,
+                                               AgentRequestHandler)
+        os.chmod(path, 0600)
+        self.operations = operations
+
+
+def agent_main():
+    parser = argparse.ArgumentParser()
+    defaults = {
+        'api-server': '127.0.0.1',
+        'api-port': 8082,
+    }
+    parser.set_defaults(**defaults)
+    parser.add_argument("-s", "--api-server", help="API server address")
+    parser.add_argument("-p", "--api-port", type=int, help="API server port")
+    parser.add_argument("--netns-backend", default='auto',
+                        choices=['auto', 'netlink', 'shell'],
+                        help="Kernel interface used to manage namespaces")
+    parser.add_argument("-w", "--workers", type=int, default=8,
+                        help="Daemons handled concurrently per request")
+    parser.add_argument("--cache-file",
+                        help="File used to persist cached network lookups")
+    parser.add_argument("--cache-ttl", type=int, default=300,
+                        help="Lifetime in seconds of cached network lookups")
+    parser.add_argument("--api-share-ttl", type=float, default=2,
+                        help="Seconds during which API server replies are"
+                        " shared with the other processes of the host"
+                        " (0 disables)")
+    parser.add_argument("--api-rate", type=float, default=50,
+                        help="Maximum API server writes per second for the"
+                        " host (0 for no limit)")
+    parser.add_argument("--state-dir", default=STATE_DIR,
+                        help="Directory holding the per daemon checkpoints")
+    parser.add_argument("--socket", default=AGENT_SOCKET,
+                        help="Control socket path")
+    parser.add_argument("--pool-size", type=int, default=0,
+                        help="Spare namespaces kept ready for starting"
+                        " daemons")
+    parser.add_argument("--reconcile-interval", type=int, default=30,
+                        help="Seconds between reconciliation passes"
+                        " (0 disables)")
+    parser.add_argument("--metrics-dir",
+                        help="node-exporter textfile directory receiving the"
+                        " phase timings and call counts of each daemon")
+    parser.add_argument("--metrics-log",
+                        help="File receiving one JSON line per daemon run")
+    arguments = parser.parse_args(sys.argv[1:])
+
+    logging.basicConfig(level=logging.INFO)
+    sinks_configure(arguments.metrics_dir, arguments.metrics_log)
+    provisioner = Provisioner(api_server=arguments.api_server,
+                              api_port=arguments.api_port,
+                              cache_ttl=arguments.cache_ttl,
+                              cache_file=arguments.cache_file,
+                              share_ttl=arguments.api_share_ttl,
+                              api_rate=arguments.api_rate)
+    manager = LxcManager(backend=arguments.netns_backend)
+    if arguments.pool_size > 0:
+        manager.pool = NamespacePool(manager, arguments.pool_size)
+        manager.pool.start()
+    client = rpc_client_shared()
+    journal = PortJournal(os.path.join(arguments.state_dir, 'ports'))
+    applier = PortApplier(journal, client)
+    applier.start()
+    operations = DaemonOperations(
+        provisioner, manager, client, DaemonStateStore(arguments.state_dir),
+        workers=arguments.workers, journal=journal, applier=applier)
+
+    reconciler = None
+    if arguments.reconcile_interval > 0:
+        reconciler = Reconciler(operations,
+                                interval=arguments.reconcile_interval)
+        reconciler.start()
+
+    server = AgentServer(arguments.socket, operations)
+    logging.info('Listening on %s', arguments.socket)
+    try:
+        server.serve_forever()
+    finally:
+        if reconciler is not None:
+            reconciler.stop()
+        if manager.pool is not None:
+            manager.pool.stop()
+        applier.stop()
+        server.server_close()
+        os.unlink(arguments.socket)
+        operations.client.close()
+
+# end agent_main
+
+
+if __name__ == '__main__':
+    agent_main()
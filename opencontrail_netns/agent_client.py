@@ -0,0 +1,75 @@
+"""
+Client side of the netns agent control socket. This module is imported by
+the start/stop hooks and must stay free of heavy dependencies.
+
+Protocol: the client sends one JSON object per connection
+    {"op": "start" | "stop", "items": [...], "options": {...}}
+terminated by a newline; the agent replies with
+    {"results": [[item, error], ...]}  or  {"error": message}
+The "stats" op (no items) returns {"stats": {"api": ..., "cache": ...}},
+the API server request counters and the cache statistics of the agent.
+"""
+
+import argparse
+import errno
+import json
+import socket
+
+
+AGENT_SOCKET = '/var/run/opencontrail-netns/agent.sock'
+
+# options of the hooks that the agent takes from its own command line; a
+# request forwarded to it would ignore them
+AGENT_CONFIG_OPTIONS = ('api_server', 'api_port', 'netns_backend',
+                        'state_dir', 'workers', 'api_share_ttl', 'api_rate',
+                        'metrics_dir', 'metrics_log', 'trace', 'profile')
+
+
+class AgentError(Exception):
+    pass
+
+
+def options_given(parser, args, dests):
+    """
+    Return those of dests that are set on the command line args, even to
+    their default value. argparse only applies the default of an option
+    missing from the namespace it parses into.
+    """
+    unset = object()
+    namespace = argparse.Namespace(**dict((dest, unset) for dest in dests))
+    parser.parse_args(args, namespace)
+    return [dest for dest in dests if getattr(namespace, dest) is not unset]
+
+
+def agent_request(path, op, items, options=None):
+    """
+    Submit an operation to the agent listening on path. Returns a list of
+    (item, None, error) tuples, as run_parallel does, or None if no agent
+    is running.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except socket.error as ex:
+            if ex.errno in (errno.ENOENT, errno.ECONNREFUSED):
+                return None
+            raise
+        request = {'op': op, 'items': items, 'options': options or {}}
+        sock.sendall(json.dumps(request) + '\n')
+        chunks = []
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            chunks.append(data)
+    finally:
+        sock.close()
+
+    try:
+        reply = json.loads(''.join(chunks))
+    except ValueError:
+        raise AgentError('Invalid reply from agent')
+    if 'error' in reply:
+        raise AgentError(reply['error'])
+    return [(item, None, error) for item, error in reply['results']]
@@ -0,0 +1,85 @@
+"""
+Accounting of the requests a VncApi client sends to the API server: the
+number of requests and the bytes sent and received, per HTTP method and
+resource type (e.g. "GET virtual-network").
+"""
+
+import collections
+import threading
+import urlparse
+
+import metrics
+import tracing
+
+# vnc_api.common.rest operation codes
+_METHODS = {1: 'GET', 2: 'POST', 3: 'PUT', 4: 'DELETE'}
+
+
+def _resource(url):
+    path = urlparse.urlparse(url).path.strip('/')
+    return path.split('/')[0] if path else ''
+
+
+class ApiCounters(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = collections.Counter()
+        self._sent = collections.Counter()
+        self._received = collections.Counter()
+
+    def record(self, op, url, sent, received):
+        key = '%s %s' % (_METHODS.get(op, op), _resource(url))
+        with self._lock:
+            self._requests[key] += 1
+            self._sent[key] += sent
+            self._received[key] += received
+
+    def reset(self):
+        with self._lock:
+            self._requests.clear()
+            self._sent.clear()
+            self._received.clear()
+
+    def stats(self):
+        """
+        Return the totals (requests, bytes_sent, bytes_received) and the
+        same counters per request type under by_request.
+        """
+        with self._lock:
+            return {
+                'requests': sum(self._requests.values()),
+                'bytes_sent': sum(self._sent.values()),
+                'bytes_received': sum(self._received.values()),
+                'by_request': dict(
+                    (key, {'requests': count,
+                           'bytes_sent': self._sent[key],
+                           'bytes_received': self._received[key]})
+                    for key, count in self._requests.items()),
+            }
+
+
+def counters_attach(client, counters=None):
+    """
+    Count the requests of a VncApi client by wrapping its _request_server
+    method, through which every REST call goes. Requests are also counted
+    in the current metrics run and traced as spans. Clients without it
+    (such as the benchmark fake) are left untouched. Returns the counters.
+    """
+    if counters is None:
+        counters = ApiCounters()
+    request_server = getattr(client, '_request_server', None)
+    if request_server is None:
+        return counters
+
+    def _request_server(op, url, data=None, *args, **kwargs):
+        metrics.count(metrics.API_REQUEST)
+        with tracing.span('%s %s' % (_METHODS.get(op, op), _resource(url)),
+                          'api', url=url):
+            content = request_server(op, url, data, *args, **kwargs)
+        counters.record(op, url, len(data or ''),
+                        len(content) if isinstance(content, basestring)
+                        else 0)
+        return content
+
+    client._request_server = _request_server
+    return counters
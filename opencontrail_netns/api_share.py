@@ -0,0 +1,208 @@
+"""
+Host-wide sharing of the API server traffic of the processes of a host,
+layered on the _request_server method of a VncApi client:
+
+- reads (GET, fqname-to-id and bulk list requests) are coalesced: the
+  reply is kept for ttl seconds in a file per request under directory.
+  One process issues the request while holding an flock of the file, and
+  the others, waiting on the lock, use its reply. Every write of the host
+  advances a write generation, the modification time of a file in
+  directory, and replies whose request was sent before the last write
+  are not used.
+- writes take a token from a bucket shared by the host and are retried
+  with backoff when the API server is unavailable. PUT and DELETE are
+  also retried on timeouts; a create that timed out may have been
+  applied and is not retried.
+"""
+
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import socket
+import time
+import urlparse
+
+from cfgm_common import rest
+from cfgm_common.exceptions import ServiceUnavailableError, TimeOutError
+
+from ratelimit import SharedTokenBucket, backoff_delays
+
+SHARE_DIR = '/var/run/opencontrail-netns/api'
+
+# POST requests that do not modify anything
+_READ_POSTS = ('fqname-to-id', 'id-to-fqname', 'list-bulk-collection')
+
+# shared replies older than this are deleted by the periodic sweep
+_SWEEP_AGE = 60
+
+
+def _is_read(op, url):
+    if op == rest.OP_GET:
+        return True
+    path = urlparse.urlparse(url).path.strip('/')
+    return op == rest.OP_POST and path in _READ_POSTS
+
+
+class SharedRequests(object):
+    def __init__(self, request_server, directory=SHARE_DIR, ttl=2,
+                 rate=50, burst=None, retries=5):
+        """
+        request_server: the _request_server method being wrapped.
+        ttl: seconds during which a reply is shared (0 disables).
+        rate: writes per second for the host (0 for no limit).
+        retries: attempts after a failed write.
+        """
+        self._request_server = request_server
+        self._directory = directory
+        self._ttl = ttl
+        self._retries = retries
+        self._bucket = None
+        if rate > 0:
+            self._bucket = SharedTokenBucket(
+                os.path.join(directory, 'writes.bucket'), rate, burst)
+        self._generation_file = os.path.join(directory, 'writes.gen')
+
+    def __call__(self, op, url, data=None, *args, **kwargs):
+        if _is_read(op, url):
+            if self._ttl <= 0:
+                return self._request_server(op, url, data, *args, **kwargs)
+            return self._read(op, url, data, *args, **kwargs)
+        return self._write(op, url, data, *args, **kwargs)
+
+    def _generation(self):
+        """ Return the time of the last write of the host """
+        try:
+            return os.stat(self._generation_file).st_mtime
+        except OSError:
+            return 0
+
+    def _generation_advance(self):
+        fd = os.open(self._generation_file, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            now = time.time()
+            if os.fstat(fd).st_mtime < now:
+                os.utime(self._generation_file, (now, now))
+        finally:
+            os.close(fd)
+
+    def _fresh(self, fd):
+        """
+        Return the shared reply of fd if it can be used, else None. The
+        modification time of a reply is the time its request was sent.
+        """
+        st = os.fstat(fd)
+        if (st.st_size == 0 or time.time() - st.st_mtime > self._ttl or
+                st.st_mtime < self._generation()):
+            return None
+        os.lseek(fd, 0, os.SEEK_SET)
+        chunks = []
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                return ''.join(chunks)
+            chunks.append(chunk)
+
+    def _read(self, op, url, data, *args, **kwargs):
+        key = hashlib.sha1('%s %s %s' % (op, url, data or '')).hexdigest()
+        filename = os.path.join(self._directory, key)
+        started = time.time()
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            content = self._fresh(fd)
+            if content is not None:
+                return content
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            content = self._fresh(fd)
+            if content is not None:
+                return content
+            st = os.fstat(fd)
+            if st.st_size == 0 and st.st_mtime > started:
+                # the request of another process failed while this one
+                # was waiting: do not queue behind the lock
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                return self._request_server(op, url, data, *args, **kwargs)
+            os.ftruncate(fd, 0)
+            sent = time.time()
+            try:
+                content = self._request_server(op, url, data, *args,
+                                               **kwargs)
+            except Exception:
+                os.utime(filename, None)
+                raise
+            if isinstance(content, basestring):
+                os.lseek(fd, 0, os.SEEK_SET)
+                written = 0
+                while written < len(content):
+                    written += os.write(fd, content[written:])
+                os.utime(filename, (sent, sent))
+            return content
+        finally:
+            os.close(fd)
+            self._sweep()
+
+    def _write(self, op, url, data, *args, **kwargs):
+        retryable = (ServiceUnavailableError,)
+        if op in (rest.OP_PUT, rest.OP_DELETE):
+            retryable += (TimeOutError, socket.timeout)
+        delays = backoff_delays(self._retries)
+        while True:
+            if self._bucket is not None:
+                self._bucket.acquire()
+            try:
+                content = self._request_server(op, url, data, *args,
+                                               **kwargs)
+                break
+            except retryable as ex:
+                delay = next(delays, None)
+                if delay is None:
+                    raise
+                logging.warning('API server request failed (%s), retrying'
+                                ' in %.1fs', ex, delay)
+                time.sleep(delay)
+        self._generation_advance()
+        return content
+
+    def _sweep(self):
+        """ Delete old replies, at most once per _SWEEP_AGE per host """
+        marker = os.path.join(self._directory, '.swept')
+        now = time.time()
+        try:
+            if now - os.stat(marker).st_mtime < _SWEEP_AGE:
+                return
+        except OSError:
+            pass
+        open(marker, 'a').close()
+        os.utime(marker, None)
+        for name in os.listdir(self._directory):
+            if len(name) != 40:
+                continue
+            filename = os.path.join(self._directory, name)
+            try:
+                if now - os.stat(filename).st_mtime > _SWEEP_AGE:
+                    os.unlink(filename)
+            except OSError:
+                pass
+
+
+def requests_share(client, directory=SHARE_DIR, ttl=2, rate=50):
+    """
+    Route the requests of a VncApi client through SharedRequests. Sharing
+    is skipped, with a warning, when directory cannot be created (e.g.
+    when not running as root). Clients without a _request_server method
+    are left untouched.
+    """
+    request_server = getattr(client, '_request_server', None)
+    if request_server is None:
+        return
+    try:
+        os.makedirs(directory)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            logging.warning('API requests are not shared: %s', ex)
+            return
+    client._request_server = SharedRequests(request_server, directory,
+                                            ttl=ttl, rate=rate)
@@ -0,0 +1,109 @@
+"""
+Helpers used to run operations concurrently: an operation over many
+daemons with a bounded pool of worker threads, or independent stages of
+a single operation.
+"""
+
+import logging
+import sys
+import threading
+import traceback
+
+import metrics
+
+
+def manifest_read(filename):
+    """
+    Parse a manifest file. Each non empty line contains a daemon name
+    optionally followed by its network and outbound network; '#' starts a
+    comment. Returns a list of lists of fields.
+    """
+    entries = []
+    with open(filename) as fp:
+        for line in fp:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            entries.append(line.split())
+    return entries
+
+
+def run_parallel(func, items, workers=8):
+    """
+    Apply func to every item using at most workers threads.
+    Returns a list of (item, result, error) tuples in the order of items;
+    error is None on success and a formatted traceback otherwise.
+    """
+    current = metrics.run_current()
+
+    def run(item):
+        try:
+            with metrics.run_context(current):
+                return (item, func(item), None)
+        except (Exception, SystemExit):
+            logging.exception('Operation failed for %s', item)
+            return (item, None, traceback.format_exc())
+
+    if not items:
+        return []
+    if workers <= 1 or len(items) == 1:
+        return [run(item) for item in items]
+
+    # imported here to keep the command line clients light
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(run, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def batch_report(results, name=str):
+    """
+    Print the per item outcome of run_parallel and return the number of
+    failures.
+    """
+    failures = 0
+    for item, _, error in results:
+        if error is None:
+            print '%s: ok' % name(item)
+            continue
+        failures += 1
+        print '%s: FAILED: %s' % (name(item),
+                                  error.strip().split('\n')[-1])
+    print '%d succeeded, %d failed' % (len(results) - failures, failures)
+    return failures
+
+
+def run_concurrently(*funcs):
+    """
+    Call every function in its own thread and return their results in
+    order. Once all of them have completed, the first exception raised,
+    if any, is re-raised.
+    """
+    results = [None] * len(funcs)
+    errors = [None] * len(funcs)
+    # the threads work for the run of the caller
+    current = metrics.run_current()
+
+    def run(index):
+        try:
+            with metrics.run_context(current):
+                results[index] = funcs[index]()
+        except BaseException:
+            errors[index] = sys.exc_info()
+
+    threads = [threading.Thread(target=run, args=(index,))
+               for index in range(1, len(funcs))]
+    for thread in threads:
+        thread.start()
+    if funcs:
+        run(0)
+    for thread in threads:
+        thread.join()
+
+    for error in errors:
+        if error is not None:
+            raise error[0], error[1], error[2]
+    return results
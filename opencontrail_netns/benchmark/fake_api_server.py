@@ -0,0 +1,322 @@
+"""
+In-process stand-in for the VNC API server, exposing the VncApi client
+methods used by Provisioner and NetworkManager.
+"""
+
+import collections
+import copy
+import itertools
+import socket
+import struct
+import threading
+import time
+import uuid as uuidlib
+
+from vnc_api.vnc_api import *
+
+
+def _ip_to_int(address):
+    return struct.unpack('!I', socket.inet_aton(address))[0]
+
+
+def _int_to_ip(value):
+    return socket.inet_ntoa(struct.pack('!I', value))
+
+
+class FakeVncApi(object):
+    """
+    Objects are kept in memory and deep copied on every request, as if
+    they had been serialized. Back references and children are computed
+    from indexes maintained on writes. A read by fq_name accounts for two
+    round trips (fq_name_to_id and GET), as with the real client.
+
+    Supported methods: <type>_create, <type>_read, <type>_update,
+    <type>_delete, <type>s_list, fq_name_to_id and id_to_fq_name.
+    """
+    def __init__(self, latency=0.0):
+        self._latency = latency
+        self._lock = threading.RLock()
+        self._objects = {}
+        self._fq_names = {}
+        self._referrers = collections.defaultdict(set)
+        self._children = collections.defaultdict(set)
+        self._mac_seq = itertools.count(1)
+        self._ip_seq = collections.defaultdict(lambda: itertools.count(3))
+        self.calls = collections.Counter()
+        self.round_trips = 0
+        self._default_objects()
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls.clear()
+            self.round_trips = 0
+
+    def _round_trip(self, op):
+        with self._lock:
+            self.calls[op] += 1
+            self.round_trips += 1
+        if self._latency:
+            time.sleep(self._latency)
+
+    def _default_objects(self):
+        project = Project('default-project')
+        project.uuid = str(uuidlib.uuid4())
+        self._store('project', project)
+        ipam = NetworkIpam('default-network-ipam', project)
+        ipam.uuid = str(uuidlib.uuid4())
+        self._store('network_ipam', ipam)
+        ipam_subnet = IpamSubnetType(subnet=SubnetType('10.0.0.0', 8))
+        ipam_subnet.default_gateway = '10.0.0.1'
+        ipam_subnet.dns_server_address = '10.0.0.2'
+        vnet = VirtualNetwork('default-network', project)
+        vnet.add_network_ipam(ipam, VnSubnetsType([ipam_subnet]))
+        self._create('virtual_network', vnet)
+
+    # indexes
+
+    def _ref_fields(self, obj):
+        return [field for field in obj.__dict__.keys()
+                if field.endswith('_refs') and
+                not field.endswith('_back_refs')]
+
+    def _resolve(self, obj_type, ref):
+        if ref.get('uuid'):
+            return ref['uuid']
+        return self._fq_names.get((obj_type, tuple(ref['to'])))
+
+    def _parent_uuid(self, obj):
+        parent_type = getattr(obj, 'parent_type', None)
+        if not parent_type:
+            return None
+        key = (parent_type.replace('-', '_'), tuple(obj.get_fq_name()[:-1]))
+        return self._fq_names.get(key)
+
+    def _index(self, obj, add=True):
+        for field in self._ref_fields(obj):
+            for ref in getattr(obj, field) or []:
+                target = self._resolve(field[:-len('_refs')], ref)
+                if target is None:
+                    continue
+                ref['uuid'] = target
+                if add:
+                    self._referrers[target].add(obj.uuid)
+                else:
+                    self._referrers[target].discard(obj.uuid)
+        parent = self._parent_uuid(obj)
+        if parent is not None:
+            if add:
+                self._children[parent].add(obj.uuid)
+            else:
+                self._children[parent].discard(obj.uuid)
+
+    def _store(self, obj_type, obj):
+        self._objects[obj.uuid] = (obj_type, obj)
+        self._fq_names[(obj_type, tuple(obj.get_fq_name()))] = obj.uuid
+        self._index(obj)
+
+    # server side behavior
+
+    def _allocate_ip(self, ip):
+        refs = ip.get_virtual_network_refs() or []
+        vn_uuid = self._resolve('virtual_network', refs[0])
+        vnet = self._objects[vn_uuid][1]
+        subnet = vnet.get_network_ipam_refs()[0]['attr'].ipam_subnets[0]
+        base = _ip_to_int(subnet.subnet.ip_prefix)
+        return _int_to_ip(base + next(self._ip_seq[vn_uuid]))
+
+    def _on_create(self, obj_type, obj):
+        if obj_type == 'virtual_machine_interface':
+            if not obj.get_virtual_machine_interface_mac_addresses():
+                seq = next(self._mac_seq)
+                mac = '02:00:%02x:%02x:%02x:%02x' % (
+                    (seq >> 24) & 0xff, (seq >> 16) & 0xff,
+                    (seq >> 8) & 0xff, seq & 0xff)
+                obj.set_virtual_machine_interface_mac_addresses(
+                    MacAddressesType([mac]))
+        elif obj_type == 'instance_ip':
+            if not obj.get_instance_ip_address():
+                obj.set_instance_ip_address(self._allocate_ip(obj))
+        elif obj_type == 'virtual_network':
+            rt_instance = RoutingInstance(obj.name, obj)
+            rt_instance.uuid = str(uuidlib.uuid4())
+            rt_instance.route_target_refs = []
+            self._store('routing_instance', rt_instance)
+
+    def _create(self, obj_type, obj):
+        with self._lock:
+            fq_name = tuple(obj.get_fq_name())
+            if (obj_type, fq_name) in self._fq_names:
+                raise RefsExistError('%s exists' % ':'.join(fq_name))
+            obj.uuid = getattr(obj, 'uuid', None) or str(uuidlib.uuid4())
+            stored = copy.deepcopy(obj)
+            self._on_create(obj_type, stored)
+            self._store(obj_type, stored)
+        return obj.uuid
+
+    def _lookup(self, obj_type, fq_name=None, id=None):
+        if fq_name is not None:
+            if isinstance(fq_name, basestring):
+                fq_name = [fq_name]
+            id = self._fq_names.get((obj_type, tuple(fq_name)))
+        entry = self._objects.get(id)
+        if entry is None or entry[0] != obj_type:
+            raise NoIdError(id or fq_name)
+        return entry[1]
+
+    def _view(self, obj_type, obj):
+        """ Copy of a stored object with back references and children """
+        result = copy.deepcopy(obj)
+        back_refs = collections.defaultdict(list)
+        for uuid in self._referrers.get(obj.uuid, ()):
+            ref_type, ref_obj = self._objects[uuid]
+            for field in self._ref_fields(ref_obj):
+                for ref in getattr(ref_obj, field) or []:
+                    if ref.get('uuid') == obj.uuid:
+                        back_refs[ref_type].append({
+                            'to': ref_obj.get_fq_name(),
+                            'uuid': ref_obj.uuid,
+                            'attr': ref.get('attr')})
+        for ref_type, refs in back_refs.items():
+            setattr(result, ref_type + '_back_refs', refs)
+        children = collections.defaultdict(list)
+        for uuid in self._children.get(obj.uuid, ()):
+            child_type, child = self._objects[uuid]
+            children[child_type].append({'to': child.get_fq_name(),
+                                         'uuid': child.uuid})
+        for child_type, refs in children.items():
+            setattr(result, child_type + 's', refs)
+        return result
+
+    def _select(self, obj, fields):
+        """
+        Drop the properties, references and children not in fields, as
+        the API server does when a read names the fields it needs.
+        """
+        if fields is None:
+            return obj
+        for field in getattr(obj, 'prop_fields', ()):
+            if field not in fields and hasattr(obj, '_' + field):
+                delattr(obj, '_' + field)
+        for field in (set(getattr(obj, 'ref_fields', ())) |
+                      set(getattr(obj, 'backref_fields', ())) |
+                      set(getattr(obj, 'children_fields', ()))):
+            if field not in fields and hasattr(obj, field):
+                delattr(obj, field)
+        return obj
+
+    def _read(self, obj_type, fq_name=None, fq_name_str=None, id=None,
+              fields=None):
+        if fq_name_str is not None:
+            fq_name = fq_name_str.split(':')
+        if fq_name is not None:
+            self._round_trip('fq_name_to_id')
+        self._round_trip(obj_type + '_read')
+        with self._lock:
+            return self._select(
+                self._view(obj_type, self._lookup(obj_type, fq_name, id)),
+                fields)
+
+    def _update(self, obj_type, obj):
+        self._round_trip(obj_type + '_update')
+        with self._lock:
+            current = self._lookup(obj_type, id=obj.uuid)
+            self._index(current, add=False)
+            # fields absent from a partially read object are left as is
+            stored = copy.deepcopy(current)
+            for field, value in copy.deepcopy(obj.__dict__).items():
+                if not field.endswith('_back_refs'):
+                    setattr(stored, field, value)
+            self._store(obj_type, stored)
+
+    def _delete(self, obj_type, fq_name=None, id=None):
+        self._round_trip(obj_type + '_delete')
+        with self._lock:
+            obj = self._lookup(obj_type, fq_name, id)
+            if self._referrers.get(obj.uuid):
+                raise RefsExistError('%s is referenced' % obj.uuid)
+            self._remove(obj_type, obj)
+
+    def _remove(self, obj_type, obj):
+        """ Delete an object and, like the API server, its children """
+        for child in list(self._children.get(obj.uuid, ())):
+            self._remove(self._objects[child][0], self._objects[child][1])
+        self._index(obj, add=False)
+        del self._objects[obj.uuid]
+        del self._fq_names[(obj_type, tuple(obj.get_fq_name()))]
+        self._referrers.pop(obj.uuid, None)
+        self._children.pop(obj.uuid, None)
+
+    def _list(self, obj_type, parent_id=None, parent_fq_name=None,
+              obj_uuids=None, back_ref_id=None, fields=None, detail=False,
+              count=False, filters=None):
+        self._round_trip(obj_type + 's_list')
+        with self._lock:
+            if parent_fq_name is not None:
+                parent_id = None
+                for key, uuid in self._fq_names.items():
+                    if key[1] == tuple(parent_fq_name):
+                        parent_id = uuid
+                if parent_id is None:
+                    return [] if detail else {obj_type.replace('_', '-') +
+                                              's': []}
+            objs = [obj for (t, obj) in self._objects.values()
+                    if t == obj_type]
+            if parent_id is not None:
+                if isinstance(parent_id, basestring):
+                    parent_id = [parent_id]
+                children = set()
+                for uuid in parent_id:
+                    children |= self._children.get(uuid, set())
+                objs = [obj for obj in objs if obj.uuid in children]
+            if obj_uuids is not None:
+                objs = [obj for obj in objs if obj.uuid in obj_uuids]
+            if back_ref_id is not None:
+                if isinstance(back_ref_id, basestring):
+                    back_ref_id = [back_ref_id]
+                referrers = set()
+                for uuid in back_ref_id:
+                    referrers |= self._referrers.get(uuid, set())
+                objs = [obj for obj in objs if obj.uuid in referrers]
+            if count:
+                return {obj_type.replace('_', '-') + 's':
+                        {'count': len(objs)}}
+            if detail:
+                return [self._select(self._view(obj_type, obj), fields)
+                        for obj in objs]
+            return {obj_type.replace('_', '-') + 's':
+                    [{'fq_name': obj.get_fq_name(), 'uuid': obj.uuid,
+                      'href': ''} for obj in objs]}
+
+    def fq_name_to_id(self, obj_type, fq_name):
+        self._round_trip('fq_name_to_id')
+        with self._lock:
+            uuid = self._fq_names.get((obj_type.replace('-', '_'),
+                                       tuple(fq_name)))
+        if uuid is None:
+            raise NoIdError(':'.join(fq_name))
+        return uuid
+
+    def id_to_fq_name(self, id):
+        self._round_trip('id_to_fq_name')
+        with self._lock:
+            entry = self._objects.get(id)
+            if entry is None:
+                raise NoIdError(id)
+            return entry[1].get_fq_name()
+
+    def __getattr__(self, name):
+        for suffix in ('_create', '_read', '_update', '_delete'):
+            if name.endswith(suffix):
+                obj_type = name[:-len(suffix)]
+                method = getattr(self, '_' + suffix[1:])
+                if suffix == '_create':
+                    def create(obj):
+                        self._round_trip(obj_type + '_create')
+                        return method(obj_type, obj)
+                    return create
+                return lambda *args, **kwargs: method(obj_type, *args,
+                                                      **kwargs)
+        if name.endswith('s_list'):
+            obj_type = name[:-len('s_list')]
+            return lambda **kwargs: self._list(obj_type, **kwargs)
+        raise AttributeError(name)
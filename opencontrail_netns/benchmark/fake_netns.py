@@ -0,0 +1,235 @@
+"""
+In-memory stand-in for the LxcManager kernel backends.
+"""
+
+import collections
+import itertools
+import threading
+
+
+class FakeBackend(object):
+    """
+    Keeps namespaces and links in memory and records every operation.
+    forks counts the processes that the emulated backend ('shell' or
+    'netlink') would have spawned for the same operations.
+    """
+    def __init__(self, emulate='shell'):
+        self.name = 'fake-%s' % emulate
+        self._emulate = emulate
+        self._lock = threading.RLock()
+        self._index = itertools.count(2)
+        self._namespaces = {None: {}}
+        self.ops = collections.Counter()
+        self.forks = 0
+        self._link_add(None, 'lo', index=1)
+
+    def reset_counters(self):
+        with self._lock:
+            self.ops.clear()
+            self.forks = 0
+
+    def _record(self, op, forks=None):
+        """ forks: number of processes spawned by the shell backend """
+        with self._lock:
+            self.ops[op] += 1
+            if self._emulate == 'shell':
+                self.forks += 1 if forks is None else forks
+            elif op in ('namespace_add', 'execute'):
+                self.forks += 1
+
+    def _links(self, netns):
+        links = self._namespaces.get(netns)
+        if links is None:
+            raise OSError('Cannot open network namespace "%s"' % netns)
+        return links
+
+    def _link(self, ifname, netns):
+        link = self._links(netns).get(ifname)
+        if link is None:
+            raise OSError('Device "%s" does not exist' % ifname)
+        return link
+
+    def _link_add(self, netns, ifname, index=None):
+        link = {
+            'index': index or next(self._index),
+            'name': ifname,
+            'address': '00:00:00:00:00:00',
+            'peer': None,
+            'up': False,
+            'addresses': [],
+        }
+        self._links(netns)[ifname] = link
+        return link
+
+    def has_link(self, ifname, netns=None):
+        with self._lock:
+            return ifname in self._namespaces.get(netns, {})
+
+    def namespace_list(self):
+        self._record('namespace_list')
+        with self._lock:
+            return [netns for netns in self._namespaces if netns]
+
+    def namespace_add(self, netns):
+        self._record('namespace_add')
+        with self._lock:
+            if netns in self._namespaces:
+                raise OSError('Cannot create namespace "%s"' % netns)
+            self._namespaces[netns] = {}
+            self._link_add(netns, 'lo', index=1)
+
+    def namespace_delete(self, netns):
+        self._record('namespace_delete')
+        with self._lock:
+            for ifname in self._links(netns).keys():
+                self._link_remove(ifname, netns)
+            del self._namespaces[netns]
+
+    def namespace_rename(self, netns, name):
+        # touch, mount --bind, umount, rm
+        self._record('namespace_rename', forks=4)
+        with self._lock:
+            if name in self._namespaces:
+                raise OSError('File exists: %s' % name)
+            self._namespaces[name] = self._links(netns)
+            del self._namespaces[netns]
+            for ns_links in self._namespaces.values():
+                for link in ns_links.values():
+                    if link['peer'] is not None and link['peer'][0] == netns:
+                        link['peer'] = (name, link['peer'][1])
+
+    def link_list(self, netns=None):
+        self._record('link_list')
+        with self._lock:
+            return [(link['index'], link['name'])
+                    for link in self._links(netns).values()]
+
+    def _peer_ifindex(self, link):
+        if link['peer'] is None:
+            return None
+        peer_ns, peer_name = link['peer']
+        return self._namespaces[peer_ns][peer_name]['index']
+
+    def link_describe(self, netns=None):
+        self._record('link_describe')
+        with self._lock:
+            return [{'index': link['index'],
+                     'name': link['name'],
+                     'address': link['address'],
+                     'peer_ifindex': self._peer_ifindex(link),
+                     'peer_local': (link['peer'] is not None and
+                                    link['peer'][0] == netns)}
+                    for link in self._links(netns).values()]
+
+    def link_name(self, ifindex, netns=None):
+        # the shell backend resolves host indexes with if_indextoname()
+        self._record('link_name', forks=0 if netns is None else 1)
+        with self._lock:
+            for link in self._links(netns).values():
+                if link['index'] == ifindex:
+                    return link['name']
+        return None
+
+    def link_index(self, ifname, netns=None):
+        self._record('link_index')
+        with self._lock:
+            return self._link(ifname, netns)['index']
+
+    def link_address(self, ifname, netns=None):
+        self._record('link_address')
+        with self._lock:
+            return self._link(ifname, netns)['address']
+
+    def link_peer_ifindex(self, ifname, netns=None):
+        self._record('link_peer_ifindex')
+        with self._lock:
+            return self._peer_ifindex(self._link(ifname, netns))
+
+    def veth_create(self, ifname, peer, queues=None):
+        self._record('veth_create')
+        with self._lock:
+            links = self._links(None)
+            if ifname in links or peer in links:
+                raise OSError('RTNETLINK answers: File exists')
+            self._link_add(None, ifname)['peer'] = (None, peer)
+            self._link_add(None, peer)['peer'] = (None, ifname)
+
+    def link_set_netns(self, ifname, netns):
+        self._record('link_set_netns')
+        with self._lock:
+            target = self._links(netns)
+            if ifname in target:
+                raise OSError('RTNETLINK answers: File exists')
+            link = self._links(None).pop(ifname)
+            target[ifname] = link
+            if link['peer'] is not None:
+                peer_ns, peer_name = link['peer']
+                self._namespaces[peer_ns][peer_name]['peer'] = (netns, ifname)
+
+    def link_set_up(self, ifname, netns=None):
+        self._record('link_set_up')
+        with self._lock:
+            self._link(ifname, netns)['up'] = True
+
+    def link_set_mac(self, ifname, mac, netns=None):
+        self._record('link_set_mac')
+        with self._lock:
+            self._link(ifname, netns)['address'] = mac
+
+    def link_set_params(self, ifname, netns=None, mtu=None,
+                        txqueuelen=None):
+        if mtu is None and txqueuelen is None:
+            return
+        self._record('link_set_params')
+        with self._lock:
+            self._link(ifname, netns)
+
+    def link_set_offloads(self, ifname, offloads, netns=None):
+        # ethtool is forked by both backends
+        self._record('link_set_offloads')
+        with self._lock:
+            if self._emulate != 'shell':
+                self.forks += 1
+            self._link(ifname, netns)
+
+    def _link_remove(self, ifname, netns):
+        link = self._links(netns).pop(ifname, None)
+        if link is not None and link['peer'] is not None:
+            peer_ns, peer_name = link['peer']
+            self._namespaces[peer_ns].pop(peer_name, None)
+
+    def link_delete(self, ifname, netns=None):
+        self._record('link_delete')
+        with self._lock:
+            self._link(ifname, netns)
+            self._link_remove(ifname, netns)
+
+    def addr_replace(self, ifname, address, prefixlen, netns=None):
+        self._record('addr_replace')
+        with self._lock:
+            self._link(ifname, netns)['addresses'] = [(address, prefixlen)]
+
+    def route_replace_default(self, ifname, gateway, netns=None):
+        self._record('route_replace_default')
+        with self._lock:
+            self._link(ifname, netns)
+
+    def sysctl_set(self, key, value, netns=None):
+        self._record('sysctl_set')
+
+    def execute(self, command, netns=None):
+        self._record('execute')
+        return ''
+
+    def link_wait(self, ifname, timeout, netns=None, address=None):
+        # the shell backend reads the state with one command
+        self._record('link_wait')
+        with self._lock:
+            link = self._link(ifname, netns)
+            peer_up = True
+            if link['peer'] is not None:
+                peer_ns, peer_name = link['peer']
+                peer_up = self._namespaces[peer_ns][peer_name]['up']
+            return link['up'] and peer_up and (
+                address is None or
+                address in [addr for addr, _ in link['addresses']])
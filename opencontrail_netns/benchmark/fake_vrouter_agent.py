@@ -0,0 +1,74 @@
+"""
+Local InstanceService server standing in for the vrouter agent.
+"""
+
+import collections
+import socket
+import threading
+import time
+
+from nova_contrail_vif.gen_py.instance_service import InstanceService
+
+from thrift.protocol import TBinaryProtocol
+from thrift.server import TServer
+from thrift.transport import TSocket
+from thrift.transport import TTransport
+
+
+class FakeInstanceService(object):
+    """ InstanceService handler recording the registered ports """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.ports = {}
+        self.calls = collections.Counter()
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls.clear()
+
+    def AddPort(self, port_list):
+        with self._lock:
+            self.calls['AddPort'] += 1
+            for port in port_list:
+                self.ports[tuple(port.port_id)] = port
+        return True
+
+    def DeletePort(self, port_id):
+        with self._lock:
+            self.calls['DeletePort'] += 1
+            self.ports.pop(tuple(port_id), None)
+        return True
+
+    def KeepAliveCheck(self):
+        with self._lock:
+            self.calls['KeepAliveCheck'] += 1
+        return True
+
+    def Connect(self):
+        with self._lock:
+            self.calls['Connect'] += 1
+        return True
+
+
+def agent_start(handler, host='127.0.0.1', port=9090):
+    """ Serve handler from a daemon thread and return the server """
+    processor = InstanceService.Processor(handler)
+    transport = TSocket.TServerSocket(host=host, port=port)
+    server = TServer.TThreadedServer(
+        processor, transport, TTransport.TFramedTransportFactory(),
+        TBinaryProtocol.TBinaryProtocolFactory(), daemon=True)
+    thread = threading.Thread(target=server.serve)
+    thread.daemon = True
+    thread.start()
+
+    # wait for the listening socket
+    deadline = time.time() + 5
+    while True:
+        try:
+            socket.create_connection((host, port)).close()
+            break
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.01)
+    return server
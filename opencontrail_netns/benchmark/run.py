@@ -0,0 +1,228 @@
+"""
+Offline provisioning benchmark.
+
+Drives daemon_provision, daemon_unprovision, a reconciliation pass and
+NetworkManager against an in-process API server, a local InstanceService
+and an in-memory netns layer, then reports latency percentiles and the
+API round trips, forks and RPCs spent per operation:
+
+    netns-benchmark --daemons 1,10,100 --workers 8 --api-latency 2
+"""
+
+import argparse
+import collections
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from opencontrail_netns.batch import run_parallel
+from opencontrail_netns.contrail_lib import RpcClient
+from opencontrail_netns.daemon_ops import DaemonOperations
+from opencontrail_netns.daemon_ops import daemon_provision
+from opencontrail_netns.daemon_ops import daemon_unprovision
+from opencontrail_netns.daemon_ops import daemons_teardown
+from opencontrail_netns.daemon_state import DaemonStateStore
+from opencontrail_netns.ifname_allocator import InterfaceNameAllocator
+from opencontrail_netns.instance_provisioner import Provisioner
+from opencontrail_netns.lxc_manager import LxcManager
+from opencontrail_netns.netns_pool import NamespacePool
+from opencontrail_netns.network_manage import NetworkManager
+from opencontrail_netns.port_journal import PortJournal
+from opencontrail_netns.reconcile import Reconciler
+
+from fake_api_server import FakeVncApi
+from fake_netns import FakeBackend
+from fake_vrouter_agent import FakeInstanceService, agent_start
+
+
+PROJECT = 'default-domain:default-project'
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1,
+                       int(round(fraction * (len(ordered) - 1))))]
+
+
+class Environment(object):
+    """ Fresh stand-ins and scratch directories for one benchmark level """
+    def __init__(self, arguments, agent):
+        self.directory = tempfile.mkdtemp(prefix='netns-benchmark-')
+        self.api = FakeVncApi(latency=arguments.api_latency / 1000.0)
+        self.backend = FakeBackend(emulate=arguments.emulate)
+        self.agent = agent
+        allocator = InterfaceNameAllocator(
+            filename=os.path.join(self.directory, 'interfaces.bitmap'),
+            exists=self.backend.has_link)
+        self.manager = LxcManager(
+            backend=self.backend, allocator=allocator,
+            lock_file=os.path.join(self.directory, 'veth.lock'),
+            etc_dir=os.path.join(self.directory, 'etc'))
+        if arguments.pool_size:
+            self.manager.pool = NamespacePool(
+                self.manager, arguments.pool_size,
+                lock_file=os.path.join(self.directory, 'pool.lock'))
+        self.provisioner = Provisioner(client=self.api)
+        self.network_manager = NetworkManager(None, None, project=PROJECT,
+                                              client=self.api)
+        self.state_store = DaemonStateStore(
+            os.path.join(self.directory, 'state'))
+        self.rpc = RpcClient(port=arguments.agent_port)
+
+    def reset_counters(self):
+        self.api.reset_counters()
+        self.backend.reset_counters()
+        self.agent.reset_counters()
+
+    def close(self):
+        self.rpc.close()
+        shutil.rmtree(self.directory)
+
+
+def phase_run(env, name, func, items, workers, count=None):
+    """ count: number of operations, when an item holds several of them """
+    env.reset_counters()
+    latencies = []
+
+    def timed(item):
+        start = time.time()
+        func(item)
+        latencies.append(time.time() - start)
+
+    start = time.time()
+    results = run_parallel(timed, items, workers)
+    elapsed = time.time() - start
+    count = float(count or len(items))
+    return collections.OrderedDict([
+        ('phase', name),
+        ('count', int(count)),
+        ('failures', len([r for r in results if r[2] is not None])),
+        ('elapsed', elapsed),
+        ('p50_ms', percentile(latencies, 0.50) * 1000),
+        ('p99_ms', percentile(latencies, 0.99) * 1000),
+        ('api_per_op', env.api.round_trips / count),
+        ('forks_per_op', env.backend.forks / count),
+        ('rpcs_per_op', sum(env.agent.calls.values()) / count),
+    ])
+
+
+def level_run(arguments, agent, count):
+    env = Environment(arguments, agent)
+    daemons = ['bench%d' % i for i in range(count)]
+    networks = ['bench-net-%d' % i for i in range(count)]
+    network = '%s:default-network' % PROJECT
+
+    def net_create(name):
+        index = networks.index(name)
+        env.network_manager.create(name, subnet='100.%d.%d.0/24' %
+                                   (index / 256, index % 256))
+
+    def start(daemon):
+        daemon_provision(env.provisioner, env.manager, daemon, network,
+                         client=env.rpc, state_store=env.state_store,
+                         pipeline=arguments.pipeline)
+
+    def stop(daemon):
+        daemon_unprovision(env.provisioner, env.manager, daemon,
+                           client=env.rpc, state_store=env.state_store,
+                           pipeline=arguments.pipeline)
+
+    def reconcile(batch):
+        # the daemons are as they were provisioned: none may be started
+        # again
+        operations = DaemonOperations(
+            env.provisioner, env.manager, env.rpc, env.state_store,
+            workers=arguments.workers,
+            journal=PortJournal(os.path.join(env.directory, 'ports')))
+        reprovisioned = Reconciler(operations).run_once()
+        if reprovisioned:
+            raise RuntimeError('Reconciliation provisioned %d unchanged'
+                               ' daemons again' % len(reprovisioned))
+
+    def stop_bulk(batch):
+        results = daemons_teardown(env.provisioner, env.manager, batch,
+                                   client=env.rpc,
+                                   state_store=env.state_store,
+                                   workers=arguments.workers)
+        if [error for _, _, error in results if error is not None]:
+            raise RuntimeError('Bulk teardown failed')
+
+    try:
+        rows = [phase_run(env, 'net-create', net_create, networks,
+                          arguments.workers)]
+        if env.manager.pool is not None:
+            # spares are created ahead of the measured starts
+            env.manager.pool.refill()
+        rows.extend([
+            phase_run(env, 'start', start, daemons, arguments.workers),
+            phase_run(env, 'restart', start, daemons, arguments.workers),
+            phase_run(env, 'reconcile', reconcile, [daemons], 1,
+                      count=len(daemons)),
+        ])
+        if arguments.bulk:
+            rows.append(phase_run(env, 'stop', stop_bulk, [daemons], 1,
+                                  count=len(daemons)))
+        else:
+            rows.append(phase_run(env, 'stop', stop, daemons,
+                                  arguments.workers))
+        rows.append(phase_run(env, 'net-delete', env.network_manager.delete,
+                              networks, arguments.workers))
+        return rows
+    finally:
+        env.close()
+
+
+def report_print(rows):
+    header = ('%-10s %6s %5s %9s %9s %9s %8s %8s %8s' %
+              ('phase', 'count', 'fail', 'elapsed', 'p50(ms)', 'p99(ms)',
+               'api/op', 'forks/op', 'rpcs/op'))
+    print header
+    for row in rows:
+        print ('%-10s %6d %5d %9.3f %9.2f %9.2f %8.2f %8.2f %8.2f' %
+               tuple(row.values()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--daemons", default='1,10,100',
+                        help="Comma separated list of daemon counts")
+    parser.add_argument("-w", "--workers", type=int, default=8,
+                        help="Concurrent operations")
+    parser.add_argument("--api-latency", type=float, default=1.0,
+                        help="Simulated API server round trip in ms")
+    parser.add_argument("--agent-port", type=int, default=19090,
+                        help="Port of the local InstanceService")
+    parser.add_argument("--emulate", default='shell',
+                        choices=['shell', 'netlink'],
+                        help="Backend whose forks are accounted")
+    parser.add_argument("--pipeline", action='store_true',
+                        help="Use the pipelined start/stop path")
+    parser.add_argument("--bulk", action='store_true',
+                        help="Stop all the daemons with one bulk teardown")
+    parser.add_argument("--pool-size", type=int, default=0,
+                        help="Spare namespaces created before the starts")
+    parser.add_argument("--output", help="Write the results as JSON")
+    arguments = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    agent = FakeInstanceService()
+    agent_start(agent, port=arguments.agent_port)
+
+    rows = []
+    for count in [int(value) for value in arguments.daemons.split(',')]:
+        rows.extend(level_run(arguments, agent, count))
+    report_print(rows)
+
+    if arguments.output:
+        with open(arguments.output, 'w') as fp:
+            json.dump(rows, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Bounded cache for configuration objects that rarely change (virtual
+networks, IPAM subnets, fq_name to uuid resolutions).
+"""
+
+import collections
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+
+class ConfigCache(object):
+    """
+    LRU cache with a per entry time to live. When a filename is given the
+    entries are loaded from and written back to that file, so that
+    consecutive processes can share them; values must then be JSON
+    serializable.
+    """
+    def __init__(self, maxsize=1024, ttl=300, filename=None):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._filename = filename
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if filename:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self._filename) as fp:
+                data = json.load(fp)
+        except (IOError, ValueError):
+            return
+        now = time.time()
+        for key, (expires, value) in sorted(data.items(),
+                                            key=lambda item: item[1][0]):
+            if expires > now:
+                self._entries[key] = (expires, value)
+        self._trim()
+
+    def _save(self):
+        dirname = os.path.dirname(os.path.abspath(self._filename))
+        try:
+            fd, tmpname = tempfile.mkstemp(dir=dirname)
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(dict(self._entries), fp)
+            os.rename(tmpname, self._filename)
+        except (IOError, OSError) as ex:
+            logging.warning('Unable to save cache %s: %s',
+                            self._filename, ex)
+
+    def _trim(self):
+        while len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= time.time():
+                self.misses += 1
+                return default
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self._ttl, value)
+            self._trim()
+            if self._filename:
+                self._save()
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._entries.pop(key, None) is not None and self._filename:
+                self._save()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
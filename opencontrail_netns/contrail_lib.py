@@ -1,9 +1,8 @@
 import sys
 
 import getopt
-import logging
 import socket
-import thrift
+import threading
 import uuid
 
 from nova_contrail_vif.gen_py.instance_service import InstanceService
@@ -11,20 +10,104 @@ from nova_contrail_vif.gen_py.instance_service import InstanceService
 from thrift.protocol import TBinaryProtocol
 from thrift.transport import TTransport
 
+import metrics
+import tracing
 
-def rpc_client_instance():
-    """ Return an RPC client connection """
-    import thrift.transport.TSocket as TSocket
-    socket = TSocket.TSocket('127.0.0.1', 9090)
-    try:
-        transport = TTransport.TFramedTransport(socket)
+
+RPC_ERRORS = (socket.error, TTransport.TTransportException)
+
+
+class RpcClient(object):
+    """
+    Persistent connection to the vrouter agent InstanceService.
+    The transport is opened on first use and re-opened once when a call
+    fails. Calls are serialized so that a client can be shared between
+    threads. connects counts the transports opened, which lets callers
+    notice that the agent may have been restarted.
+    """
+    def __init__(self, host='127.0.0.1', port=9090):
+        self._host = host
+        self._port = port
+        self._transport = None
+        self._client = None
+        self._lock = threading.Lock()
+        self.connects = 0
+
+    def _connect(self):
+        import thrift.transport.TSocket as TSocket
+        if self._client is not None:
+            return self._client
+        sock = TSocket.TSocket(self._host, self._port)
+        transport = TTransport.TFramedTransport(sock)
         transport.open()
-    except thrift.transport.TTransport.TTransportException:
-        logging.error('Connection failure')
-        return None
-    protocol = TBinaryProtocol.TBinaryProtocol(transport)
-    return InstanceService.Client(protocol)
-# end rpc_client_instance
+        protocol = TBinaryProtocol.TBinaryProtocol(transport)
+        self._transport = transport
+        self._client = InstanceService.Client(protocol)
+        self.connects += 1
+        return self._client
+
+    def _disconnect(self):
+        if self._transport is not None:
+            try:
+                self._transport.close()
+            except RPC_ERRORS:
+                pass
+        self._transport = None
+        self._client = None
+
+    def _call(self, method, *args):
+        metrics.count(metrics.RPC)
+        with tracing.span(method, 'rpc'):
+            try:
+                return getattr(self._connect(), method)(*args)
+            except RPC_ERRORS:
+                self._disconnect()
+            try:
+                return getattr(self._connect(), method)(*args)
+            except RPC_ERRORS:
+                self._disconnect()
+                raise
+
+    def call(self, method, *args):
+        """
+        Invoke an InstanceService method. Raises one of RPC_ERRORS if the
+        call fails after a reconnect.
+        """
+        with self._lock:
+            return self._call(method, *args)
+
+    def call_batch(self, method, args_list):
+        """
+        Invoke method once per tuple of arguments, back to back on the
+        connection, and return the results.
+        """
+        with self._lock:
+            return [self._call(method, *args) for args in args_list]
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+# end RpcClient
+
+
+_shared_client = None
+_shared_client_lock = threading.Lock()
+
+
+def rpc_client_shared():
+    """ Return the process wide RpcClient """
+    global _shared_client
+    with _shared_client_lock:
+        if _shared_client is None:
+            _shared_client = RpcClient()
+        return _shared_client
+# end rpc_client_shared
 
 
 def uuid_from_string(idstr):
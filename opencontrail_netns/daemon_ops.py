@@ -0,0 +1,475 @@
+"""
+Provisioning operations behind netns-daemon-start and netns-daemon-stop,
+shared by the command line tools and the netns agent.
+"""
+
+import functools
+import logging
+import socket
+import threading
+import time
+import traceback
+
+import metrics
+from batch import run_concurrently, run_parallel
+from lxc_manager import DHCP_TIMEOUT, READY_TIMEOUT
+from port_journal import journal_apply
+from ratelimit import backoff_delays
+from vrouter_control import add_ports, interface_register_batch, port_data
+from vrouter_control import del_ports, interface_unregister
+
+
+# instance side name of the primary and outbound interfaces
+INSTANCE_IFNAMES = ['veth0', 'veth1']
+
+
+def daemon_restore(manager, daemon, state, client=None, journal=None):
+    """
+    Restart fast path: if the kernel still matches the checkpoint (veth
+    pairs, mac and IP addresses), only re-register the ports with the
+    vrouter agent. Returns False when a full provisioning run is
+    required.
+    """
+    for iface in state['interfaces']:
+        if not manager.interface_verify(daemon, iface['name'], iface['mac'],
+                                        iface['master'],
+                                        iface['master_ifindex'],
+                                        address=iface.get('ip')):
+            return False
+
+    ports = [(iface['master'], iface['vmi'], state['vm'], iface['mac'])
+             for iface in state['interfaces']]
+    if journal is not None:
+        journal.add(daemon, ports)
+    else:
+        add_ports([port_data(*port) for port in ports], client=client)
+    return True
+
+# end daemon_restore
+
+
+def _api_locate(provisioner, daemon, networks, concurrent=False):
+    """
+    Locate the virtual-machine of a daemon and one interface per network.
+    """
+    instance_name = '%s-%s' % (socket.gethostname(), daemon)
+    with metrics.phase('api_locate'):
+        vm = provisioner.virtual_machine_locate(instance_name)
+
+        funcs = [functools.partial(provisioner.vmi_locate, vm, network,
+                                   ifname)
+                 for ifname, network in zip(INSTANCE_IFNAMES, networks)]
+        if concurrent:
+            vmi_list = run_concurrently(*funcs)
+        else:
+            vmi_list = [func() for func in funcs]
+    return vm, vmi_list
+
+
+def _kernel_prepare(manager, daemon, count, queues=None):
+    """
+    Create the namespace and the veth pairs, before the mac addresses are
+    known. Returns the master interface names.
+    """
+    with metrics.phase('kernel_prepare'):
+        # spare namespaces hold single queue veths
+        manager.namespace_init(daemon, spare=not queues)
+        return [manager.interface_prepare(daemon, ifname, queues=queues)
+                for ifname in INSTANCE_IFNAMES[:count]]
+
+
+def daemon_provision(provisioner, manager, daemon, network, outbound=None,
+                     client=None, state_store=None, restore=True,
+                     dhcp=False, dhcp_timeout=DHCP_TIMEOUT, pipeline=False,
+                     journal=None, ready_timeout=READY_TIMEOUT,
+                     tuning=None):
+    """
+    Provision a single daemon. network and outbound are fully qualified
+    network names. When a state_store is given the result is checkpointed
+    and, if restore is set, the API server is not contacted as long as
+    the checkpoint of a previous run is still valid.
+    With a PortJournal, the ports are journaled instead of registered
+    with the vrouter agent.
+    Addresses are configured statically unless dhcp is set, and the
+    interfaces must be up with their address within ready_timeout.
+    With pipeline, API server requests and kernel configuration that do
+    not depend on each other are issued concurrently.
+    tuning is an optional tuning profile of the veth pairs (see tuning);
+    a checkpoint is only restored with the profile it was created with.
+    """
+    if state_store and restore:
+        with metrics.phase('restore'):
+            state = state_store.load(daemon)
+            restored = (state and state['network'] == network and
+                        state['outbound'] == outbound and
+                        state.get('tuning') == tuning and
+                        daemon_restore(manager, daemon, state,
+                                       client=client, journal=journal))
+        if restored:
+            logging.info('%s: restored from checkpoint', daemon)
+            return
+
+    networks = [network]
+    if outbound:
+        networks.append(outbound)
+    queues = tuning and tuning.get('queues')
+
+    if pipeline:
+        (vm, vmi_list), masters = run_concurrently(
+            lambda: _api_locate(provisioner, daemon, networks,
+                                concurrent=True),
+            lambda: _kernel_prepare(manager, daemon, len(networks),
+                                    queues=queues))
+    else:
+        vm, vmi_list = _api_locate(provisioner, daemon, networks)
+        with metrics.phase('kernel_prepare'):
+            manager.namespace_init(daemon, spare=not queues)
+        masters = [None] * len(networks)
+
+    ports = []
+    with metrics.phase('interface_update'):
+        for ifname_instance, port_vmi, ifname_master in zip(
+                INSTANCE_IFNAMES, vmi_list, masters):
+            network_mtu = None
+            if tuning and tuning.get('mtu') == 'auto':
+                network_mtu = provisioner.get_interface_mtu(port_vmi)
+            ifname = manager.interface_update(daemon, port_vmi,
+                                              ifname_instance,
+                                              ifname_master=ifname_master,
+                                              tuning=tuning,
+                                              network_mtu=network_mtu)
+            ports.append((vm, port_vmi, ifname))
+    vmi = vmi_list[0]
+    vmi_out = vmi_list[1] if outbound else None
+
+    with metrics.phase('port_register'):
+        if journal is not None:
+            journal.add(daemon, [
+                (ifname, port_vmi.uuid, vm.uuid,
+                 port_vmi.virtual_machine_interface_mac_addresses.
+                 mac_address[0])
+                for _, port_vmi, ifname in ports])
+        else:
+            interface_register_batch(ports, client=client)
+
+    # ip_config holds the ip_prefix, gateway and dns_servers arguments
+    single_interface = (outbound is None)
+    with metrics.phase('ip_lookup'):
+        ip_config = provisioner.get_interface_ip_config(vmi) or {}
+        if vmi_out:
+            ip_config_out = provisioner.get_interface_ip_config(vmi_out) or {}
+    with metrics.phase('dhcp' if dhcp else 'interface_config'):
+        manager.interface_config(daemon, 'veth0',
+                                 advertise_default=single_interface,
+                                 dhcp=dhcp, dhcp_timeout=dhcp_timeout,
+                                 ready_timeout=ready_timeout, **ip_config)
+        if vmi_out:
+            manager.interface_config(daemon, 'veth1', dhcp=dhcp,
+                                     dhcp_timeout=dhcp_timeout,
+                                     ready_timeout=ready_timeout,
+                                     **ip_config_out)
+
+    if state_store:
+        with metrics.phase('checkpoint'):
+            interfaces = []
+            for _, port_vmi, ifname_master in ports:
+                macs = port_vmi.virtual_machine_interface_mac_addresses
+                interfaces.append({
+                    'name': port_vmi.fq_name[-1],
+                    'vmi': port_vmi.uuid,
+                    'mac': macs.mac_address[0],
+                    'master': ifname_master,
+                    'master_ifindex': manager.interface_index(ifname_master),
+                })
+            if ip_config:
+                interfaces[0]['ip'] = ip_config['ip_prefix'][0]
+            state_store.save(daemon, {
+                'vm': vm.uuid,
+                'network': network,
+                'outbound': outbound,
+                'tuning': tuning,
+                'interfaces': interfaces,
+            })
+
+# end daemon_provision
+
+
+def _api_delete(provisioner, vm, vmi_list, concurrent=False):
+    with metrics.phase('api_delete'):
+        funcs = [functools.partial(provisioner.vmi_delete, ref['uuid'])
+                 for ref in vmi_list]
+        if concurrent:
+            run_concurrently(*funcs)
+        else:
+            for func in funcs:
+                func()
+
+        provisioner.virtual_machine_delete(vm)
+
+
+def _kernel_delete(manager, daemon):
+    with metrics.phase('kernel_delete'):
+        manager.clear_interfaces(daemon)
+        manager.namespace_delete(daemon)
+
+
+def daemon_unprovision(provisioner, manager, daemon, client=None,
+                       state_store=None, pipeline=False, journal=None):
+    # drop the checkpoint first: a partial teardown must not be restored
+    if state_store:
+        state_store.remove(daemon)
+
+    instance_name = '%s-%s' % (socket.gethostname(), daemon)
+    with metrics.phase('lookup'):
+        vm = provisioner.virtual_machine_lookup(instance_name)
+
+    vmi_list = vm.get_virtual_machine_interfaces()
+    with metrics.phase('port_unregister'):
+        if journal is not None:
+            journal.delete([ref['uuid'] for ref in vmi_list])
+        else:
+            for ref in vmi_list:
+                interface_unregister(ref['uuid'], client=client)
+
+    if pipeline:
+        # the kernel and API server objects are independent once the
+        # ports are gone from the vrouter
+        run_concurrently(
+            lambda: _api_delete(provisioner, vm, vmi_list, concurrent=True),
+            lambda: _kernel_delete(manager, daemon))
+        return
+
+    with metrics.phase('kernel_delete'):
+        manager.clear_interfaces(daemon)
+    _api_delete(provisioner, vm, vmi_list)
+    with metrics.phase('kernel_delete'):
+        manager.namespace_delete(daemon)
+
+# end daemon_unprovision
+
+
+def daemons_teardown(provisioner, manager, daemons, client=None,
+                     state_store=None, workers=8, vms=None, limiter=None,
+                     journal=None):
+    """
+    Unprovision several daemons at once, for instance to drain a node:
+    - every port is unregistered on one vrouter connection;
+    - each namespace is deleted in one operation, the kernel deleting
+      the veth pairs along with it;
+    - instance-ips, then interfaces, then virtual-machines are deleted
+      with up to workers concurrent API server requests.
+    vms optionally holds the virtual-machines of the daemons, already
+    read with their interfaces; limiter is an optional TokenBucket
+    paced by the namespace and API object deletions. With a PortJournal,
+    the ports are journaled for deletion instead.
+    Returns run_parallel style results, one per daemon.
+    """
+    errors = {}
+
+    def limited(func):
+        if limiter is None:
+            return func
+
+        def call(item):
+            limiter.acquire()
+            return func(item)
+        return call
+
+    def failed(results, daemon=lambda item: item):
+        for item, _, error in results:
+            if error is not None:
+                errors.setdefault(daemon(item), error)
+
+    def lookup(daemon):
+        # drop the checkpoint first: a partial teardown must not be restored
+        if state_store:
+            state_store.remove(daemon)
+        if vms is not None:
+            return vms.get(daemon)
+        instance_name = '%s-%s' % (socket.gethostname(), daemon)
+        return provisioner.virtual_machine_lookup(instance_name)
+
+    with metrics.phase('lookup'):
+        results = run_parallel(lookup, daemons, workers)
+    failed(results)
+    found = dict((daemon, vm) for daemon, vm, error in results
+                 if error is None and vm is not None)
+    vmis = dict((daemon, [ref['uuid'] for ref in
+                          vm.get_virtual_machine_interfaces() or []])
+                for daemon, vm in found.items())
+
+    with metrics.phase('port_unregister'):
+        ports = [uuid for uuids in vmis.values() for uuid in uuids]
+        if journal is not None:
+            journal.delete(ports)
+        else:
+            del_ports(ports, client=client)
+
+    with metrics.phase('kernel_delete'):
+        namespaces = set(manager.namespace_daemons())
+        failed(run_parallel(limited(manager.namespace_destroy),
+                            [daemon for daemon in daemons
+                             if daemon in namespaces and
+                             daemon not in errors],
+                            workers))
+
+    def delete(task):
+        provisioner.object_delete(task[1], task[2])
+
+    def delete_all(obj_type, uuids):
+        tasks = [(daemon, obj_type, uuid)
+                 for daemon in daemons if daemon not in errors
+                 for uuid in uuids.get(daemon, [])]
+        with metrics.phase('api_delete'):
+            failed(run_parallel(limited(delete), tasks, workers),
+                   daemon=lambda task: task[0])
+
+    try:
+        with metrics.phase('api_delete'):
+            ips = provisioner.instance_ips_by_vmi(
+                [uuid for daemon, uuids in vmis.items()
+                 if daemon not in errors for uuid in uuids])
+    except Exception:
+        logging.exception('Unable to list the instance-ips')
+        error = traceback.format_exc()
+        return [(daemon, None, errors.get(daemon, error))
+                for daemon in daemons]
+    delete_all('instance_ip', dict(
+        (daemon, [ip for uuid in uuids for ip in ips.get(uuid, [])])
+        for daemon, uuids in vmis.items()))
+    delete_all('virtual_machine_interface', vmis)
+    delete_all('virtual_machine',
+               dict((daemon, [vm.uuid]) for daemon, vm in found.items()))
+
+    return [(daemon, None, errors.get(daemon)) for daemon in daemons]
+
+# end daemons_teardown
+
+
+class DaemonOperations(object):
+    """
+    Context shared by the daemons handled by a process: API server
+    client, namespace manager, vrouter client and checkpoint store.
+    The daemons being processed are tracked so that the reconciler can
+    leave them alone.
+    With a PortJournal, port operations are journaled and then applied
+    by the applier (a PortApplier) or, without one, once in the calling
+    thread at the end of each operation. Operations that fail stay in
+    the journal for the next invocation or for the agent.
+    """
+    def __init__(self, provisioner, manager, client, state_store=None,
+                 workers=8, journal=None, applier=None):
+        self.provisioner = provisioner
+        self.manager = manager
+        self.client = client
+        self.state_store = state_store
+        self.workers = workers
+        self.journal = journal
+        self.applier = applier
+        self._busy = set()
+        self._busy_lock = threading.Lock()
+
+    def busy(self):
+        """ Return the daemons currently being started or stopped """
+        with self._busy_lock:
+            return set(self._busy)
+
+    def _run(self, func, daemon, operation):
+        with self._busy_lock:
+            self._busy.add(daemon)
+        try:
+            with metrics.run(daemon, operation):
+                func()
+        finally:
+            with self._busy_lock:
+                self._busy.discard(daemon)
+
+    def ports_flush(self, daemons=(), wait=None):
+        """
+        Apply the journaled port operations. With wait, keep applying for
+        up to wait seconds until those of daemons are applied. Returns
+        the daemons whose operations are still pending.
+        """
+        if self.journal is None:
+            return set()
+        deadline = time.time() + (wait or 0)
+        delays = backoff_delays(64, base=0.1, cap=2)
+        while True:
+            if self.applier is not None:
+                self.applier.notify()
+            else:
+                journal_apply(self.journal, self.client)
+            pending = self.journal.daemons_pending(daemons)
+            remaining = deadline - time.time()
+            if not pending or remaining <= 0:
+                return pending
+            time.sleep(min(next(delays, 2), remaining))
+
+    def _ports_settle(self, results, daemon, wait=None):
+        """
+        Flush the journal after an operation. Without wait, the operation
+        returns once its ports are journaled: the applier is only
+        notified, or the journal is applied once. With wait, the daemons
+        whose ports are still pending after wait seconds fail.
+        """
+        if wait is None and self.applier is not None:
+            self.applier.notify()
+            return results
+        daemons = [daemon(item) for item, _, error in results
+                   if error is None]
+        pending = self.ports_flush(daemons, wait)
+        if not pending:
+            return results
+        if wait is None:
+            logging.warning('vrouter agent unavailable, ports of %s'
+                            ' left in the journal', ', '.join(sorted(pending)))
+            return results
+        message = 'vrouter port registration timed out after %ss\n' % wait
+        return [(item, result, message
+                 if error is None and daemon(item) in pending else error)
+                for item, result, error in results]
+
+    def start(self, entries, port_wait=None, **options):
+        """
+        entries: list of [daemon, network, outbound] with fully qualified
+        network names (outbound may be None). options are passed to
+        daemon_provision. With port_wait, a daemon fails when its ports
+        are not registered within port_wait seconds. Returns the
+        run_parallel results.
+        """
+        def provision(entry):
+            self._run(lambda: daemon_provision(
+                self.provisioner, self.manager, entry[0], entry[1],
+                outbound=entry[2], client=self.client,
+                state_store=self.state_store, journal=self.journal,
+                **options), entry[0], 'start')
+        results = run_parallel(provision, entries, self.workers)
+        return self._ports_settle(results, lambda entry: entry[0],
+                                  port_wait)
+
+    def stop(self, daemons, bulk=False, **options):
+        """
+        With bulk, the daemons are torn down together by daemons_teardown;
+        options are then ignored.
+        """
+        if bulk:
+            with self._busy_lock:
+                self._busy.update(daemons)
+            try:
+                with metrics.run(None, 'bulk_stop'):
+                    results = daemons_teardown(
+                        self.provisioner, self.manager, daemons,
+                        client=self.client, state_store=self.state_store,
+                        workers=self.workers, journal=self.journal)
+            finally:
+                with self._busy_lock:
+                    self._busy.difference_update(daemons)
+            return self._ports_settle(results, lambda daemon: daemon)
+
+        def unprovision(daemon):
+            self._run(lambda: daemon_unprovision(
+                self.provisioner, self.manager, daemon, client=self.client,
+                state_store=self.state_store, journal=self.journal,
+                **options), daemon, 'stop')
+        results = run_parallel(unprovision, daemons, self.workers)
+        return self._ports_settle(results, lambda daemon: daemon)
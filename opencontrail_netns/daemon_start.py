@@ -4,12 +4,17 @@ application can be executed under the context of a virtualized network.
 """
 
 import argparse
-import socket
+import logging
+import os
 import sys
+import time
 
-from instance_provisioner import Provisioner
-from lxc_manager import LxcManager
-from vrouter_control import interface_register
+from agent_client import AGENT_CONFIG_OPTIONS, AGENT_SOCKET, agent_request
+from agent_client import options_given
+from batch import batch_report, manifest_read
+from daemon_state import STATE_DIR, DaemonStateStore
+from tracing import profile_start, span, span_add, trace_start
+from tuning import PROFILES, profile_load
 
 
 def build_network_name(project_name, network_name):
@@ -18,12 +23,45 @@ def build_network_name(project_name, network_name):
     return "%s:%s" % (project_name, network_name)
 
 
+def _local_start(arguments, entries, options):
+    """ Provision in this process when no agent is running """
+    with span('imports', 'startup'):
+        from contrail_lib import rpc_client_shared
+        from daemon_ops import DaemonOperations
+        from instance_provisioner import Provisioner
+        from lxc_manager import LxcManager
+        from metrics import sinks_configure
+        from port_journal import PortJournal
+
+    sinks_configure(arguments.metrics_dir, arguments.metrics_log)
+    provisioner = Provisioner(api_server=arguments.api_server,
+                              api_port=arguments.api_port,
+                              cache_ttl=arguments.cache_ttl,
+                              cache_file=arguments.cache_file,
+                              share_ttl=arguments.api_share_ttl,
+                              api_rate=arguments.api_rate)
+    with rpc_client_shared() as client:
+        operations = DaemonOperations(
+            provisioner, LxcManager(backend=arguments.netns_backend),
+            client, DaemonStateStore(arguments.state_dir),
+            workers=arguments.workers,
+            journal=PortJournal(os.path.join(arguments.state_dir, 'ports')))
+        results = operations.start(entries, **options)
+    logging.debug('Cache statistics: %s', provisioner.cache_stats())
+    logging.debug('API statistics: %s', provisioner.api_stats())
+    return results
+
+
 def daemon_start():
     """
     Creates a virtual-machine and vmi object in the API server.
     Creates a namespace and a veth interface pair.
     Associates the veth interface in the master instance with the vrouter.
+
+    Several daemons may be given on the command line or in a manifest
+    file; they are then provisioned concurrently.
     """
+    started = time.time()
     parser = argparse.ArgumentParser()
     defaults = {
         'api-server': '127.0.0.1',
@@ -36,43 +74,134 @@ def daemon_start():
     parser.add_argument("-p", "--api-port", type=int, help="API server port")
     parser.add_argument("-n", "--network", help="Primary network")
     parser.add_argument("-o", "--outbound", help="Outbound traffic network")
-    parser.add_argument("daemon", help="Deamon Name")
-
-    arguments = parser.parse_args(sys.argv)
-
-    manager = LxcManager()
-    provisioner = Provisioner(api_server=arguments.api_server,
-                              api_port=arguments.api_port)
-    instance_name = '%s-%s' % (socket.gethostname(), arguments.daemon)
-    vm = provisioner.virtual_machine_locate(instance_name)
-
-    network = build_network_name(arguments.project, arguments.network)
-
-    vmi = provisioner.vmi_locate(vm, network, 'veth0')
-    vmi_out = None
-    if arguments.outbound:
-        outbound_name = build_network_name(arguments.project,
-                                           arguments.outbound)
-        vmi_out = provisioner.vmi_locate(vm, outbound_name, 'veth1')
-
-    manager.namespace_init(arguments.daemon)
-    ifname = manager.interface_update(arguments.daemon, vmi, 'veth0')
-    interface_register(vm, vmi, ifname)
-
-    if vmi_out:
-        ifname = manager.interface_update(arguments.daemon, vmi_out, 'veth1')
-        interface_register(vm, vmi_out, ifname)
-
-    single_interface = (arguments.outbound is None)
-    ip_prefix = provisioner.get_interface_ip_prefix(vmi)
-    manager.interface_config(arguments.daemon, 'veth0',
-                             advertise_default=single_interface,
-                             ip_prefix=ip_prefix)
-    if vmi_out:
-        manager.interface_config(arguments.daemon, 'veth1')
+    parser.add_argument("--netns-backend", default='auto',
+                        choices=['auto', 'netlink', 'shell'],
+                        help="Kernel interface used to manage namespaces")
+    parser.add_argument("-m", "--manifest",
+                        help="File listing one 'daemon [network [outbound]]'"
+                        " per line")
+    parser.add_argument("-w", "--workers", type=int, default=8,
+                        help="Daemons provisioned concurrently in batch mode")
+    parser.add_argument("--cache-file",
+                        help="File used to share cached network lookups"
+                        " between invocations")
+    parser.add_argument("--cache-ttl", type=int, default=300,
+                        help="Lifetime in seconds of cached network lookups")
+    parser.add_argument("--api-share-ttl", type=float, default=2,
+                        help="Seconds during which API server replies are"
+                        " shared with the other processes of the host"
+                        " (0 disables)")
+    parser.add_argument("--api-rate", type=float, default=50,
+                        help="Maximum API server writes per second for the"
+                        " host (0 for no limit)")
+    parser.add_argument("--state-dir", default=STATE_DIR,
+                        help="Directory holding the per daemon checkpoints")
+    parser.add_argument("--full-reconcile", action='store_true',
+                        help="Ignore checkpoints and query the API server")
+    parser.add_argument("--dhcp", action='store_true',
+                        help="Configure addresses with dhclient")
+    parser.add_argument("--dhcp-timeout", type=int,
+                        help="Seconds to wait for a DHCP lease")
+    parser.add_argument("--tuning-profile",
+                        help="Tuning of the veth pairs: MTU, txqueuelen,"
+                        " offloads and queues (built-in: %s)" %
+                        ', '.join(sorted(PROFILES)))
+    parser.add_argument("--tuning-file",
+                        help="JSON file of additional tuning profiles")
+    parser.add_argument("--ready-timeout", type=float,
+                        help="Seconds to wait for the interfaces to be up"
+                        " with their address (0 does not wait)")
+    parser.add_argument("--pipeline", action='store_true',
+                        help="Overlap API server and kernel operations")
+    parser.add_argument("--wait-port", action='store_true',
+                        help="Wait until the vrouter agent registered the"
+                        " ports instead of returning once they are"
+                        " journaled")
+    parser.add_argument("--port-timeout", type=float, default=30,
+                        help="Seconds --wait-port waits before failing")
+    parser.add_argument("--agent-socket", default=AGENT_SOCKET,
+                        help="Control socket of the netns agent")
+    parser.add_argument("--no-agent", action='store_true',
+                        help="Provision in this process even if the netns"
+                        " agent is running")
+    parser.add_argument("--metrics-dir",
+                        help="node-exporter textfile directory receiving the"
+                        " phase timings and call counts of each daemon")
+    parser.add_argument("--metrics-log",
+                        help="File receiving one JSON line per daemon run")
+    parser.add_argument("--trace",
+                        help="Write a Chrome trace event timeline of the run"
+                        " to this file")
+    parser.add_argument("--profile",
+                        help="Write cProfile statistics of the main thread"
+                        " to this file")
+    parser.add_argument("daemon", nargs='*', help="Deamon Name")
+
+    arguments = parser.parse_args(sys.argv[1:])
+    if arguments.profile:
+        profile_start(arguments.profile)
+    if arguments.trace:
+        trace_start(arguments.trace)
+        span_add('parse_arguments', 'startup', started)
+
+    entries = [[daemon] for daemon in arguments.daemon]
+    if arguments.manifest:
+        entries.extend(manifest_read(arguments.manifest))
+    if not entries:
+        parser.error('no daemon specified')
+
+    # [daemon, network, outbound] with fully qualified network names
+    for entry in entries:
+        network = entry[1] if len(entry) > 1 else arguments.network
+        outbound = entry[2] if len(entry) > 2 else arguments.outbound
+        entry[1:] = [build_network_name(arguments.project, network),
+                     outbound and build_network_name(arguments.project,
+                                                     outbound)]
+
+    options = {
+        'restore': not arguments.full_reconcile,
+        'dhcp': arguments.dhcp,
+        'pipeline': arguments.pipeline,
+    }
+    if arguments.dhcp_timeout is not None:
+        options['dhcp_timeout'] = arguments.dhcp_timeout
+    if arguments.ready_timeout is not None:
+        options['ready_timeout'] = arguments.ready_timeout
+    if arguments.wait_port:
+        options['port_wait'] = arguments.port_timeout
+    if arguments.tuning_profile:
+        try:
+            # sent resolved, so that the agent needs no profile file
+            options['tuning'] = profile_load(arguments.tuning_profile,
+                                             arguments.tuning_file) or None
+        except (IOError, ValueError) as ex:
+            parser.error(str(ex))
+
+    # the agent applies its own configuration: run in-process when this
+    # invocation sets any
+    local = arguments.no_agent or options_given(
+        parser, sys.argv[1:],
+        AGENT_CONFIG_OPTIONS + ('cache_file', 'cache_ttl'))
+    results = None
+    if not local:
+        with span('agent_request', 'agent'):
+            results = agent_request(arguments.agent_socket, 'start',
+                                    entries, options)
+    if results is None:
+        results = _local_start(arguments, entries, options)
+
+    if len(entries) == 1 and not arguments.manifest:
+        error = results[0][2]
+        if error is not None:
+            sys.stderr.write(error)
+            sys.exit(1)
+        return
+
+    if batch_report(results, name=lambda entry: entry[0]):
+        sys.exit(1)
 
 # end daemon_start
 
 
 if __name__ == '__main__':
-    deamon_start()
+    daemon_start()
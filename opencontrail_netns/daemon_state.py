@@ -0,0 +1,68 @@
+"""
+Per daemon checkpoint of the provisioned state. daemon_start records the
+identifiers it obtained from the API server and the kernel so that a
+restart can be validated against the kernel alone.
+"""
+
+import errno
+import json
+import logging
+import os
+import tempfile
+
+
+STATE_DIR = '/var/lib/opencontrail-netns'
+
+
+class DaemonStateStore(object):
+    def __init__(self, directory=STATE_DIR):
+        self._directory = directory
+
+    def _filename(self, daemon):
+        return os.path.join(self._directory, '%s.json' % daemon)
+
+    def load(self, daemon):
+        """ Return the recorded state of a daemon or None """
+        try:
+            with open(self._filename(daemon)) as fp:
+                return json.load(fp)
+        except IOError as ex:
+            if ex.errno != errno.ENOENT:
+                logging.warning('Unable to read state of %s: %s', daemon, ex)
+        except ValueError:
+            logging.warning('Corrupted state file for %s', daemon)
+        return None
+
+    def save(self, daemon, state):
+        try:
+            os.makedirs(self._directory)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        fd, tmpname = tempfile.mkstemp(dir=self._directory)
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(state, fp)
+        os.rename(tmpname, self._filename(daemon))
+
+    def remove(self, daemon):
+        try:
+            os.unlink(self._filename(daemon))
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+
+    def modified(self, daemon):
+        """ Return the modification time of the state of a daemon or None """
+        try:
+            return os.stat(self._filename(daemon)).st_mtime
+        except OSError:
+            return None
+
+    def daemons(self):
+        """ Return the names of the daemons with a recorded state """
+        try:
+            names = os.listdir(self._directory)
+        except OSError:
+            return []
+        return [name[:-len('.json')] for name in names
+                if name.endswith('.json')]
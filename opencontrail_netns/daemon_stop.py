@@ -3,15 +3,46 @@ Unconfigure the namespace created by daemon_start.
 """
 
 import argparse
-import socket
+import logging
+import os
 import sys
+import time
 
-from instance_provisioner import Provisioner
-from lxc_manager import LxcManager
-from vrouter_control import interface_unregister
+from agent_client import AGENT_CONFIG_OPTIONS, AGENT_SOCKET, agent_request
+from agent_client import options_given
+from batch import batch_report, manifest_read
+from daemon_state import STATE_DIR, DaemonStateStore
+from tracing import profile_start, span, span_add, trace_start
+
+
+def _local_stop(arguments, daemons, options):
+    """ Unprovision in this process when no agent is running """
+    with span('imports', 'startup'):
+        from contrail_lib import rpc_client_shared
+        from daemon_ops import DaemonOperations
+        from instance_provisioner import Provisioner
+        from lxc_manager import LxcManager
+        from metrics import sinks_configure
+        from port_journal import PortJournal
+
+    sinks_configure(arguments.metrics_dir, arguments.metrics_log)
+    provisioner = Provisioner(api_server=arguments.api_server,
+                              api_port=arguments.api_port,
+                              share_ttl=arguments.api_share_ttl,
+                              api_rate=arguments.api_rate)
+    with rpc_client_shared() as client:
+        operations = DaemonOperations(
+            provisioner, LxcManager(backend=arguments.netns_backend),
+            client, DaemonStateStore(arguments.state_dir),
+            workers=arguments.workers,
+            journal=PortJournal(os.path.join(arguments.state_dir, 'ports')))
+        results = operations.stop(daemons, **options)
+    logging.debug('API statistics: %s', provisioner.api_stats())
+    return results
 
 
 def daemon_stop():
+    started = time.time()
     parser = argparse.ArgumentParser()
     defaults = {
         'api-server': '127.0.0.1',
@@ -20,27 +51,80 @@ def daemon_stop():
     parser.set_defaults(**defaults)
     parser.add_argument("-s", "--api-server", help="API server address")
     parser.add_argument("-p", "--api-port", type=int, help="API server port")
-    parser.add_argument("daemon", help="Deamon Name")
-    arguments = parser.parse_args(sys.argv)
-
-    manager = LxcManager()
-    provisioner = Provisioner(api_server=arguments.api_server,
-                              api_port=arguments.api_port)
-    instance_name = '%s-%s' % (socket.gethostname(), arguments.daemon)
-    vm = provisioner.virtual_machine_lookup(instance_name)
+    parser.add_argument("--netns-backend", default='auto',
+                        choices=['auto', 'netlink', 'shell'],
+                        help="Kernel interface used to manage namespaces")
+    parser.add_argument("-m", "--manifest",
+                        help="File listing one daemon per line")
+    parser.add_argument("-w", "--workers", type=int, default=8,
+                        help="Daemons stopped concurrently in batch mode")
+    parser.add_argument("--api-share-ttl", type=float, default=2,
+                        help="Seconds during which API server replies are"
+                        " shared with the other processes of the host"
+                        " (0 disables)")
+    parser.add_argument("--api-rate", type=float, default=50,
+                        help="Maximum API server writes per second for the"
+                        " host (0 for no limit)")
+    parser.add_argument("--state-dir", default=STATE_DIR,
+                        help="Directory holding the per daemon checkpoints")
+    parser.add_argument("--pipeline", action='store_true',
+                        help="Overlap API server and kernel operations")
+    parser.add_argument("--bulk", action='store_true',
+                        help="Tear the daemons down together: one namespace"
+                        " deletion per daemon and concurrent API deletions")
+    parser.add_argument("--agent-socket", default=AGENT_SOCKET,
+                        help="Control socket of the netns agent")
+    parser.add_argument("--no-agent", action='store_true',
+                        help="Unprovision in this process even if the netns"
+                        " agent is running")
+    parser.add_argument("--metrics-dir",
+                        help="node-exporter textfile directory receiving the"
+                        " phase timings and call counts of each daemon")
+    parser.add_argument("--metrics-log",
+                        help="File receiving one JSON line per daemon run")
+    parser.add_argument("--trace",
+                        help="Write a Chrome trace event timeline of the run"
+                        " to this file")
+    parser.add_argument("--profile",
+                        help="Write cProfile statistics of the main thread"
+                        " to this file")
+    parser.add_argument("daemon", nargs='*', help="Deamon Name")
+    arguments = parser.parse_args(sys.argv[1:])
+    if arguments.profile:
+        profile_start(arguments.profile)
+    if arguments.trace:
+        trace_start(arguments.trace)
+        span_add('parse_arguments', 'startup', started)
 
-    vmi_list = vm.get_virtual_machine_interfaces()
-    for ref in vmi_list:
-        uuid = ref['uuid']
-        interface_unregister(uuid)
+    daemons = list(arguments.daemon)
+    if arguments.manifest:
+        daemons.extend([entry[0]
+                        for entry in manifest_read(arguments.manifest)])
+    if not daemons:
+        parser.error('no daemon specified')
 
-    manager.clear_interfaces(arguments.daemon)
+    options = {'pipeline': arguments.pipeline, 'bulk': arguments.bulk}
+    # the agent applies its own configuration: run in-process when this
+    # invocation sets any
+    local = arguments.no_agent or options_given(parser, sys.argv[1:],
+                                                AGENT_CONFIG_OPTIONS)
+    results = None
+    if not local:
+        with span('agent_request', 'agent'):
+            results = agent_request(arguments.agent_socket, 'stop',
+                                    daemons, options)
+    if results is None:
+        results = _local_stop(arguments, daemons, options)
 
-    for ref in vmi_list:
-        provisioner.vmi_delete(ref['uuid'])
+    if len(daemons) == 1 and not arguments.manifest:
+        error = results[0][2]
+        if error is not None:
+            sys.stderr.write(error)
+            sys.exit(1)
+        return
 
-    provisioner.virtual_machine_delete(vm)
-    manager.namespace_delete(arguments.daemon)
+    if batch_report(results):
+        sys.exit(1)
 
 # end daemon_stop
 
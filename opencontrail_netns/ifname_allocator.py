@@ -0,0 +1,121 @@
+"""
+Host wide allocation of the master veth interface names (instanceN).
+"""
+
+import contextlib
+import errno
+import fcntl
+import os
+
+from daemon_state import STATE_DIR
+
+
+@contextlib.contextmanager
+def host_lock(filename):
+    """ Exclusive lock shared by all the processes and threads of a host """
+    _makedirs(os.path.dirname(filename))
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield fd
+    finally:
+        os.close(fd)
+
+
+def _makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+
+
+class InterfaceNameAllocator(object):
+    """
+    Names are tracked in an on-disk bitmap, one bit per index, updated
+    under an flock of the bitmap file. The lowest free index is found
+    without listing the host interfaces; the exists callback is only used
+    to skip names held by interfaces created outside of the allocator.
+    """
+    def __init__(self, filename=os.path.join(STATE_DIR, 'interfaces.bitmap'),
+                 prefix='instance', size=16384, exists=None):
+        self._filename = filename
+        self._prefix = prefix
+        self._size = size
+        self._exists = exists or (lambda name: False)
+
+    @contextlib.contextmanager
+    def _bitmap(self):
+        with host_lock(self._filename) as fd:
+            fp = os.fdopen(os.dup(fd), 'r+b')
+            try:
+                bitmap = bytearray(fp.read())
+                length = len(bitmap)
+                nbytes = (self._size + 7) / 8
+                bitmap.extend('\0' * (nbytes - length))
+                yield bitmap
+                fp.seek(0)
+                fp.write(bitmap)
+                fp.flush()
+            finally:
+                fp.close()
+
+    def _index(self, ifname):
+        if not ifname or not ifname.startswith(self._prefix):
+            return None
+        try:
+            index = int(ifname[len(self._prefix):])
+        except ValueError:
+            return None
+        if index >= self._size:
+            return None
+        return index
+
+    def owns(self, ifname):
+        """ Whether ifname belongs to the name space of the allocator """
+        return self._index(ifname) is not None
+
+    def allocate(self):
+        """ Return the lowest free name or None when the space is full """
+        with self._bitmap() as bitmap:
+            while True:
+                offset = len(bitmap) - len(bitmap.lstrip('\xff'))
+                if offset == len(bitmap):
+                    return None
+                byte = bitmap[offset]
+                bit = 0
+                while byte & (1 << bit):
+                    bit += 1
+                index = offset * 8 + bit
+                if index >= self._size:
+                    return None
+                bitmap[offset] |= 1 << bit
+                ifname = '%s%d' % (self._prefix, index)
+                if not self._exists(ifname):
+                    return ifname
+
+    def release(self, ifname):
+        index = self._index(ifname)
+        if index is None:
+            return
+        with self._bitmap() as bitmap:
+            bitmap[index / 8] &= ~(1 << (index % 8)) & 0xff
+
+    def release_unused(self, dry_run=False):
+        """
+        Release the allocated names held by no interface, according to
+        the exists callback. Returns these names.
+        """
+        unused = []
+        with self._bitmap() as bitmap:
+            for offset, byte in enumerate(bitmap):
+                for bit in range(8):
+                    if not byte & (1 << bit):
+                        continue
+                    ifname = '%s%d' % (self._prefix, offset * 8 + bit)
+                    if self._exists(ifname):
+                        continue
+                    unused.append(ifname)
+                    if not dry_run:
+                        bitmap[offset] &= ~(1 << bit) & 0xff
+        return unused
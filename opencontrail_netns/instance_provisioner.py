@@ -3,18 +3,54 @@
 
 from vnc_api.vnc_api import *
 
+from api_counters import counters_attach
+from api_share import requests_share
+from config_cache import ConfigCache
+
+# fields requested when reading objects; back references and children
+# of networks in particular can be very large
+VM_FIELDS = ['virtual_machine_interfaces']
+VMI_FIELDS = ['virtual_machine_interface_mac_addresses',
+              'virtual_network_refs', 'instance_ip_back_refs']
+VN_FIELDS = ['network_ipam_refs', 'virtual_network_properties']
+
 
 class Provisioner(object):
     def __init__(self, api_server='127.0.0.1', api_port=8082,
-                 project='default-domain:default-project'):
-        self._client = VncApi(api_server_host=api_server,
-                              api_server_port=api_port)
+                 project='default-domain:default-project',
+                 cache_ttl=300, cache_size=1024, cache_file=None,
+                 share_ttl=2, api_rate=50, client=None):
+        shared = client is None
+        if client is None:
+            client = VncApi(api_server_host=api_server,
+                            api_server_port=api_port)
+        self._client = client
+        self.api_counters = counters_attach(client)
+        if shared:
+            # outside the counters: these count the requests actually sent
+            requests_share(client, ttl=share_ttl, rate=api_rate)
         self._project = project
+        # virtual-network objects, keyed by fq_name string and uuid
+        self._object_cache = ConfigCache(maxsize=cache_size, ttl=cache_ttl)
+        # fq_name -> uuid resolutions and subnet information; these can
+        # be shared between invocations through cache_file
+        self._ref_cache = ConfigCache(maxsize=cache_size, ttl=cache_ttl,
+                                      filename=cache_file)
+
+    def cache_stats(self):
+        return {
+            'objects': self._object_cache.stats(),
+            'refs': self._ref_cache.stats(),
+        }
+
+    def api_stats(self):
+        return self.api_counters.stats()
 
     def virtual_machine_lookup(self, vm_name):
         fq_name = [vm_name]
         try:
-            vm_instance = self._client.virtual_machine_read(fq_name=fq_name)
+            vm_instance = self._client.virtual_machine_read(
+                fq_name=fq_name, fields=VM_FIELDS)
             return vm_instance
         except NoIdError:
             pass
@@ -25,7 +61,8 @@ class Provisioner(object):
         #    vm_name = self._project + ':' + vm_name
         fq_name = vm_name.split(':')
         try:
-            vm_instance = self._client.virtual_machine_read(fq_name=fq_name)
+            vm_instance = self._client.virtual_machine_read(
+                fq_name=fq_name, fields=VM_FIELDS)
             return vm_instance
         except NoIdError:
             pass
@@ -37,21 +74,73 @@ class Provisioner(object):
     def virtual_machine_delete(self, vm_instance):
         self._client.virtual_machine_delete(id=vm_instance.uuid)
 
+    def _virtual_network_cache(self, network_name, vnet):
+        self._object_cache.put(network_name, vnet)
+        self._object_cache.put(vnet.uuid, vnet)
+        self._ref_cache.put('virtual-network:' + network_name, vnet.uuid)
+
     def _virtual_network_lookup(self, network_name):
-        fq_name = network_name.split(':')
+        vnet = self._object_cache.get(network_name)
+        if vnet is not None:
+            return vnet
+
+        key = 'virtual-network:' + network_name
+        uuid = self._ref_cache.get(key)
         try:
-            vnet = self._client.virtual_network_read(fq_name=fq_name)
+            if uuid:
+                vnet = self._client.virtual_network_read(id=uuid,
+                                                         fields=VN_FIELDS)
+            else:
+                fq_name = network_name.split(':')
+                vnet = self._client.virtual_network_read(fq_name=fq_name,
+                                                         fields=VN_FIELDS)
         except NoIdError:
+            if uuid:
+                # stale resolution: the network has been re-created
+                self._ref_cache.invalidate(key)
+                return self._virtual_network_lookup(network_name)
             return None
 
+        self._virtual_network_cache(network_name, vnet)
         return vnet
 
+    def _virtual_network_subnet(self, vn_uuid):
+        """
+        Return the first subnet of a virtual network as a dictionary with
+        the ip_prefix, ip_prefix_len, default_gateway and
+        dns_server_address keys, along with the mtu of the network.
+        """
+        key = 'subnet:' + vn_uuid
+        subnet = self._ref_cache.get(key)
+        if subnet is not None:
+            return subnet
+
+        vnet = self._object_cache.get(vn_uuid)
+        if vnet is None:
+            vnet = self._client.virtual_network_read(id=vn_uuid,
+                                                     fields=VN_FIELDS)
+            self._virtual_network_cache(':'.join(vnet.fq_name), vnet)
+        ipam_r = vnet.get_network_ipam_refs()
+        ipam_subnet = ipam_r[0]['attr'].ipam_subnets[0]
+        subnet = {
+            'ip_prefix': ipam_subnet.subnet.ip_prefix,
+            'ip_prefix_len': ipam_subnet.subnet.ip_prefix_len,
+            'default_gateway': getattr(ipam_subnet, 'default_gateway', None),
+            'dns_server_address': getattr(ipam_subnet, 'dns_server_address',
+                                          None),
+            'mtu': getattr(vnet.get_virtual_network_properties(), 'mtu',
+                           None),
+        }
+        self._ref_cache.put(key, subnet)
+        return subnet
+
     def vmi_locate(self, vm_instance, network, name, advertise_default=True):
         fq_name = vm_instance.fq_name[:]
         fq_name.append(name)
         create = False
         try:
-            vmi = self._client.virtual_machine_interface_read(fq_name=fq_name)
+            vmi = self._client.virtual_machine_interface_read(
+                fq_name=fq_name, fields=VMI_FIELDS)
         except NoIdError:
             vmi = VirtualMachineInterface(parent_type='virtual-machine',
                                           fq_name=fq_name)
@@ -61,53 +150,137 @@ class Provisioner(object):
         if not vnet:
             sys.exit(1)
 
-        vmi.set_virtual_network(vnet)
+        refs = vmi.get_virtual_network_refs() or []
         if create:
+            vmi.set_virtual_network(vnet)
             self._client.virtual_machine_interface_create(vmi)
-            vmi = self._client.virtual_machine_interface_read(id=vmi.uuid)
-        else:
+        elif [ref['uuid'] for ref in refs] != [vnet.uuid]:
+            vmi.set_virtual_network(vnet)
             self._client.virtual_machine_interface_update(vmi)
 
-        ips = vmi.get_instance_ip_back_refs()
-        if ips and len(ips):
-            uuid = ips[0]['uuid']
-        else:
+        if create or not vmi.get_instance_ip_back_refs():
             ip = InstanceIp(vm_instance.name + '.' + name)
             ip.set_virtual_machine_interface(vmi)
             ip.set_virtual_network(vnet)
-            uuid = self._client.instance_ip_create(ip)
+            self._client.instance_ip_create(ip)
+            # the mac address and the instance-ip back reference are
+            # filled in by the API server
+            vmi = self._client.virtual_machine_interface_read(
+                id=vmi.uuid, fields=VMI_FIELDS)
 
-        ip = self._client.instance_ip_read(id=uuid)
-
-        # print "IP address: %s" % ip.get_instance_ip_address()
         return vmi
 
     def vmi_delete(self, uuid):
         try:
-            vmi = self._client.virtual_machine_interface_read(id=uuid)
+            vmi = self._client.virtual_machine_interface_read(
+                id=uuid, fields=['instance_ip_back_refs'])
         except NoIdError:
             return
 
-        ips = vmi.get_instance_ip_back_refs()
+        ips = vmi.get_instance_ip_back_refs() or []
         for ref in ips:
             self._client.instance_ip_delete(id=ref['uuid'])
 
         self._client.virtual_machine_interface_delete(id=vmi.uuid)
 
-    def _get_vmi_prefixlen(self, vmi):
+    def vmi_mac_addresses(self, uuids, chunk=100):
+        """
+        Return the mac address of the given virtual-machine-interfaces,
+        keyed by uuid, using one list request per chunk of uuids.
+        Interfaces that no longer exist are absent from the result.
+        """
+        uuids = list(uuids)
+        result = {}
+        for start in range(0, len(uuids), chunk):
+            vmis = self._client.virtual_machine_interfaces_list(
+                obj_uuids=uuids[start:start + chunk], detail=True,
+                fields=['virtual_machine_interface_mac_addresses'])
+            for vmi in vmis:
+                macs = vmi.get_virtual_machine_interface_mac_addresses()
+                if macs and macs.mac_address:
+                    result[vmi.uuid] = macs.mac_address[0]
+                else:
+                    result[vmi.uuid] = None
+        return result
+
+    def instance_ips_by_vmi(self, vmi_uuids, chunk=100):
+        """
+        Return the uuids of the instance-ips of the given interfaces, as
+        a dictionary keyed by interface uuid.
+        """
+        vmi_uuids = list(vmi_uuids)
+        result = dict((uuid, []) for uuid in vmi_uuids)
+        for start in range(0, len(vmi_uuids), chunk):
+            ips = self._client.instance_ips_list(
+                back_ref_id=vmi_uuids[start:start + chunk], detail=True,
+                fields=['virtual_machine_interface_refs'])
+            for ip in ips:
+                for ref in ip.get_virtual_machine_interface_refs() or []:
+                    if ref['uuid'] in result:
+                        result[ref['uuid']].append(ip.uuid)
+        return result
+
+    def virtual_machines_named(self, names, chunk=100):
+        """
+        Return the virtual-machines whose name is one of names, with
+        their interfaces and id_perms: one list request for the names,
+        then one detail list request per chunk of matching uuids.
+        """
+        names = set(names)
+        result = self._client.virtual_machines_list()
+        uuids = [item['uuid'] for item in result['virtual-machines']
+                 if item['fq_name'][-1] in names]
+        vms = []
+        for start in range(0, len(uuids), chunk):
+            vms.extend(self._client.virtual_machines_list(
+                obj_uuids=uuids[start:start + chunk], detail=True,
+                fields=['virtual_machine_interfaces', 'id_perms']))
+        return vms
+
+    def object_delete(self, obj_type, uuid):
+        """ Delete an object by uuid; a missing object is not an error """
+        try:
+            getattr(self._client, obj_type + '_delete')(id=uuid)
+        except NoIdError:
+            pass
+
+    def _get_vmi_subnet(self, vmi):
         refs = vmi.get_virtual_network_refs()
         if len(refs) == 0:
             sys.exit(1)
 
-        vnet = self._client.virtual_network_read(id=refs[0]['uuid'])
-        ipam_r = vnet.get_network_ipam_refs()
-        return ipam_r[0]['attr'].ipam_subnets[0].subnet.ip_prefix_len
+        return self._virtual_network_subnet(refs[0]['uuid'])
+
+    def _get_vmi_prefixlen(self, vmi):
+        return self._get_vmi_subnet(vmi)['ip_prefix_len']
 
     def get_interface_ip_prefix(self, vmi):
         ips = vmi.get_instance_ip_back_refs()
-        if len(ips) == 0:
+        if not ips:
             return None
-        ip_obj = self._client.instance_ip_read(id=ips[0]['uuid'])
+        ip_obj = self._client.instance_ip_read(id=ips[0]['uuid'],
+                                               fields=['instance_ip_address'])
         ip_addr = ip_obj.get_instance_ip_address()
         ip_prefixlen = self._get_vmi_prefixlen(vmi)
         return (ip_addr, ip_prefixlen)
+
+    def get_interface_mtu(self, vmi):
+        """ Return the MTU set by the network of an interface, or None """
+        return self._get_vmi_subnet(vmi).get('mtu')
+
+    def get_interface_ip_config(self, vmi):
+        """
+        Return the information required to configure an interface without
+        DHCP: a dictionary with the ip_prefix (address, prefix length),
+        gateway and dns_servers keys.
+        """
+        ip_prefix = self.get_interface_ip_prefix(vmi)
+        if ip_prefix is None:
+            return None
+        subnet = self._get_vmi_subnet(vmi)
+        dns_server = subnet.get('dns_server_address')
+        return {
+            'ip_prefix': ip_prefix,
+            'gateway': subnet.get('default_gateway'),
+            'dns_servers': [dns_server] if dns_server else [],
+        }
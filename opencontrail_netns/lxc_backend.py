@@ -0,0 +1,556 @@
+"""
+Kernel backends used by LxcManager.
+
+ShellBackend forks the iproute2/ethtool command line tools; it is the
+original implementation and works anywhere those tools are installed.
+NetlinkBackend performs the same operations over rtnetlink sockets and
+setns() from within the running process (requires pyroute2).
+
+Both wait for an interface to become ready on link and address events,
+from rtnetlink multicast groups or from ip monitor, rather than by
+polling.
+"""
+
+import contextlib
+import ctypes
+import ctypes.util
+import os
+import re
+import select
+import subprocess
+import threading
+import time
+
+import metrics
+import tracing
+
+try:
+    from pyroute2 import IPRoute, NetlinkError
+    from pyroute2 import netns as pyroute2_netns
+    from pyroute2.netlink.rtnl import RTMGRP_IPV4_IFADDR, RTMGRP_LINK
+    from pyroute2.netlink.rtnl import RTMGRP_IPV6_IFADDR
+except ImportError:
+    IPRoute = None
+    NetlinkError = OSError
+    pyroute2_netns = None
+
+# exceptions raised by a backend when an operation fails
+BACKEND_ERRORS = (OSError, IOError, subprocess.CalledProcessError,
+                  NetlinkError)
+
+
+def shell_command(str):
+    metrics.count(metrics.SUBPROCESS)
+    with tracing.span('shell_command', 'subprocess', command=str):
+        cmd = subprocess.check_output(str, shell=True)
+    return cmd
+
+
+IF_NAMESIZE = 16
+
+IFF_UP = 0x1
+IFF_LOWER_UP = 0x10000
+
+# named network namespaces are bind mounts of their nsfs inode in there
+NETNS_RUN_DIR = '/var/run/netns'
+
+MS_BIND = 4096
+MNT_DETACH = 2
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+
+def if_indextoname(ifindex):
+    """ Resolve an interface index of the current namespace """
+    buf = ctypes.create_string_buffer(IF_NAMESIZE)
+    if not _libc.if_indextoname(ifindex, buf):
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return buf.value
+
+
+def _libc_check(result):
+    if result != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+def namespace_rename(netns, name):
+    """
+    Rename a named namespace: bind mount it under the new name, then
+    detach the old mount point. A mount point cannot be rename()d.
+    """
+    source = os.path.join(NETNS_RUN_DIR, netns)
+    target = os.path.join(NETNS_RUN_DIR, name)
+    fd = os.open(target, os.O_RDONLY | os.O_CREAT | os.O_EXCL, 0444)
+    os.close(fd)
+    try:
+        _libc_check(_libc.mount(source, target, None, MS_BIND, None))
+    except OSError:
+        os.unlink(target)
+        raise
+    _libc_check(_libc.umount2(source, MNT_DETACH))
+    os.unlink(source)
+
+
+def namespaces_in_use():
+    """
+    Return the (st_dev, st_ino) of the network namespaces processes run
+    in, from a single scan of /proc.
+    """
+    inodes = set()
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            st = os.stat('/proc/%s/ns/net' % pid)
+        except OSError:
+            continue
+        inodes.add((st.st_dev, st.st_ino))
+    return inodes
+
+
+def _proc_write(path, value):
+    with open(path, 'w') as fp:
+        fp.write('%s\n' % value)
+
+
+class ShellBackend(object):
+    """ Fork iproute2 commands for every operation """
+    name = 'shell'
+
+    def _netns_prefix(self, netns):
+        if netns is None:
+            return ''
+        return 'ip netns exec %s ' % netns
+
+    def namespace_list(self):
+        output = shell_command('ip netns list')
+        return output.split()
+
+    def namespace_add(self, netns):
+        shell_command('ip netns add %s' % netns)
+
+    def namespace_delete(self, netns):
+        shell_command('ip netns delete %s' % netns)
+
+    def namespace_rename(self, netns, name):
+        source = os.path.join(NETNS_RUN_DIR, netns)
+        target = os.path.join(NETNS_RUN_DIR, name)
+        shell_command('touch %s && mount --bind %s %s && umount -l %s && '
+                      'rm %s' % (target, source, target, source, source))
+
+    def link_list(self, netns=None):
+        """ Return a list of (ifindex, ifname) tuples """
+        output = shell_command(self._netns_prefix(netns) + 'ip link list')
+        links = []
+        for line in output.split('\n'):
+            m = re.match(r'^([\d]+): ([^:@\s]+)[:@]', line)
+            if m:
+                links.append((int(m.group(1)), m.group(2)))
+        return links
+
+    def link_describe(self, netns=None):
+        """
+        Return a list of dictionaries with the index, name, address,
+        peer_ifindex (or None) and peer_local of every interface.
+        peer_local is set when the peer is in the same namespace.
+        """
+        output = shell_command(self._netns_prefix(netns) + 'ip -o link list')
+        links = []
+        for line in output.split('\n'):
+            m = re.match(r'^([\d]+): ([^:@\s]+)(@if(\d+)|@([^:]+))?:', line)
+            if not m:
+                continue
+            address = re.search(r'link/\w+ ([\da-f:]+)', line)
+            links.append({
+                'index': int(m.group(1)),
+                'name': m.group(2),
+                'address': address.group(1) if address else None,
+                'peer_ifindex': int(m.group(4)) if m.group(4) else None,
+                'peer_local': m.group(5),
+            })
+        # a peer in the same namespace is shown by name
+        indexes = dict((link['name'], link['index']) for link in links)
+        for link in links:
+            if link['peer_local']:
+                link['peer_ifindex'] = indexes.get(link['peer_local'])
+            link['peer_local'] = bool(link['peer_local'])
+        return links
+
+    def link_name(self, ifindex, netns=None):
+        if netns is None:
+            try:
+                return if_indextoname(ifindex)
+            except OSError:
+                return None
+        for index, ifname in self.link_list(netns):
+            if index == ifindex:
+                return ifname
+        return None
+
+    def link_index(self, ifname, netns=None):
+        output = shell_command(self._netns_prefix(netns) +
+                               'cat /sys/class/net/%s/ifindex' % ifname)
+        return int(output)
+
+    def link_address(self, ifname, netns=None):
+        output = shell_command(self._netns_prefix(netns) +
+                               'cat /sys/class/net/%s/address' % ifname)
+        return output.strip()
+
+    def link_peer_ifindex(self, ifname, netns=None):
+        output = shell_command(self._netns_prefix(netns) +
+                               'cat /sys/class/net/%s/iflink' % ifname)
+        return int(output)
+
+    def veth_create(self, ifname, peer, queues=None):
+        """ queues: number of TX and RX queues of both ends """
+        options = ''
+        if queues:
+            options = ' numtxqueues %d numrxqueues %d' % (queues, queues)
+        shell_command('ip link add %s%s type veth peer name %s%s' %
+                      (ifname, options, peer, options))
+
+    def link_set_netns(self, ifname, netns):
+        shell_command('ip link set %s netns %s' % (ifname, netns))
+
+    def link_set_up(self, ifname, netns=None):
+        shell_command(self._netns_prefix(netns) +
+                      'ip link set %s up' % ifname)
+
+    def link_set_mac(self, ifname, mac, netns=None):
+        shell_command(self._netns_prefix(netns) +
+                      'ifconfig %s hw ether %s' % (ifname, mac))
+
+    def link_set_params(self, ifname, netns=None, mtu=None,
+                        txqueuelen=None):
+        params = ''
+        if mtu is not None:
+            params += ' mtu %d' % mtu
+        if txqueuelen is not None:
+            params += ' txqueuelen %d' % txqueuelen
+        if params:
+            shell_command(self._netns_prefix(netns) +
+                          'ip link set %s%s' % (ifname, params))
+
+    def link_set_offloads(self, ifname, offloads, netns=None):
+        """ offloads: dictionary of ethtool feature to 'on' or 'off' """
+        shell_command(self._netns_prefix(netns) + 'ethtool -K %s %s' %
+                      (ifname, ' '.join('%s %s' % item
+                                        for item in sorted(offloads.items()))))
+
+    def link_delete(self, ifname, netns=None):
+        shell_command(self._netns_prefix(netns) +
+                      'ip link delete %s' % ifname)
+
+    def addr_replace(self, ifname, address, prefixlen, netns=None):
+        shell_command(self._netns_prefix(netns) +
+                      'ip addr replace %s/%d dev %s' %
+                      (address, prefixlen, ifname))
+
+    def route_replace_default(self, ifname, gateway, netns=None):
+        shell_command(self._netns_prefix(netns) +
+                      'ip route replace default via %s dev %s' %
+                      (gateway, ifname))
+
+    def sysctl_set(self, key, value, netns=None):
+        shell_command(self._netns_prefix(netns) +
+                      'sh -c "echo %s >/proc/sys/%s"' % (value, key))
+
+    def execute(self, command, netns=None):
+        return shell_command(self._netns_prefix(netns) + command)
+
+    def _link_ready(self, ifname, netns, address):
+        output = shell_command(self._netns_prefix(netns) +
+                               'sh -c "cat /sys/class/net/%s/operstate;'
+                               ' ip -o addr show dev %s"' % (ifname, ifname))
+        lines = output.split('\n')
+        return lines[0].strip() == 'up' and (
+            address is None or
+            re.search(r'\sinet6? %s/' % re.escape(address), output))
+
+    def link_wait(self, ifname, timeout, netns=None, address=None):
+        """
+        Wait until ifname is operationally up (for a veth, its peer is up
+        too) and, if given, address is assigned to it. The state is read
+        once; ip monitor is only started when it is not ready yet, and the
+        state is read again on the events of ifname. Returns False after
+        timeout seconds.
+        """
+        if self._link_ready(ifname, netns, address):
+            return True
+        if timeout <= 0:
+            return False
+        deadline = time.time() + timeout
+        metrics.count(metrics.SUBPROCESS)
+        monitor = subprocess.Popen('exec %sip monitor link address' %
+                                   self._netns_prefix(netns), shell=True,
+                                   stdout=subprocess.PIPE)
+        try:
+            # the state may have changed before the monitor started
+            if self._link_ready(ifname, netns, address):
+                return True
+            pattern = re.compile(r'^(Deleted )?\d+: %s[@:\s]' %
+                                 re.escape(ifname), re.M)
+            fd = monitor.stdout.fileno()
+            while True:
+                remaining = deadline - time.time()
+                if (remaining <= 0 or
+                        not select.select([fd], [], [], remaining)[0]):
+                    return False
+                events = os.read(fd, 65536)
+                if not events:
+                    return False
+                if (pattern.search(events) and
+                        self._link_ready(ifname, netns, address)):
+                    return True
+        finally:
+            monitor.kill()
+            monitor.wait()
+
+
+def _link_up(msg):
+    """ Whether an RTM_NEWLINK message shows an operational link """
+    flags = msg['flags']
+    return bool(flags & IFF_UP and flags & IFF_LOWER_UP)
+
+
+class NetlinkBackend(object):
+    """
+    Use rtnetlink sockets for link and address management.
+    Sockets for a namespace are opened after a per-thread setns() and
+    kept while /var/run/netns/<name> refers to the same namespace (nsfs
+    inode), so that a namespace deleted and created again by another
+    process gets a new socket.
+    """
+    name = 'netlink'
+
+    def __init__(self):
+        if IPRoute is None:
+            raise ImportError('pyroute2 is required by the netlink backend')
+        self._ipr = IPRoute()
+        self._sockets = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _netns_context(self, netns):
+        """ Switch the calling thread into netns """
+        saved = os.open('/proc/thread-self/ns/net', os.O_RDONLY)
+        try:
+            pyroute2_netns.setns(netns, flags=0)
+            try:
+                yield
+            finally:
+                pyroute2_netns.setns(saved)
+        finally:
+            os.close(saved)
+
+    def _socket(self, netns):
+        if netns is None:
+            return self._ipr
+        st = os.stat(os.path.join(NETNS_RUN_DIR, netns))
+        ident = (st.st_dev, st.st_ino)
+        stale = None
+        with self._lock:
+            cached = self._sockets.get(netns)
+            if cached is not None and cached[0] != ident:
+                stale = cached[1]
+                cached = None
+            if cached is None:
+                with self._netns_context(netns):
+                    cached = (ident, IPRoute())
+                self._sockets[netns] = cached
+        if stale is not None:
+            stale.close()
+        return cached[1]
+
+    def _socket_close(self, netns):
+        with self._lock:
+            cached = self._sockets.pop(netns, None)
+        if cached is not None:
+            cached[1].close()
+
+    def link_index(self, ifname, netns=None):
+        indices = self._socket(netns).link_lookup(ifname=ifname)
+        if not indices:
+            raise OSError('Interface %s not found' % ifname)
+        return indices[0]
+
+    def namespace_list(self):
+        return pyroute2_netns.listnetns()
+
+    def namespace_add(self, netns):
+        pyroute2_netns.create(netns)
+
+    def namespace_delete(self, netns):
+        self._socket_close(netns)
+        pyroute2_netns.remove(netns)
+
+    def namespace_rename(self, netns, name):
+        namespace_rename(netns, name)
+        # the sockets belong to the namespace, not to its name
+        with self._lock:
+            cached = self._sockets.pop(netns, None)
+            if cached is not None:
+                self._sockets[name] = cached
+
+    def link_list(self, netns=None):
+        return [(msg['index'], msg.get_attr('IFLA_IFNAME'))
+                for msg in self._socket(netns).get_links()]
+
+    def link_describe(self, netns=None):
+        links = []
+        for msg in self._socket(netns).get_links():
+            peer = msg.get_attr('IFLA_LINK')
+            links.append({
+                'index': msg['index'],
+                'name': msg.get_attr('IFLA_IFNAME'),
+                'address': msg.get_attr('IFLA_ADDRESS'),
+                'peer_ifindex': peer,
+                'peer_local': (peer not in (None, 0, msg['index']) and
+                               msg.get_attr('IFLA_LINK_NETNSID') is None),
+            })
+        return links
+
+    def link_name(self, ifindex, netns=None):
+        links = self._socket(netns).get_links(ifindex)
+        if not links:
+            return None
+        return links[0].get_attr('IFLA_IFNAME')
+
+    def link_address(self, ifname, netns=None):
+        ipr = self._socket(netns)
+        links = ipr.get_links(self.link_index(ifname, netns))
+        return links[0].get_attr('IFLA_ADDRESS')
+
+    def link_peer_ifindex(self, ifname, netns=None):
+        ipr = self._socket(netns)
+        links = ipr.get_links(self.link_index(ifname, netns))
+        return links[0].get_attr('IFLA_LINK')
+
+    def veth_create(self, ifname, peer, queues=None):
+        """ queues: number of TX and RX queues of both ends """
+        if not queues:
+            self._ipr.link('add', ifname=ifname, kind='veth', peer=peer)
+            return
+        self._ipr.link('add', ifname=ifname, kind='veth',
+                       num_tx_queues=queues, num_rx_queues=queues,
+                       peer={'ifname': peer, 'num_tx_queues': queues,
+                             'num_rx_queues': queues})
+
+    def link_set_netns(self, ifname, netns):
+        self._ipr.link('set', index=self.link_index(ifname),
+                       net_ns_fd=netns)
+
+    def link_set_up(self, ifname, netns=None):
+        self._socket(netns).link('set', index=self.link_index(ifname, netns),
+                                 state='up')
+
+    def link_set_mac(self, ifname, mac, netns=None):
+        self._socket(netns).link('set', index=self.link_index(ifname, netns),
+                                 address=mac)
+
+    def link_set_params(self, ifname, netns=None, mtu=None,
+                        txqueuelen=None):
+        params = {}
+        if mtu is not None:
+            params['mtu'] = mtu
+        if txqueuelen is not None:
+            params['txqlen'] = txqueuelen
+        if params:
+            self._socket(netns).link(
+                'set', index=self.link_index(ifname, netns), **params)
+
+    def link_set_offloads(self, ifname, offloads, netns=None):
+        """
+        offloads: dictionary of ethtool feature to 'on' or 'off'. Features
+        are not exposed over rtnetlink: ethtool is forked.
+        """
+        self.execute('ethtool -K %s %s' %
+                     (ifname, ' '.join('%s %s' % item
+                                       for item in sorted(offloads.items()))),
+                     netns=netns)
+
+    def link_delete(self, ifname, netns=None):
+        self._socket(netns).link('del', index=self.link_index(ifname, netns))
+
+    def addr_replace(self, ifname, address, prefixlen, netns=None):
+        self._socket(netns).addr('replace',
+                                 index=self.link_index(ifname, netns),
+                                 address=address, mask=prefixlen)
+
+    def route_replace_default(self, ifname, gateway, netns=None):
+        self._socket(netns).route('replace', dst='0.0.0.0/0',
+                                  gateway=gateway,
+                                  oif=self.link_index(ifname, netns))
+
+    def sysctl_set(self, key, value, netns=None):
+        path = os.path.join('/proc/sys', key)
+        if netns is None:
+            _proc_write(path, value)
+            return
+        with self._netns_context(netns):
+            _proc_write(path, value)
+
+    def execute(self, command, netns=None):
+        if netns is not None:
+            command = 'ip netns exec %s %s' % (netns, command)
+        return shell_command(command)
+
+    def link_wait(self, ifname, timeout, netns=None, address=None):
+        """
+        Wait until ifname is operationally up (for a veth, its peer is up
+        too) and, if given, address is assigned to it. The link and
+        address groups are subscribed to before the state is read, so
+        that no change is missed. Returns False after timeout seconds.
+        """
+        if netns is None:
+            monitor = IPRoute()
+        else:
+            with self._netns_context(netns):
+                monitor = IPRoute()
+        try:
+            monitor.bind(groups=RTMGRP_LINK | RTMGRP_IPV4_IFADDR |
+                         RTMGRP_IPV6_IFADDR)
+            ipr = self._socket(netns)
+            index = self.link_index(ifname, netns)
+            up = _link_up(ipr.get_links(index)[0])
+            assigned = (address is None or
+                        address in [msg.get_attr('IFA_ADDRESS')
+                                    for msg in ipr.get_addr(index=index)])
+            deadline = time.time() + timeout
+            while not (up and assigned):
+                remaining = deadline - time.time()
+                if (remaining <= 0 or
+                        not select.select([monitor], [], [], remaining)[0]):
+                    return False
+                for msg in monitor.get():
+                    if msg.get('index') != index:
+                        continue
+                    if msg['event'] == 'RTM_NEWLINK':
+                        up = _link_up(msg)
+                    elif (address is not None and
+                          msg.get_attr('IFA_ADDRESS') == address):
+                        assigned = (msg['event'] == 'RTM_NEWADDR')
+            return True
+        finally:
+            monitor.close()
+
+
+BACKENDS = {
+    ShellBackend.name: ShellBackend,
+    NetlinkBackend.name: NetlinkBackend,
+}
+
+
+def backend_create(name=None):
+    """
+    Instantiate a backend by name. When no name is given the netlink
+    backend is used if pyroute2 is available, the shell one otherwise.
+    """
+    if name is None or name == 'auto':
+        if IPRoute is not None:
+            return NetlinkBackend()
+        return ShellBackend()
+    return BACKENDS[name]()
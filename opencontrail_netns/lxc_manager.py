@@ -1,111 +1,387 @@
-import re
-import subprocess
+import errno
+import os
+import signal
 import sys
 
+from daemon_state import STATE_DIR
+from ifname_allocator import InterfaceNameAllocator, host_lock
+from lxc_backend import BACKEND_ERRORS, NETNS_RUN_DIR, backend_create
+from lxc_backend import namespaces_in_use
+from tuning import interface_mtu
 
-def shell_command(str):
-    cmd = subprocess.check_output(str, shell=True)
-    return cmd
+
+DHCP_TIMEOUT = 10
+
+# seconds to wait for an interface to be up with its address
+READY_TIMEOUT = 10
 
 
 class LxcManager(object):
-    def __init__(self):
-        pass
+    def __init__(self, backend=None, allocator=None,
+                 lock_file=os.path.join(STATE_DIR, 'veth.lock'),
+                 etc_dir='/etc/netns'):
+        """
+        backend: 'netlink', 'shell' or a backend instance. Defaults to
+        netlink when available.
+        allocator: InterfaceNameAllocator used for the master interfaces.
+        etc_dir: per namespace configuration files used by ip netns exec.
+        """
+        if backend is None or isinstance(backend, basestring):
+            backend = backend_create(backend)
+        self._backend = backend
+        if allocator is None:
+            allocator = InterfaceNameAllocator(
+                exists=lambda ifname: os.path.exists(
+                    os.path.join('/sys/class/net', ifname)))
+        self._allocator = allocator
+        self._lock_file = lock_file
+        self._etc_dir = etc_dir
+        # optional NamespacePool providing pre-created namespaces
+        self.pool = None
 
     def _interface_generate_unique_name(self):
-        output = shell_command('ip link list')
-        ids = {}
+        return self._allocator.allocate()
 
-        for line in output.split('\n'):
-            m = re.match(r'[\d]+: instance([\d]+)', line)
-            if m:
-                ids[m.group(1)] = True
+    def create_interface(self, daemon, ifname_instance, netns=None,
+                         queues=None):
+        # the instance side is created in the host namespace under a
+        # fixed name: serialize until it has been moved away. The master
+        # name is allocated under the lock too, so that a name without
+        # an interface is never in use outside of it.
+        with host_lock(self._lock_file):
+            ifname_master = self._interface_generate_unique_name()
+            try:
+                self._backend.veth_create(ifname_instance, ifname_master,
+                                          queues=queues)
+            except BACKEND_ERRORS:
+                self._allocator.release(ifname_master)
+                raise
+            self._backend.link_set_netns(ifname_instance,
+                                         netns or 'ns-%s' % daemon)
+        self._backend.link_set_up(ifname_master)
+        return ifname_master
 
-        for i in range(256):
-            if str(i) in ids:
+    def _describe_netns(self, netns):
+        interfaces = []
+        for link in self._backend.link_describe(netns=netns):
+            if link['name'] == 'lo':
                 continue
-            return 'instance%d' % i
-        return None
-
-    def create_interface(self, daemon, ifname_instance):
-        ifname_master = self._interface_generate_unique_name()
-        shell_command('ip link add %s type veth peer name %s' %
-                      (ifname_instance, ifname_master))
-        shell_command('ip link set %s netns ns-%s' % (ifname_instance, daemon))
-        shell_command('ip link set %s up' % ifname_master)
-        return ifname_master
+            peer = link['peer_ifindex']
+            if peer == link['index']:
+                peer = None
+            interfaces.append({
+                'name': link['name'],
+                'index': link['index'],
+                'address': link['address'],
+                'master': self._backend.link_name(peer) if peer else None,
+                'master_ifindex': peer,
+            })
+        return interfaces
+
+    def describe_interfaces(self, daemon):
+        """
+        Return the interfaces of the daemon namespace as dictionaries with
+        the name, index, address, master and master_ifindex keys. master
+        is the name of the host side of the veth pair, if any.
+        """
+        return self._describe_netns('ns-%s' % daemon)
+
+    def interface_prepare(self, daemon, ifname_instance, queues=None):
+        """
+        Make sure that the interface exists in the name space and return
+        the name of its master interface. queues is the number of queues
+        of a veth pair that has to be created.
+        """
+        for iface in self.describe_interfaces(daemon):
+            if iface['name'] == ifname_instance:
+                return iface['master']
+        return self.create_interface(daemon, ifname_instance, queues=queues)
 
-    def _interface_list_contains(self, output, iface):
-        for line in output.split('\n'):
-            m = re.match(r'[\d]+: ' + iface + ':', line)
-            if m:
-                return True
-        return False
-
-    def _get_master_ifname(self, daemon, ifname_instance):
-        output = shell_command('ip netns exec ns-%s ethtool -S %s' %
-                               (daemon, ifname_instance))
-        m = re.search(r'peer_ifindex: (\d+)', output)
-        ifindex = m.group(1)
-        output = shell_command('ip link list')
-        expr = '^' + ifindex + ': (\w+): '
-        regex = re.compile(expr, re.MULTILINE)
-        m = regex.search(output)
-        return m.group(1)
-
-    def interface_update(self, daemon, vmi, ifname_instance):
-        """
-        1. Make sure that the interface exists in the name space.
+    def interface_update(self, daemon, vmi, ifname_instance,
+                         ifname_master=None, tuning=None, network_mtu=None):
+        """
+        1. Make sure that the interface exists in the name space
+           (unless the master is already known from interface_prepare).
         2. Update the mac address.
+        3. Apply the tuning profile, if any (see interface_tune).
         """
-        output = shell_command('ip netns exec ns-%s ip link list' % daemon)
-        if not self._interface_list_contains(output, ifname_instance):
-            ifname_master = self.create_interface(daemon, ifname_instance)
-        else:
-            ifname_master = self._get_master_ifname(daemon, ifname_instance)
+        if ifname_master is None:
+            ifname_master = self.interface_prepare(
+                daemon, ifname_instance,
+                queues=tuning and tuning.get('queues'))
 
         mac = vmi.virtual_machine_interface_mac_addresses.mac_address[0]
-        shell_command('ip netns exec ns-%s ifconfig %s hw ether %s' %
-                      (daemon, ifname_instance, mac))
+        self._backend.link_set_mac(ifname_instance, mac,
+                                   netns='ns-%s' % daemon)
+        if tuning:
+            self.interface_tune(daemon, ifname_instance, ifname_master,
+                                tuning, network_mtu=network_mtu)
         return ifname_master
 
+    def interface_tune(self, daemon, ifname_instance, ifname_master,
+                       profile, network_mtu=None):
+        """
+        Apply the MTU, txqueuelen and offloads of a tuning profile to both
+        ends of a veth pair. network_mtu is the MTU set by the virtual
+        network, if any. The queues are only set by create_interface.
+        """
+        mtu = interface_mtu(profile, network_mtu)
+        for ifname, netns in ((ifname_instance, 'ns-%s' % daemon),
+                              (ifname_master, None)):
+            self._backend.link_set_params(
+                ifname, netns=netns, mtu=mtu,
+                txqueuelen=profile.get('txqueuelen'))
+            if profile.get('offloads'):
+                self._backend.link_set_offloads(ifname, profile['offloads'],
+                                                netns=netns)
+
+    def interface_index(self, ifname):
+        return self._backend.link_index(ifname)
+
+    def interface_verify(self, daemon, ifname_instance, mac, ifname_master,
+                         master_ifindex, address=None):
+        """
+        Check that the kernel still holds the veth pair configured by
+        interface_update: same mac address and same master interface and,
+        when given, the interface is up with address assigned.
+        """
+        netns = 'ns-%s' % daemon
+        try:
+            mac_address = self._backend.link_address(ifname_instance,
+                                                     netns=netns)
+            if mac_address.lower() != mac.lower():
+                return False
+            peer = self._backend.link_peer_ifindex(ifname_instance,
+                                                   netns=netns)
+            if peer != master_ifindex:
+                return False
+            if self._backend.link_name(master_ifindex) != ifname_master:
+                return False
+            return (address is None or
+                    self._backend.link_wait(ifname_instance, 0, netns=netns,
+                                            address=address))
+        except BACKEND_ERRORS:
+            return False
+
+    def interface_repair(self, daemon, ifname_instance, mac, ifname_master,
+                         master_ifindex):
+        """
+        Restore the mac address of an interface whose veth pair is still
+        in place. Returns False when the pair is gone or was replaced.
+        """
+        if self.interface_verify(daemon, ifname_instance, mac,
+                                 ifname_master, master_ifindex):
+            return True
+        try:
+            self._backend.link_set_mac(ifname_instance, mac,
+                                       netns='ns-%s' % daemon)
+        except BACKEND_ERRORS:
+            return False
+        return self.interface_verify(daemon, ifname_instance, mac,
+                                     ifname_master, master_ifindex)
+
+    def interface_release(self, ifname_master):
+        """ Release the name of a master interface reaped by the kernel """
+        self._allocator.release(ifname_master)
+
+    def host_interfaces(self):
+        """ Return the host interfaces, keyed by name, from a single dump """
+        return dict((link['name'], link)
+                    for link in self._backend.link_describe())
+
+    def clear_stray_interfaces(self, links=None):
+        """
+        Delete the veth pairs left in the host namespace by an interrupted
+        create_interface, i.e. master interfaces whose peer was never moved
+        to a namespace. links is an optional host_interfaces() snapshot
+        used to skip the locked scan when there are no candidates.
+        Returns the names of the deleted master interfaces.
+        """
+        if links is not None and not self.stray_interfaces(links):
+            return []
+        deleted = []
+        with host_lock(self._lock_file):
+            for name in self.stray_interfaces():
+                self._backend.link_delete(name)
+                self._allocator.release(name)
+                deleted.append(name)
+        return deleted
+
+    def stray_interfaces(self, links=None):
+        """ Return the master interfaces whose peer is on the host """
+        if links is None:
+            links = self.host_interfaces()
+        return sorted(name for name, link in links.items()
+                      if self._allocator.owns(name) and link['peer_local'])
+
+    def release_unused_names(self, dry_run=False):
+        """
+        Release the master interface names marked allocated without an
+        interface, e.g. after a crash between allocation and creation or
+        when a namespace was deleted by other means. Returns the names.
+        """
+        with host_lock(self._lock_file):
+            return self._allocator.release_unused(dry_run=dry_run)
+
+    def _dhcp_config(self, daemon, ifname_guest, timeout):
+        """
+        Obtain a lease with a bounded wait, then terminate dhclient with
+        SIGTERM, which does not run dhclient-script: the address is kept
+        but no client remains in the namespace.
+        """
+        netns = 'ns-%s' % daemon
+        pidfile = '/var/run/dhclient-%s-%s.pid' % (netns, ifname_guest)
+        self._backend.execute('timeout %d dhclient -1 -pf %s %s' %
+                              (timeout, pidfile, ifname_guest), netns=netns)
+        try:
+            with open(pidfile) as fp:
+                pid = int(fp.read().strip())
+            os.unlink(pidfile)
+        except (IOError, OSError, ValueError):
+            return
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError as ex:
+            if ex.errno != errno.ESRCH:
+                raise
+
+    def _resolver_config(self, daemon, dns_servers):
+        """ /etc/netns/<ns>/resolv.conf is bind mounted by ip netns exec """
+        directory = os.path.join(self._etc_dir, 'ns-%s' % daemon)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, 'resolv.conf'), 'w') as fp:
+            for server in dns_servers:
+                fp.write('nameserver %s\n' % server)
+
+    def interface_wait(self, daemon, ifname_guest, address=None,
+                       timeout=READY_TIMEOUT):
+        """
+        Wait until the interface has a carrier, i.e. both ends of the veth
+        pair are up, and address is assigned to it. Raises OSError after
+        timeout seconds; a timeout of 0 does not wait.
+        """
+        if timeout <= 0:
+            return
+        if not self._backend.link_wait(ifname_guest, timeout,
+                                       netns='ns-%s' % daemon,
+                                       address=address):
+            raise OSError(errno.ETIMEDOUT, '%s of ns-%s not ready after %ss'
+                          % (ifname_guest, daemon, timeout))
+
     def interface_config(self, daemon, ifname_guest, advertise_default=True,
-                         ip_prefix=None):
+                         ip_prefix=None, gateway=None, dns_servers=None,
+                         dhcp=False, dhcp_timeout=DHCP_TIMEOUT,
+                         ready_timeout=READY_TIMEOUT):
         """
-        Once the interface is operational, configure the IP addresses.
-        For a bi-directional interface we use dhclient.
+        Configure the IP addresses and wait until the interface is ready
+        (see interface_wait). The address obtained from the API server is
+        configured statically; a bi-directional interface also gets the
+        default route and the resolver configuration. dhclient is used
+        when dhcp is set or when the address is not known; it is started
+        once the link has a carrier, so that its first request is not lost.
         """
+        netns = 'ns-%s' % daemon
+        if advertise_default and (dhcp or ip_prefix is None):
+            self._backend.link_set_up(ifname_guest, netns=netns)
+            self.interface_wait(daemon, ifname_guest, timeout=ready_timeout)
+            self._dhcp_config(daemon, ifname_guest, dhcp_timeout)
+            return
+
+        self._backend.addr_replace(ifname_guest, ip_prefix[0], ip_prefix[1],
+                                   netns=netns)
+        self._backend.link_set_up(ifname_guest, netns=netns)
+        self.interface_wait(daemon, ifname_guest, ip_prefix[0],
+                            timeout=ready_timeout)
         if advertise_default:
-            shell_command('ip netns exec ns-%s dhclient %s' %
-                          (daemon, ifname_guest))
+            if gateway:
+                self._backend.route_replace_default(ifname_guest, gateway,
+                                                    netns=netns)
+            if dns_servers:
+                self._resolver_config(daemon, dns_servers)
         else:
-            shell_command('ip netns exec ns-%s ip addr add %s/%d dev %s' %
-                          (daemon, ip_prefix[0], ip_prefix[1], ifname_guest))
-            shell_command('ip netns exec ns-%s ip link set %s up' %
-                          (daemon, ifname_guest))
             # disable reverse path filtering
-            shell_command('ip netns exec ns-%s sh -c ' +
-                          '"echo 2 >/proc/sys/net/ipv4/conf/%s/rp_filter"' %
-                          (daemon, ifname_guest))
+            self._backend.sysctl_set(
+                'net/ipv4/conf/%s/rp_filter' % ifname_guest, 2, netns=netns)
 
     def clear_interfaces(self, daemon):
-        output = shell_command('ip netns exec ns-%s ip link list' % daemon)
-        for line in output.split('\n'):
-            m = re.match(r'^[\d]+: ([\w]+):', line)
-            if m:
-                ifname = m.group(1)
-                if ifname == 'lo':
-                    continue
-                shell_command('ip netns exec ns-%s ip link delete %s' %
-                              (daemon, ifname))
-
-    def namespace_init(self, daemon):
-        output = shell_command('ip netns list')
-        for line in output.split():
-            if line == 'ns-' + daemon:
-                return False
-        shell_command('ip netns add ns-%s' % daemon)
+        netns = 'ns-%s' % daemon
+        for iface in self.describe_interfaces(daemon):
+            self._backend.link_delete(iface['name'], netns=netns)
+            self._allocator.release(iface['master'])
+
+    def namespace_daemons(self):
+        """ Return the daemons that have a namespace """
+        return [netns[len('ns-'):] for netns in self._backend.namespace_list()
+                if netns.startswith('ns-')]
+
+    def namespace_usage(self, daemons):
+        """
+        Return a dictionary of daemon to (in_use, created) for the given
+        namespaces: whether a process runs in the namespace, and about
+        when it was created (the time of its nsfs inode). Processes are
+        found with a single scan of /proc.
+        """
+        active = namespaces_in_use()
+        usage = {}
+        for daemon in daemons:
+            try:
+                st = os.stat(os.path.join(NETNS_RUN_DIR, 'ns-%s' % daemon))
+            except OSError:
+                continue
+            usage[daemon] = ((st.st_dev, st.st_ino) in active, st.st_mtime)
+        return usage
+
+    def namespace_init(self, daemon, spare=True):
+        """
+        Create the namespace of daemon unless it exists. With spare, a
+        namespace of the pool is used when there is one.
+        """
+        namespaces = self._backend.namespace_list()
+        if 'ns-' + daemon in namespaces:
+            return False
+        if (spare and self.pool is not None and
+                self.pool.claim(daemon, namespaces)):
+            return True
+        self._backend.namespace_add('ns-%s' % daemon)
         return True
 
+    def spare_list(self, prefix, namespaces=None):
+        """ Return the spare namespaces, whose names start with prefix """
+        if namespaces is None:
+            namespaces = self._backend.namespace_list()
+        return sorted(netns for netns in namespaces
+                      if netns.startswith(prefix))
+
+    def spare_create(self, netns, ifname_instance):
+        """ Create a namespace holding a veth pair, not bound to a daemon """
+        self._backend.namespace_add(netns)
+        try:
+            self.create_interface(None, ifname_instance, netns=netns)
+        except BACKEND_ERRORS:
+            self._backend.namespace_delete(netns)
+            raise
+
+    def spare_claim(self, netns, daemon):
+        """ Bind a spare namespace to a daemon """
+        self._backend.namespace_rename(netns, 'ns-%s' % daemon)
+
+    def _netns_destroy(self, netns):
+        interfaces = self._describe_netns(netns)
+        # the kernel deletes the veth pairs along with the namespace
+        self._backend.namespace_delete(netns)
+        for iface in interfaces:
+            self._allocator.release(iface['master'])
+
+    def spare_delete(self, netns):
+        self._netns_destroy(netns)
+
     def namespace_delete(self, daemon):
-        shell_command('ip netns delete ns-%s' % daemon)
+        self._backend.namespace_delete('ns-%s' % daemon)
+
+    def namespace_destroy(self, daemon):
+        """
+        Delete the namespace of a daemon together with its interfaces,
+        with a single namespace deletion.
+        """
+        self._netns_destroy('ns-%s' % daemon)
@@ -0,0 +1,190 @@
+"""
+Instrumentation of the provisioning runs. A run covers the start or stop
+of one daemon (or a bulk stop); it records the duration of its phases and
+counts the API server requests, subprocesses and vrouter RPCs issued on
+its behalf:
+
+    with metrics.run(daemon, 'start'):
+        with metrics.phase('api_locate'):
+            ...
+
+The current run is held per thread; the batch helpers hand it over
+to the threads they start. Completed runs are passed to the configured
+sinks: a node-exporter textfile per daemon (netns-<daemon>.prom) holding
+its last run, and a JSON line per run appended to a log file.
+"""
+
+import collections
+import contextlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import tracing
+
+# kinds of counted operations
+API_REQUEST = 'api_request'
+SUBPROCESS = 'subprocess'
+RPC = 'rpc'
+
+_context = threading.local()
+_sinks = []
+
+
+class Run(object):
+    def __init__(self, daemon, operation):
+        self.daemon = daemon
+        self.operation = operation
+        self.started = time.time()
+        self.duration = None
+        self.success = None
+        # phase -> seconds; concurrent phases overlap
+        self.phases = collections.OrderedDict()
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    def phase_add(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count(self, kind, n=1):
+        with self._lock:
+            self.counts[kind] += n
+
+    def record(self):
+        return collections.OrderedDict([
+            ('time', self.started),
+            ('daemon', self.daemon),
+            ('operation', self.operation),
+            ('success', self.success),
+            ('seconds', self.duration),
+            ('phases', self.phases),
+            ('counts', dict((kind, self.counts[kind])
+                            for kind in (API_REQUEST, SUBPROCESS, RPC))),
+        ])
+
+
+def run_current():
+    return getattr(_context, 'run', None)
+
+
+@contextlib.contextmanager
+def run_context(current):
+    """ Attribute the operations of the calling thread to current """
+    saved = run_current()
+    _context.run = current
+    try:
+        yield
+    finally:
+        _context.run = saved
+
+
+@contextlib.contextmanager
+def run(daemon, operation):
+    current = Run(daemon, operation)
+    with run_context(current), tracing.span(
+            '%s %s' % (operation, daemon or ''), 'run'):
+        try:
+            yield current
+            current.success = True
+        except BaseException:
+            current.success = False
+            raise
+        finally:
+            current.duration = time.time() - current.started
+            for sink in list(_sinks):
+                try:
+                    sink(current)
+                except Exception:
+                    logging.exception('Unable to record the metrics of %s',
+                                      daemon)
+
+
+@contextlib.contextmanager
+def phase(name):
+    current = run_current()
+    start = time.time()
+    try:
+        with tracing.span(name, 'phase'):
+            yield
+    finally:
+        if current is not None:
+            current.phase_add(name, time.time() - start)
+
+
+def count(kind, n=1):
+    current = run_current()
+    if current is not None:
+        current.count(kind, n)
+
+
+def _label(value):
+    return '"%s"' % (value.replace('\\', '\\\\').replace('"', '\\"')
+                     .replace('\n', '\\n'))
+
+
+def textfile_format(current):
+    """ Format a run in the Prometheus text exposition format """
+    labels = 'daemon=%s,operation=%s' % (_label(current.daemon or ''),
+                                         _label(current.operation))
+    lines = []
+
+    def metric(name, description, samples):
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s gauge' % name)
+        for extra, value in samples:
+            lines.append('%s{%s%s} %s' % (name, labels, extra, repr(value)))
+
+    metric('netns_run_timestamp_seconds', 'Start time of the last run.',
+           [('', current.started)])
+    metric('netns_run_seconds', 'Duration of the last run.',
+           [('', current.duration)])
+    metric('netns_run_success', 'Whether the last run succeeded.',
+           [('', int(bool(current.success)))])
+    metric('netns_phase_seconds', 'Duration of the phases of the last run.',
+           [(',phase=%s' % _label(name), seconds)
+            for name, seconds in current.phases.items()])
+    metric('netns_run_calls', 'Operations issued by the last run.',
+           [(',kind=%s' % _label(kind), current.counts[kind])
+            for kind in (API_REQUEST, SUBPROCESS, RPC)])
+    return '\n'.join(lines) + '\n'
+
+
+def textfile_write(directory, current):
+    """
+    Replace the textfile of the daemon of a run, atomically so that the
+    node-exporter never reads a partial file.
+    """
+    filename = os.path.join(directory, 'netns-%s.prom' %
+                            (current.daemon or current.operation))
+    fd, tmpname = tempfile.mkstemp(dir=directory, prefix='.netns-')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(textfile_format(current))
+        os.chmod(tmpname, 0644)
+        os.rename(tmpname, filename)
+    except Exception:
+        os.unlink(tmpname)
+        raise
+
+
+_log_lock = threading.Lock()
+
+
+def log_append(path, current):
+    line = json.dumps(current.record()) + '\n'
+    with _log_lock:
+        with open(path, 'a') as fp:
+            fp.write(line)
+
+
+def sinks_configure(textfile_dir=None, log_file=None):
+    """ Set where completed runs are written; None disables a sink """
+    del _sinks[:]
+    if textfile_dir:
+        _sinks.append(lambda current: textfile_write(textfile_dir, current))
+    if log_file:
+        _sinks.append(lambda current: log_append(log_file, current))
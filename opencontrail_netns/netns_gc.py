@@ -0,0 +1,214 @@
+"""
+netns-gc deletes what interrupted starts and missing stops left behind on
+this host.
+
+The objects of a daemon are its <hostname>-<daemon> virtual-machine (with
+its interfaces and instance-ips), its ns-<daemon> namespace, its
+checkpoint and its journaled ports. Only the daemons having a namespace,
+a checkpoint or journaled ports on this host are considered: a
+virtual-machine alone may belong to another host whose name shares the
+prefix. A daemon is orphaned when no process runs in its namespace and
+none of these objects was created or updated within the grace period.
+A namespace must moreover have been found idle by runs of netns-gc for
+the grace period, so that a daemon being restarted is not collected.
+Orphans are torn down together, as by netns-daemon-stop --bulk. The
+spare namespaces of the agent pool are not daemon namespaces and are
+left alone.
+
+Independently of the daemons, master veths whose peer never left the
+host are deleted, and interface names allocated without an interface
+are released.
+"""
+
+import argparse
+import calendar
+import errno
+import logging
+import os
+import socket
+import sys
+import time
+
+from batch import batch_report
+from contrail_lib import rpc_client_shared
+from daemon_ops import daemons_teardown
+from daemon_state import STATE_DIR, DaemonStateStore
+from instance_provisioner import Provisioner
+from lxc_manager import LxcManager
+from port_journal import PortJournal, journal_apply
+from ratelimit import TokenBucket
+
+
+def _created(obj):
+    """ Creation time of an API server object, None when unknown """
+    id_perms = obj.get_id_perms()
+    created = getattr(id_perms, 'created', None)
+    if not created:
+        return None
+    try:
+        return calendar.timegm(time.strptime(created.split('.')[0],
+                                             '%Y-%m-%dT%H:%M:%S'))
+    except ValueError:
+        return None
+
+
+def _idle_since(directory, daemon, now):
+    """
+    Return since when the namespace of daemon was found idle, recording
+    now when it was not yet.
+    """
+    filename = os.path.join(directory, daemon)
+    try:
+        return os.stat(filename).st_mtime
+    except OSError:
+        pass
+    try:
+        os.makedirs(directory)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+    open(filename, 'w').close()
+    os.utime(filename, (now, now))
+    return now
+
+
+def _idle_clear(directory, daemon):
+    try:
+        os.unlink(os.path.join(directory, daemon))
+    except OSError as ex:
+        if ex.errno != errno.ENOENT:
+            raise
+
+
+def orphans_find(provisioner, manager, state_store, journal, idle_dir,
+                 grace=600):
+    """
+    Enumerate the daemons of this host, with one pass over the
+    namespaces, the processes, the checkpoints and the port journal, and
+    one over the API server virtual-machines of these daemons. The time
+    each idle namespace was first found idle is recorded in idle_dir.
+    Returns (orphans, vms): a dictionary of orphaned daemon to the list
+    of objects it holds, and the virtual-machines keyed by daemon.
+    """
+    now = time.time()
+    namespaces = manager.namespace_usage(manager.namespace_daemons())
+    checkpoints = {}
+    for daemon in state_store.daemons():
+        modified = state_store.modified(daemon)
+        if modified is not None:
+            checkpoints[daemon] = modified
+    daemons = set(namespaces) | set(checkpoints) | journal.daemons()
+    prefix = socket.gethostname() + '-'
+    vms = dict((vm.get_fq_name()[-1][len(prefix):], vm)
+               for vm in provisioner.virtual_machines_named(
+                   [prefix + daemon for daemon in daemons]))
+
+    try:
+        marked = os.listdir(idle_dir)
+    except OSError:
+        marked = []
+    for daemon in marked:
+        if daemon not in namespaces:
+            _idle_clear(idle_dir, daemon)
+
+    orphans = {}
+    for daemon in sorted(daemons):
+        in_use, ns_created = namespaces.get(daemon, (False, None))
+        if in_use:
+            _idle_clear(idle_dir, daemon)
+            continue
+        vm = vms.get(daemon)
+        times = [value for value in (ns_created, checkpoints.get(daemon),
+                                     vm and _created(vm))
+                 if value is not None]
+        if daemon in namespaces:
+            times.append(_idle_since(idle_dir, daemon, now))
+        if times and now - max(times) < grace:
+            continue
+        held = []
+        if vm is not None:
+            held.append('virtual-machine (%d interfaces)' %
+                        len(vm.get_virtual_machine_interfaces() or []))
+        if daemon in namespaces:
+            held.append('namespace')
+        if daemon in checkpoints:
+            held.append('checkpoint')
+        orphans[daemon] = held
+    return orphans, vms
+
+# end orphans_find
+
+
+def gc_main():
+    parser = argparse.ArgumentParser()
+    defaults = {
+        'api-server': '127.0.0.1',
+        'api-port': 8082,
+    }
+    parser.set_defaults(**defaults)
+    parser.add_argument("-s", "--api-server", help="API server address")
+    parser.add_argument("-p", "--api-port", type=int, help="API server port")
+    parser.add_argument("--netns-backend", default='auto',
+                        choices=['auto', 'netlink', 'shell'],
+                        help="Kernel interface used to manage namespaces")
+    parser.add_argument("--state-dir", default=STATE_DIR,
+                        help="Directory holding the per daemon checkpoints")
+    parser.add_argument("-w", "--workers", type=int, default=8,
+                        help="Concurrent deletions")
+    parser.add_argument("--grace", type=int, default=600,
+                        help="Seconds during which new objects are not"
+                        " collected")
+    parser.add_argument("--rate", type=float, default=10,
+                        help="Maximum namespace and API object deletions"
+                        " per second (0 for no limit)")
+    parser.add_argument("--dry-run", action='store_true',
+                        help="Only print what would be deleted")
+    arguments = parser.parse_args(sys.argv[1:])
+
+    logging.basicConfig(level=logging.INFO)
+    provisioner = Provisioner(api_server=arguments.api_server,
+                              api_port=arguments.api_port)
+    manager = LxcManager(backend=arguments.netns_backend)
+    state_store = DaemonStateStore(arguments.state_dir)
+
+    journal = PortJournal(os.path.join(arguments.state_dir, 'ports'))
+    orphans, vms = orphans_find(provisioner, manager, state_store, journal,
+                                os.path.join(arguments.state_dir, 'gc-idle'),
+                                grace=arguments.grace)
+    for daemon, held in sorted(orphans.items()):
+        print '%s: %s' % (daemon, ', '.join(held))
+    strays = manager.stray_interfaces()
+    for ifname in strays:
+        print '%s: veth left on the host' % ifname
+
+    if arguments.dry_run:
+        unused = manager.release_unused_names(dry_run=True)
+        print '%d orphaned daemons, %d stray interfaces, %d unused' \
+            ' interface names' % (len(orphans), len(strays), len(unused))
+        return
+
+    failures = 0
+    if orphans:
+        limiter = None
+        if arguments.rate > 0:
+            limiter = TokenBucket(arguments.rate)
+        with rpc_client_shared() as client:
+            results = daemons_teardown(provisioner, manager, sorted(orphans),
+                                       client=client,
+                                       state_store=state_store,
+                                       workers=arguments.workers, vms=vms,
+                                       limiter=limiter, journal=journal)
+            journal_apply(journal, client)
+        failures = batch_report(results)
+    deleted = manager.clear_stray_interfaces()
+    released = manager.release_unused_names()
+    print '%d stray interfaces deleted, %d unused interface names' \
+        ' released' % (len(deleted), len(released))
+    if failures:
+        sys.exit(1)
+
+# end gc_main
+
+
+if __name__ == '__main__':
+    gc_main()
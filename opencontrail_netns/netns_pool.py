@@ -0,0 +1,94 @@
+"""
+Warm pool of spare namespaces for LxcManager. Each spare already holds
+the primary veth pair, moved into the namespace and with its master
+interface up; starting a daemon renames a spare to ns-<daemon>, which
+leaves only the mac address and the IP configuration to be set.
+"""
+
+import logging
+import os
+import threading
+import uuid
+
+from daemon_state import STATE_DIR
+from ifname_allocator import host_lock
+from lxc_backend import BACKEND_ERRORS
+
+
+POOL_PREFIX = 'spare-'
+
+
+class NamespacePool(object):
+    def __init__(self, manager, size, ifname='veth0',
+                 lock_file=os.path.join(STATE_DIR, 'pool.lock'),
+                 interval=60):
+        """
+        manager: LxcManager creating the spares.
+        size: number of spares to keep.
+        ifname: instance side name of the veth pair of a spare.
+        interval: seconds between refills when no spare is claimed.
+        """
+        self._manager = manager
+        self._size = size
+        self._ifname = ifname
+        self._lock_file = lock_file
+        self._interval = interval
+        self._wakeup = threading.Event()
+        self._stop = False
+        self._thread = None
+
+    def spares(self, namespaces=None):
+        return self._manager.spare_list(POOL_PREFIX, namespaces)
+
+    def claim(self, daemon, namespaces=None):
+        """
+        Bind a spare to daemon. namespaces is an optional listing of the
+        namespaces. Returns False when the pool is empty.
+        """
+        claimed = False
+        with host_lock(self._lock_file):
+            for netns in self.spares(namespaces):
+                try:
+                    self._manager.spare_claim(netns, daemon)
+                except BACKEND_ERRORS:
+                    # claimed by another process since the listing
+                    continue
+                logging.debug('%s: claimed %s', daemon, netns)
+                claimed = True
+                break
+        self._wakeup.set()
+        return claimed
+
+    def refill(self):
+        """ Create spares until the pool holds size of them """
+        for _ in range(self._size - len(self.spares())):
+            netns = POOL_PREFIX + uuid.uuid4().hex[:8]
+            # a spare must not be claimed until its veth pair is in place
+            with host_lock(self._lock_file):
+                self._manager.spare_create(netns, self._ifname)
+
+    def drain(self):
+        """ Delete every spare """
+        with host_lock(self._lock_file):
+            for netns in self.spares():
+                self._manager.spare_delete(netns)
+
+    def _loop(self):
+        while not self._stop:
+            self._wakeup.clear()
+            try:
+                self.refill()
+            except BACKEND_ERRORS:
+                logging.exception('Unable to refill the namespace pool')
+            self._wakeup.wait(self._interval)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
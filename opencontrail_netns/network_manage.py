@@ -1,39 +1,213 @@
 #!/bin/env python
 
 import argparse
+import atexit
+import collections
+import json
+import time
 from vnc_api.vnc_api import *
 
+from api_counters import counters_attach
+from api_share import requests_share
+from batch import batch_report, manifest_read, run_parallel
+from tracing import profile_start, span_add, trace_start
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+# uuids per list request when reading objects in detail
+LIST_CHUNK = 100
+
+
+# fields of the list command, with the virtual-network fields they need
+LIST_FIELDS = collections.OrderedDict([
+    ('name', []),
+    ('uuid', []),
+    ('subnets', ['network_ipam_refs']),
+    ('route_targets', ['route_target_list']),
+    ('import_targets', ['routing_instances']),
+    ('export_targets', ['routing_instances']),
+])
+
+
+def spec_read(filename):
+    """
+    Load a network spec. YAML requires PyYAML; JSON is always accepted.
+    """
+    with open(filename) as fp:
+        if yaml is not None:
+            return yaml.safe_load(fp)
+        if filename.endswith(('.yaml', '.yml')):
+            print 'PyYAML is required to read %s' % filename
+            sys.exit(1)
+        return json.load(fp)
+
+
+def _target_name(rtarget):
+    if rtarget.startswith('target:'):
+        return rtarget
+    return 'target:%s' % rtarget
+
+
+def _rti_change(targets, op, rtarget, direction):
+    """
+    Add or remove a direction ('import', 'export' or None for both) of a
+    target in a _rti_targets() dictionary. Returns the new dictionary.
+    """
+    both = set(['import', 'export'])
+    current = targets.get(rtarget, '')
+    directions = set(both) if current is None else set([current]) - set([''])
+    change = both if direction is None else set([direction])
+    if op == 'add':
+        directions |= change
+    else:
+        directions -= change
+    targets = dict(targets)
+    if not directions:
+        targets.pop(rtarget, None)
+    else:
+        targets[rtarget] = None if directions == both else directions.pop()
+    return targets
+
+
+def _action(op, obj_type, name, changes, run, stage):
+    """
+    A step of an apply plan. Steps of the same stage are independent and
+    run concurrently; stages run in increasing order.
+    """
+    return {'op': op, 'type': obj_type, 'name': name, 'changes': changes,
+            'run': run, 'stage': stage}
+
+
+def _action_str(action):
+    sign = {'create': '+', 'update': '~', 'delete': '-'}[action['op']]
+    line = '%s %s %s' % (sign, action['type'], action['name'])
+    if action['changes']:
+        line += ': ' + ', '.join(action['changes'])
+    return line
+
 
 class NetworkManager(object):
-    def __init__(self, api_server, api_port, project=None):
-        self._client = VncApi(api_server_host=api_server,
-                              api_server_port=api_port)
+    def __init__(self, api_server, api_port, project=None, share_ttl=2,
+                 api_rate=50, client=None):
+        shared = client is None
+        if client is None:
+            client = VncApi(api_server_host=api_server,
+                            api_server_port=api_port)
+        self._client = client
+        self.api_counters = counters_attach(client)
+        if shared:
+            requests_share(client, ttl=share_ttl, rate=api_rate)
         self._project = project
+        self._default_ipam = None
 
-    def _netname(self, name):
+    def _netname(self, name, project=None):
         fqn = name.split(':')
         if len(fqn) == 1:
-            return "%s:%s" % (self._project, name)
+            return "%s:%s" % (project or self._project, name)
         return name
     # end _netname
 
-    def _add_subnet(self, vnet, subnet):
-        ipam = self._client.network_ipam_read(
-            fq_name=['default-domain',
-                     'default-project',
-                     'default-network-ipam'])
+    def _ipam(self):
+        """
+        The default network-ipam, resolved once per manager. References
+        only need its name and uuid; reading it would also return the back
+        references of every network.
+        """
+        if self._default_ipam is None:
+            ipam = NetworkIpam('default-network-ipam',
+                               Project('default-project'))
+            ipam.uuid = self._client.fq_name_to_id('network-ipam',
+                                                   ipam.get_fq_name())
+            self._default_ipam = ipam
+        return self._default_ipam
+
+    def _ipam_subnets(self, subnets):
+        ipam_subnets = []
+        for subnet in subnets:
+            (prefix, plen) = subnet.split('/')
+            ipam_subnets.append(
+                IpamSubnetType(subnet=SubnetType(prefix, int(plen))))
+        return VnSubnetsType(ipam_subnets)
 
-        (prefix, plen) = subnet.split('/')
-        subnet = IpamSubnetType(subnet=SubnetType(prefix, int(plen)))
-        vnet.add_network_ipam(ipam, VnSubnetsType([subnet]))
+    def _add_subnet(self, vnet, subnet):
+        vnet.add_network_ipam(self._ipam(), self._ipam_subnets([subnet]))
 
     # end _add_subnet
 
+    def _list_uuids(self, obj_type, **kwargs):
+        result = getattr(self._client, obj_type + 's_list')(**kwargs)
+        return [item['uuid']
+                for item in result[obj_type.replace('_', '-') + 's']]
+
+    def _list_detail(self, obj_type, uuids, fields=None, chunk=LIST_CHUNK):
+        """
+        Generator reading objects in detail, with one list request per
+        chunk of uuids.
+        """
+        for start in range(0, len(uuids), chunk):
+            objs = getattr(self._client, obj_type + 's_list')(
+                obj_uuids=uuids[start:start + chunk], detail=True,
+                fields=fields)
+            for obj in objs:
+                yield obj
+
+    def _routing_instances(self, vn_uuids, chunk=LIST_CHUNK):
+        """
+        Return the primary routing-instance of the given networks, keyed
+        by network fq_name string.
+        """
+        instances = {}
+        for start in range(0, len(vn_uuids), chunk):
+            objs = self._client.routing_instances_list(
+                parent_id=vn_uuids[start:start + chunk], detail=True,
+                fields=['route_target_refs'])
+            for rt_instance in objs:
+                fq_name = rt_instance.get_fq_name()
+                netname = ':'.join(fq_name[:-1])
+                if netname not in instances or fq_name[-1] == fq_name[-2]:
+                    instances[netname] = rt_instance
+        return instances
+
+    def _network_subnets(self, vnet):
+        subnets = []
+        for iref in vnet.get_network_ipam_refs() or []:
+            for snet in iref['attr'].ipam_subnets:
+                subnets.append('%s/%d' % (snet.subnet.ip_prefix,
+                                          snet.subnet.ip_prefix_len))
+        return sorted(subnets)
+
+    def _network_targets(self, vnet):
+        target_list = vnet.get_route_target_list()
+        if target_list is None:
+            return []
+        return sorted(target_list.get_route_target() or [])
+
+    def _rti_targets(self, rt_instance):
+        """
+        Return the route targets of a routing-instance as a dictionary of
+        target name to direction ('import', 'export' or None for both).
+        """
+        targets = {}
+        for rt in rt_instance.get_route_target_refs() or []:
+            attr = rt.get('attr')
+            targets[rt['to'][0]] = attr.import_export if attr else None
+        return targets
+
+    def _rti_set_targets(self, rt_instance, targets):
+        rt_instance.route_target_refs = [
+            {'to': [rtarget],
+             'attr': InstanceTargetType(import_export=direction)}
+            for rtarget, direction in sorted(targets.items())]
+
     def create(self, name, subnet=None):
         netname = self._netname(name)
         fq_name = netname.split(':')
         try:
-            vnet = self._client.virtual_network_read(fq_name=fq_name)
+            self._client.fq_name_to_id('virtual-network', fq_name)
             print 'Network %s already exists' % netname
             sys.exit(1)
         except NoIdError:
@@ -51,19 +225,21 @@ class NetworkManager(object):
         netname = self._netname(name)
         fq_name = netname.split(':')
         try:
-            vnet = self._client.virtual_network_read(fq_name=fq_name)
+            vn_uuid = self._client.fq_name_to_id('virtual-network', fq_name)
         except NoIdError:
             print 'Network %s does not exist' % netname
             sys.exit(1)
 
-        self._client.virtual_network_delete(id=vnet.uuid)
+        self._client.virtual_network_delete(id=vn_uuid)
     # end delete
 
     def show(self, name):
         netname = self._netname(name)
         fq_name = netname.split(':')
         try:
-            vnet = self._client.virtual_network_read(fq_name=fq_name)
+            vnet = self._client.virtual_network_read(
+                fq_name=fq_name,
+                fields=['network_ipam_refs', 'routing_instances'])
         except NoIdError:
             print 'Network %s does not exist' % netname
             sys.exit(1)
@@ -80,29 +256,29 @@ class NetworkManager(object):
                 print '    ',
                 print(snet.subnet.__dict__)
 
-        instance_list = vnet.get_routing_instances()
+        instance_list = vnet.get_routing_instances() or []
         if len(instance_list):
             rt_instance = self._client.routing_instance_read(
-                id=instance_list[0]['uuid'])
-            for rt in rt_instance.route_target_refs:
+                id=instance_list[0]['uuid'], fields=['route_target_refs'])
+            for rt in rt_instance.get_route_target_refs() or []:
                 print '    ',
                 print(rt['to'][0], rt['attr'].__dict__)
     # end show
 
     def _rti_rtarget_add(self, vnet, rtarget_str, direction):
-        instance_list = vnet.get_routing_instances()
+        instance_list = vnet.get_routing_instances() or []
         if len(instance_list) == 0:
             print 'Routing instance not found'
             sys.exit(1)
 
         rt_instance = self._client.routing_instance_read(
-            id=instance_list[0]['uuid'])
-        for rt in rt_instance.route_target_refs:
+            id=instance_list[0]['uuid'], fields=['route_target_refs'])
+        for rt in rt_instance.get_route_target_refs() or []:
             if rt['to'][0] == rtarget_str:
                 sys.exit(1)
 
         try:
-            rt_obj = self._client.route_target_read(fq_name=rtarget_str)
+            self._client.fq_name_to_id('route-target', [rtarget_str])
         except NoIdError:
             rt_obj = RouteTarget(rtarget_str)
             self._client.route_target_create(rt_obj)
@@ -113,18 +289,18 @@ class NetworkManager(object):
         self._client.routing_instance_update(rt_instance)
 
     def _rti_rtarget_del(self, vnet, rtarget_str, direction):
-        instance_list = vnet.get_routing_instances()
+        instance_list = vnet.get_routing_instances() or []
         if len(instance_list) == 0:
             print 'Routing instance not found'
             sys.exit(1)
 
         rt_instance = self._client.routing_instance_read(
-            id=instance_list[0]['uuid'])
-        for rt in rt_instance.route_target_refs:
+            id=instance_list[0]['uuid'], fields=['route_target_refs'])
+        for rt in rt_instance.get_route_target_refs() or []:
             if rt['to'][0] == rtarget_str:
-                rt_obj = self._client.route_target_read(id=rt['uuid'])
+                # references are matched by name
+                rt_instance.del_route_target(RouteTarget(rtarget_str))
 
-        rt_instance.del_route_target(rt_obj)
         self._client.routing_instance_update(rt_instance)
     # end _rti_rtarget_add
 
@@ -132,7 +308,9 @@ class NetworkManager(object):
         netname = self._netname(name)
         fq_name = netname.split(':')
         try:
-            vnet = self._client.virtual_network_read(fq_name=fq_name)
+            vnet = self._client.virtual_network_read(
+                fq_name=fq_name,
+                fields=['route_target_list', 'routing_instances'])
         except NoIdError:
             print 'Network %s does not exist' % netname
             sys.exit(1)
@@ -161,7 +339,9 @@ class NetworkManager(object):
         netname = self._netname(name)
         fq_name = netname.split(':')
         try:
-            vnet = self._client.virtual_network_read(fq_name=fq_name)
+            vnet = self._client.virtual_network_read(
+                fq_name=fq_name,
+                fields=['route_target_list', 'routing_instances'])
         except NoIdError:
             print 'Network %s does not exist' % netname
             sys.exit(1)
@@ -186,8 +366,396 @@ class NetworkManager(object):
         # self._client.virtual_network_update(vnet)
     # end rtarget_del
 
+    def list_networks(self, fields=None, project=None):
+        """
+        Generator of one record (an OrderedDict of the given fields) per
+        network of the project. Networks are read in detail one chunk at
+        a time, so that records are produced as the chunks arrive and
+        memory use does not grow with the number of networks.
+        """
+        fields = fields or LIST_FIELDS.keys()
+        project = project or self._project
+        api_fields = sorted(set(field for name in fields
+                                for field in LIST_FIELDS[name]) -
+                            set(['routing_instances']))
+        rti = 'import_targets' in fields or 'export_targets' in fields
+        vn_uuids = self._list_uuids('virtual_network',
+                                    parent_fq_name=project.split(':'))
+        for start in range(0, len(vn_uuids), LIST_CHUNK):
+            chunk = vn_uuids[start:start + LIST_CHUNK]
+            instances = self._routing_instances(chunk) if rti else {}
+            for vnet in self._list_detail('virtual_network', chunk,
+                                          fields=api_fields):
+                netname = ':'.join(vnet.get_fq_name())
+                targets = {}
+                if netname in instances:
+                    targets = self._rti_targets(instances[netname])
+                values = {
+                    'name': lambda: netname,
+                    'uuid': lambda: vnet.uuid,
+                    'subnets': lambda: self._network_subnets(vnet),
+                    'route_targets': lambda: self._network_targets(vnet),
+                    'import_targets': lambda: sorted(
+                        rtarget for rtarget, direction in targets.items()
+                        if direction != 'export'),
+                    'export_targets': lambda: sorted(
+                        rtarget for rtarget, direction in targets.items()
+                        if direction != 'import'),
+                }
+                yield collections.OrderedDict(
+                    (field, values[field]()) for field in fields)
+    # end list_networks
+
+    def _network_uuids(self, netnames):
+        """
+        Resolve network names, with one list request per project.
+        Returns a dictionary of fq_name string to uuid.
+        """
+        uuids = {}
+        for project in set(netname.rsplit(':', 1)[0] for netname in netnames):
+            result = self._client.virtual_networks_list(
+                parent_fq_name=project.split(':'))
+            for item in result['virtual-networks']:
+                uuids[':'.join(item['fq_name'])] = item['uuid']
+        return uuids
+
+    def _network_targets_update(self, vnet, targets):
+        vnet.set_route_target_list(RouteTargetList(sorted(targets)))
+        self._client.virtual_network_update(vnet)
+
+    def rtarget_bulk(self, changes, workers=8):
+        """
+        Apply route target changes across networks. changes is a list of
+        (op, network, rtarget, direction) tuples: op is 'add' or 'del',
+        direction 'import', 'export', 'both' for the routing-instance or
+        None for the route target list of the network.
+        Every virtual-network and routing-instance is read (in detail
+        list requests) and updated at most once, and the updates run
+        concurrently. Adding a present target or removing a missing one
+        is a no-op. Returns the number of failures.
+        """
+        vn_changes = collections.defaultdict(list)
+        rti_changes = collections.defaultdict(list)
+        for op, name, rtarget, direction in changes:
+            change = (op, _target_name(rtarget),
+                      None if direction == 'both' else direction)
+            if direction:
+                rti_changes[self._netname(name)].append(change)
+            else:
+                vn_changes[self._netname(name)].append(change)
+
+        netnames = set(vn_changes) | set(rti_changes)
+        uuids = self._network_uuids(netnames)
+        failures = 0
+        for netname in sorted(netnames - set(uuids)):
+            print 'Network %s does not exist' % netname
+            failures += 1
+
+        tasks = []
+        for vnet in self._list_detail(
+                'virtual_network',
+                [uuids[netname] for netname in vn_changes
+                 if netname in uuids],
+                fields=['route_target_list']):
+            netname = ':'.join(vnet.get_fq_name())
+            current = set(self._network_targets(vnet))
+            targets = set(current)
+            for op, rtarget, _ in vn_changes[netname]:
+                if op == 'add':
+                    targets.add(rtarget)
+                else:
+                    targets.discard(rtarget)
+            if targets != current:
+                tasks.append(('virtual-network', netname,
+                              lambda vnet=vnet, targets=targets:
+                              self._network_targets_update(vnet, targets)))
+
+        instances = self._routing_instances(
+            [uuids[netname] for netname in rti_changes if netname in uuids])
+        rtargets = set()
+        for netname, rti_list in sorted(rti_changes.items()):
+            if netname not in uuids:
+                continue
+            rt_instance = instances.get(netname)
+            if rt_instance is None:
+                print 'Routing instance of %s not found' % netname
+                failures += 1
+                continue
+            current = self._rti_targets(rt_instance)
+            targets = current
+            for op, rtarget, direction in rti_list:
+                targets = _rti_change(targets, op, rtarget, direction)
+            if targets != current:
+                rtargets.update(set(targets) - set(current))
+                tasks.append(('routing-instance', netname,
+                              lambda netname=netname, targets=targets,
+                              rt_instance=rt_instance:
+                              self._rti_update(netname, targets,
+                                               rt_instance)))
+
+        if not tasks:
+            print 'No changes'
+            return failures
+
+        # route-target objects referenced for the first time
+        results = run_parallel(self._route_target_create,
+                               self._route_targets_missing(rtargets), workers)
+        results.extend(run_parallel(lambda task: task[2](), tasks, workers))
+        return failures + batch_report(
+            results, name=lambda item: item if isinstance(item, basestring)
+            else '%s %s' % item[:2])
+    # end rtarget_bulk
+
+    def _spec_networks(self, spec, project):
+        """
+        Normalize the networks of a spec: a dictionary keyed by network
+        fq_name string, with the subnets, route_targets and rti (targets
+        of the routing-instance, see _rti_targets) keys.
+        """
+        networks = {}
+        for net in spec.get('networks') or []:
+            subnets = net.get('subnets') or []
+            if net.get('subnet'):
+                subnets = subnets + [net['subnet']]
+            rti = {}
+            for rtarget in net.get('import_targets') or []:
+                rti[_target_name(rtarget)] = 'import'
+            for rtarget in net.get('export_targets') or []:
+                rtarget = _target_name(rtarget)
+                rti[rtarget] = None if rtarget in rti else 'export'
+            networks[self._netname(net['name'], project)] = {
+                'subnets': sorted(subnets),
+                'route_targets': sorted(set(
+                    _target_name(rtarget)
+                    for rtarget in net.get('route_targets') or [])),
+                'rti': rti,
+            }
+        return networks
+
+    def _network_create(self, netname, net):
+        fq_name = netname.split(':')
+        vnet = VirtualNetwork(fq_name[-1], parent_type='project',
+                              fq_name=fq_name)
+        if net['subnets']:
+            vnet.add_network_ipam(self._ipam(),
+                                  self._ipam_subnets(net['subnets']))
+        if net['route_targets']:
+            vnet.set_route_target_list(RouteTargetList(net['route_targets']))
+        self._client.virtual_network_create(vnet)
+
+    def _ipam_refs_merge(self, vnet, subnets):
+        """
+        Set the subnets of vnet. The subnets it keeps retain their
+        attributes (gateway, DNS, allocation pools, uuid) and network-ipam;
+        new ones are added to its first network-ipam, or to the default
+        one. Network-ipams left without subnets are dereferenced.
+        """
+        ipams = []
+        attrs = []
+        present = set()
+        for iref in vnet.get_network_ipam_refs() or []:
+            attr = iref['attr']
+            kept = []
+            for snet in attr.ipam_subnets or []:
+                subnet = '%s/%d' % (snet.subnet.ip_prefix,
+                                    snet.subnet.ip_prefix_len)
+                if subnet in subnets:
+                    kept.append(snet)
+                    present.add(subnet)
+            attr.set_ipam_subnets(kept)
+            ipam = NetworkIpam(iref['to'][-1], parent_type='project',
+                               fq_name=iref['to'])
+            ipam.uuid = iref['uuid']
+            ipams.append(ipam)
+            attrs.append(attr)
+        added = [subnet for subnet in subnets if subnet not in present]
+        if added:
+            if not ipams:
+                ipams.append(self._ipam())
+                attrs.append(VnSubnetsType([]))
+            attrs[0].set_ipam_subnets(attrs[0].ipam_subnets +
+                                      self._ipam_subnets(added).ipam_subnets)
+        refs = [(ipam, attr) for ipam, attr in zip(ipams, attrs)
+                if attr.ipam_subnets]
+        vnet.set_network_ipam_list([ipam for ipam, attr in refs],
+                                   [attr for ipam, attr in refs])
+
+    def _network_update(self, vnet, net):
+        """ Update only the fields of vnet that differ from net """
+        if self._network_subnets(vnet) != net['subnets']:
+            self._ipam_refs_merge(vnet, net['subnets'])
+        if self._network_targets(vnet) != net['route_targets']:
+            vnet.set_route_target_list(
+                RouteTargetList(net['route_targets']))
+        self._client.virtual_network_update(vnet)
+
+    def _rti_update(self, netname, targets, rt_instance=None, merge=False):
+        """
+        Set the route targets of the routing-instance of a network. With
+        merge, targets only holds the targets to set, and the others of
+        the routing-instance are kept.
+        """
+        if rt_instance is None:
+            # created along with the network
+            vn_uuid = self._client.fq_name_to_id('virtual-network',
+                                                 netname.split(':'))
+            rt_instance = self._routing_instances([vn_uuid]).get(netname)
+            if rt_instance is None:
+                raise NoIdError('Routing instance of %s not found' % netname)
+        if merge:
+            targets = dict(self._rti_targets(rt_instance), **targets)
+        self._rti_set_targets(rt_instance, targets)
+        self._client.routing_instance_update(rt_instance)
+
+    def _route_targets_missing(self, rtargets):
+        """ Return the targets without a route-target object, sorted """
+        if not rtargets:
+            return []
+        existing = set(item['fq_name'][-1] for item in
+                       self._client.route_targets_list()['route-targets'])
+        return sorted(set(rtargets) - existing)
+
+    def _route_target_create(self, rtarget):
+        try:
+            self._client.route_target_create(RouteTarget(rtarget))
+        except RefsExistError:
+            pass
+
+    def plan(self, spec):
+        """
+        Compare a spec with the API server and return the actions that
+        converge them. The current state is read with list requests: one
+        for the networks of the project, then one per chunk of networks
+        for their details and for their routing-instances.
+        Networks of the project that are not in the spec are deleted
+        only when the spec sets prune. The routing-instance targets that
+        the spec does not list (e.g. the system allocated one and those
+        copied from the route target lists) are kept, unless the spec
+        sets prune_targets.
+        """
+        prune_targets = bool(spec.get('prune_targets'))
+        project = spec.get('project') or self._project
+        desired = self._spec_networks(spec, project)
+        vn_uuids = self._list_uuids('virtual_network',
+                                    parent_fq_name=project.split(':'))
+        current = {}
+        for vnet in self._list_detail(
+                'virtual_network', vn_uuids,
+                fields=['network_ipam_refs', 'route_target_list']):
+            current[':'.join(vnet.get_fq_name())] = vnet
+        instances = self._routing_instances(
+            [vnet.uuid for netname, vnet in current.items()
+             if netname in desired])
+
+        actions = []
+        rtargets = set()
+        for netname, net in sorted(desired.items()):
+            vnet = current.get(netname)
+            rt_instance = instances.get(netname)
+            rti_current = self._rti_targets(rt_instance) if rt_instance \
+                else {}
+            rti_desired = dict({} if prune_targets else rti_current,
+                               **net['rti'])
+            rtargets.update(net['rti'])
+            if vnet is None:
+                actions.append(_action(
+                    'create', 'virtual-network', netname,
+                    ['subnets=%s' % ','.join(net['subnets']),
+                     'route_targets=%s' % ','.join(net['route_targets'])],
+                    lambda netname=netname, net=net:
+                    self._network_create(netname, net), 1))
+            else:
+                changes = []
+                subnets = self._network_subnets(vnet)
+                if subnets != net['subnets']:
+                    changes.append('subnets %s -> %s' % (
+                        ','.join(subnets), ','.join(net['subnets'])))
+                targets = self._network_targets(vnet)
+                changes.extend(['+%s' % rtarget for rtarget in
+                                net['route_targets'] if
+                                rtarget not in targets])
+                changes.extend(['-%s' % rtarget for rtarget in targets
+                                if rtarget not in net['route_targets']])
+                if changes:
+                    actions.append(_action(
+                        'update', 'virtual-network', netname, changes,
+                        lambda vnet=vnet, net=net:
+                        self._network_update(vnet, net), 1))
+
+            if rti_current != rti_desired:
+                changes = []
+                for rtarget, direction in sorted(net['rti'].items()):
+                    if rti_current.get(rtarget, '') != direction:
+                        changes.append('+%s(%s)' % (rtarget,
+                                                    direction or 'both'))
+                changes.extend(['-%s' % rtarget for rtarget in
+                                sorted(rti_current)
+                                if rtarget not in rti_desired])
+                actions.append(_action(
+                    'update', 'routing-instance', netname, changes,
+                    lambda netname=netname, net=net, ri=rt_instance:
+                    self._rti_update(netname, net['rti'], ri,
+                                     merge=not prune_targets), 2))
+
+        if spec.get('prune'):
+            for netname in sorted(set(current) - set(desired)):
+                actions.append(_action(
+                    'delete', 'virtual-network', netname, [],
+                    lambda vnet=current[netname]:
+                    self._client.virtual_network_delete(id=vnet.uuid), 1))
+
+        for rtarget in self._route_targets_missing(rtargets):
+            actions.append(_action(
+                'create', 'route-target', rtarget, [],
+                lambda rtarget=rtarget:
+                self._route_target_create(rtarget), 0))
+        return sorted(actions, key=lambda action: action['stage'])
+
+    def apply(self, spec, dry_run=False, workers=8):
+        """
+        Print the plan of a spec and, unless dry_run, execute it.
+        Returns the number of failed actions.
+        """
+        actions = self.plan(spec)
+        for action in actions:
+            print _action_str(action)
+        if not actions:
+            print 'No changes'
+        if dry_run or not actions:
+            return 0
+
+        results = []
+        for stage in sorted(set(action['stage'] for action in actions)):
+            results.extend(run_parallel(
+                lambda action: action['run'](),
+                [action for action in actions if action['stage'] == stage],
+                workers))
+        return batch_report(results, name=lambda action: '%s %s' % (
+            action['type'], action['name']))
+    # end apply
+
+
+def records_print(records, fields, output='json'):
+    """ Print records as they are produced: JSON lines or a table """
+    widths = {'name': 48, 'uuid': 36}
+
+    def row(values):
+        return ' '.join('%-*s' % (widths.get(field, 24), value)
+                        for field, value in zip(fields, values)).rstrip()
+
+    if output == 'table':
+        print row(fields)
+    for record in records:
+        if output == 'table':
+            print row([','.join(value) if isinstance(value, list) else value
+                       for value in record.values()])
+        else:
+            print json.dumps(record)
+        sys.stdout.flush()
+
 
 def main(argv):
+    started = time.time()
     parser = argparse.ArgumentParser()
     defaults = {
         'api-server': '127.0.0.1',
@@ -203,14 +771,59 @@ def main(argv):
     parser.add_argument("--import-only", action='store_true')
     parser.add_argument("--export-only", action='store_true')
     parser.add_argument("--subnet", help="Subnet prefix")
+    parser.add_argument("--dry-run", action='store_true',
+                        help="apply: only print the plan")
+    parser.add_argument("-w", "--workers", type=int, default=8,
+                        help="apply, rtarget-bulk: concurrent API server"
+                        " requests")
+    parser.add_argument("--fields", default=','.join(LIST_FIELDS.keys()),
+                        help="list: comma separated fields among %s" %
+                        ', '.join(LIST_FIELDS.keys()))
+    parser.add_argument("--output", choices=['json', 'table'],
+                        default='json', help="list: output format")
+    parser.add_argument("--api-rate", type=float, default=50,
+                        help="Maximum API server writes per second for the"
+                        " host (0 for no limit)")
+    parser.add_argument("--api-stats", action='store_true',
+                        help="Print the API server request counters to"
+                        " stderr")
+    parser.add_argument("--trace",
+                        help="Write a Chrome trace event timeline of the"
+                        " command to this file")
+    parser.add_argument("--profile",
+                        help="Write cProfile statistics of the main thread"
+                        " to this file")
     parser.add_argument("command", choices=['create', 'delete', 'show',
-                                            'rtarget-add', 'rtarget-del'])
-    parser.add_argument("network", help="Network name")
+                                            'rtarget-add', 'rtarget-del',
+                                            'apply', 'list', 'rtarget-bulk'])
+    parser.add_argument("network", nargs='?',
+                        help="Network name (YAML or JSON spec for apply,"
+                        " file of 'add|del network target [import|export|"
+                        "both]' lines for rtarget-bulk)")
 
     arguments = parser.parse_args(argv)
+    if arguments.profile:
+        profile_start(arguments.profile)
+    if arguments.trace:
+        trace_start(arguments.trace)
+        span_add('parse_arguments', 'startup', started)
+        # registered after trace_start: runs before the trace is written
+        atexit.register(lambda: span_add(arguments.command, 'command',
+                                         started))
+    if arguments.network is None and arguments.command != 'list':
+        parser.error('%s requires an argument' % arguments.command)
+    fields = arguments.fields.split(',')
+    for field in fields:
+        if field not in LIST_FIELDS:
+            parser.error('unknown field %s' % field)
 
     manager = NetworkManager(arguments.api_server, arguments.api_port,
-                             project=arguments.project)
+                             project=arguments.project,
+                             api_rate=arguments.api_rate)
+    if arguments.api_stats:
+        # also reported when a command exits early
+        atexit.register(lambda: sys.stderr.write(json.dumps(
+            manager.api_counters.stats(), sort_keys=True) + '\n'))
 
     if arguments.command == "create":
         manager.create(arguments.network, subnet=arguments.subnet)
@@ -232,6 +845,24 @@ def main(argv):
         elif arguments.export_only:
             direction = 'export'
         manager.rtarget_del(arguments.network, arguments.rtarget, direction)
+    elif arguments.command == "rtarget-bulk":
+        changes = []
+        for entry in manifest_read(arguments.network):
+            if (len(entry) not in (3, 4) or entry[0] not in ('add', 'del') or
+                    entry[3:] and
+                    entry[3] not in ('import', 'export', 'both')):
+                parser.error('invalid change: %s' % ' '.join(entry))
+            changes.append((entry + [None])[:4])
+        if manager.rtarget_bulk(changes, workers=arguments.workers):
+            sys.exit(1)
+    elif arguments.command == "list":
+        records_print(manager.list_networks(fields), fields,
+                      output=arguments.output)
+    elif arguments.command == "apply":
+        if manager.apply(spec_read(arguments.network),
+                         dry_run=arguments.dry_run,
+                         workers=arguments.workers):
+            sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,243 @@
+"""
+Write-behind journal of the vrouter port registrations. Starting or
+stopping a daemon journals its AddPort and DeletePort operations; the
+operations are applied to the vrouter agent afterwards, and retried
+until it accepts them.
+
+The journal holds one file per virtual-machine-interface in pending/,
+holding the operation still to be applied, and one per registered port
+in registered/, kept until the port is deleted so that the ports can be
+registered again after a vrouter agent restart. Files are replaced
+atomically and synced to disk under a host lock. Only pending/ is read
+to apply the journal. Operations on an interface coalesce: only the last
+one is applied, and an add followed by a delete cancels out when the
+port was never registered.
+"""
+
+import errno
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from daemon_state import STATE_DIR
+from ifname_allocator import host_lock
+from ratelimit import backoff_delays
+from vrouter_control import add_ports, del_ports, port_data
+
+
+PORT_JOURNAL_DIR = os.path.join(STATE_DIR, 'ports')
+
+PENDING = 'pending'
+REGISTERED = 'registered'
+
+
+class PortJournal(object):
+    def __init__(self, directory=PORT_JOURNAL_DIR):
+        self._directory = directory
+        self._lock_file = os.path.join(directory, '.lock')
+
+    def _filename(self, state, vmi):
+        return os.path.join(self._directory, state, '%s.json' % vmi)
+
+    def _load(self, state, vmi):
+        try:
+            with open(self._filename(state, vmi)) as fp:
+                return json.load(fp)
+        except IOError as ex:
+            if ex.errno != errno.ENOENT:
+                logging.warning('Unable to read port %s: %s', vmi, ex)
+        except ValueError:
+            logging.warning('Corrupted journal entry for port %s', vmi)
+        return None
+
+    def _store(self, state, entry):
+        directory = os.path.join(self._directory, state)
+        try:
+            os.makedirs(directory)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        fd, tmpname = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(entry, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmpname, self._filename(state, entry['vmi']))
+
+    def _remove(self, state, vmi):
+        try:
+            os.unlink(self._filename(state, vmi))
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+
+    def _sync(self):
+        """ Make the renames and unlinks of the directories durable """
+        for state in (PENDING, REGISTERED):
+            try:
+                fd = os.open(os.path.join(self._directory, state),
+                             os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _entries(self, state):
+        try:
+            names = os.listdir(os.path.join(self._directory, state))
+        except OSError:
+            return []
+        entries = []
+        for name in names:
+            if name.endswith('.json'):
+                entry = self._load(state, name[:-len('.json')])
+                if entry is not None:
+                    entries.append(entry)
+        return entries
+
+    def add(self, daemon, ports):
+        """ ports: list of (interface_name, vmi, vm, mac) tuples """
+        if not ports:
+            return
+        with host_lock(self._lock_file):
+            for ifname, vmi, vm, mac in ports:
+                self._store(PENDING, {'vmi': vmi, 'op': 'add',
+                                      'daemon': daemon, 'ifname': ifname,
+                                      'vm': vm, 'mac': mac})
+            self._sync()
+
+    def delete(self, vmi_list):
+        if not vmi_list:
+            return
+        with host_lock(self._lock_file):
+            for vmi in vmi_list:
+                entry = self._load(PENDING, vmi)
+                registered = self._load(REGISTERED, vmi)
+                if (entry is not None and entry['op'] == 'add' and
+                        registered is None):
+                    self._remove(PENDING, vmi)
+                    continue
+                # a port that is not journaled may have been registered
+                # directly
+                entry = entry or registered or {'vmi': vmi}
+                self._store(PENDING, dict(entry, op='delete'))
+            self._sync()
+
+    def pending(self):
+        """ Return the entries whose operation is still to be applied """
+        return self._entries(PENDING)
+
+    def registered(self):
+        """ Return the entries of the registered ports """
+        return self._entries(REGISTERED)
+
+    def applied(self, entries):
+        """
+        Record that the operations of entries were applied. Entries that
+        were journaled again in the meantime remain pending.
+        """
+        if not entries:
+            return
+        with host_lock(self._lock_file):
+            for entry in entries:
+                if self._load(PENDING, entry['vmi']) != entry:
+                    continue
+                if entry['op'] == 'delete':
+                    self._remove(REGISTERED, entry['vmi'])
+                else:
+                    registered = dict(entry)
+                    del registered['op']
+                    self._store(REGISTERED, registered)
+                self._remove(PENDING, entry['vmi'])
+            self._sync()
+
+    def daemons(self):
+        """ Return the daemons having pending or registered ports """
+        return set(entry.get('daemon')
+                   for entry in self.pending() + self.registered()
+                   if entry.get('daemon'))
+
+    def daemons_pending(self, daemons):
+        """ Return those of daemons having operations still to apply """
+        daemons = set(daemons)
+        return set(entry.get('daemon') for entry in self.pending()
+                   if entry.get('daemon') in daemons)
+
+# end PortJournal
+
+
+def journal_apply(journal, client=None):
+    """
+    Apply the pending operations of journal with one AddPort call and
+    back to back DeletePort calls. Returns the number of operations
+    that failed.
+    """
+    entries = journal.pending()
+    adds = [entry for entry in entries if entry['op'] == 'add']
+    deletes = [entry for entry in entries if entry['op'] == 'delete']
+    done = []
+    if adds and add_ports([port_data(entry['ifname'], entry['vmi'],
+                                     entry['vm'], entry['mac'])
+                           for entry in adds], client=client):
+        done.extend(adds)
+    if deletes and del_ports([entry['vmi'] for entry in deletes],
+                             client=client):
+        done.extend(deletes)
+    journal.applied(done)
+    return len(entries) - len(done)
+
+# end journal_apply
+
+
+class PortApplier(object):
+    """
+    Thread of the netns agent applying the journal: when notified, every
+    interval seconds to pick up the operations journaled by other
+    processes, and with backoff while the vrouter agent fails.
+    """
+    def __init__(self, journal, client, interval=5):
+        self._journal = journal
+        self._client = client
+        self._interval = interval
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def notify(self):
+        self._wake.set()
+
+    def _loop(self):
+        timeout = 0
+        delays = None
+        while True:
+            self._wake.wait(timeout)
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+            try:
+                failed = journal_apply(self._journal, self._client)
+            except Exception:
+                logging.exception('Unable to apply the port journal')
+                failed = 1
+            if failed:
+                if delays is None:
+                    delays = backoff_delays(16, cap=self._interval)
+                timeout = next(delays, self._interval)
+            else:
+                delays = None
+                timeout = self._interval
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,96 @@
+"""
+Client side rate limiting: token buckets, per process or shared by the
+processes of a host, and retry delays.
+"""
+
+import fcntl
+import os
+import random
+import threading
+import time
+
+
+def _take(tokens, updated, now, rate, burst, count):
+    """
+    Refill a bucket holding tokens at time updated and take count tokens.
+    Tokens may go negative: the callers then wait for the debt to be
+    paid. Returns the new token count and the time to wait.
+    """
+    tokens = min(burst, tokens + (now - updated) * rate) - count
+    return tokens, (-tokens / rate if tokens < 0 else 0)
+
+
+class TokenBucket(object):
+    """
+    Token bucket shared by the threads of a process: tokens accumulate
+    at rate per second up to burst, and each operation takes one.
+    """
+    def __init__(self, rate, burst=None):
+        self._rate = float(rate)
+        self._burst = float(burst if burst is not None else max(rate, 1))
+        self._tokens = self._burst
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self._burst, self._tokens +
+                           (now - self._updated) * self._rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1):
+        """ Take tokens if available; never blocks """
+        with self._lock:
+            self._refill(time.time())
+            if self._tokens < tokens:
+                return False
+            self._tokens -= tokens
+            return True
+
+    def acquire(self, tokens=1):
+        """ Take tokens, waiting until they are available """
+        with self._lock:
+            now = time.time()
+            self._tokens, wait = _take(self._tokens, self._updated, now,
+                                       self._rate, self._burst, tokens)
+            self._updated = now
+        if wait > 0:
+            time.sleep(wait)
+
+
+class SharedTokenBucket(object):
+    """
+    Token bucket shared by all the processes of a host. Its state is
+    kept in filename and updated under an flock.
+    """
+    def __init__(self, filename, rate, burst=None):
+        self._filename = filename
+        self._rate = float(rate)
+        self._burst = float(burst if burst is not None else max(rate, 1))
+
+    def acquire(self, tokens=1):
+        fd = os.open(self._filename, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            now = time.time()
+            try:
+                state, updated = map(float, os.read(fd, 64).split())
+            except ValueError:
+                state, updated = self._burst, now
+            state, wait = _take(state, updated, now, self._rate,
+                                self._burst, tokens)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, '%f %f\n' % (state, now))
+        finally:
+            os.close(fd)
+        if wait > 0:
+            time.sleep(wait)
+
+
+def backoff_delays(retries, base=0.5, cap=30):
+    """
+    Delays before each of retries attempts: exponential, capped, with
+    jitter so that the clients of a host do not retry in step.
+    """
+    for attempt in range(retries):
+        yield min(cap, base * 2 ** attempt) * random.uniform(0.5, 1)
@@ -0,0 +1,207 @@
+"""
+Periodic reconciliation of the provisioned daemons, run by the netns
+agent. The checkpoints written by daemon_start describe the desired state;
+each pass compares them with the kernel (ns-* namespaces and instanceN
+veths), the vrouter agent and the API server, and applies the deltas only.
+
+A pass costs one namespace listing and one host interface dump. A daemon
+is only inspected inside its namespace when its checkpoint or its master
+interface changed since the previous pass, and the API server is queried
+every api_interval passes with one list request per chunk of interfaces.
+The InstanceService cannot list ports: all of them are registered again
+when the vrouter agent connection had to be re-established. Port
+operations go through the port journal of the agent, whose applier
+retries them until the vrouter agent accepts them.
+"""
+
+import json
+import logging
+import threading
+
+from contrail_lib import RPC_ERRORS
+
+
+class Reconciler(object):
+    def __init__(self, operations, interval=30, api_interval=10):
+        """
+        operations: the DaemonOperations of the agent, with a journal.
+        interval: seconds between passes.
+        api_interval: number of passes between API server checks.
+        """
+        self._operations = operations
+        self._interval = interval
+        self._api_interval = api_interval
+        self._passes = 0
+        # daemon -> (checkpoint mtime, checkpoint) of the verified daemons
+        self._known = {}
+        # daemons whose ports must be registered with the vrouter agent
+        self._unregistered = set()
+        self._connects = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _agent_restarted(self):
+        """
+        Return True if the ports must all be registered again, None if the
+        vrouter agent cannot be reached.
+        """
+        client = self._operations.client
+        try:
+            client.call('KeepAliveCheck')
+        except RPC_ERRORS:
+            logging.warning('vrouter agent is not reachable')
+            self._connects = None
+            return None
+        restarted = (client.connects != self._connects)
+        self._connects = client.connects
+        return restarted
+
+    def _record_drop(self, daemon, state):
+        """ The namespace is gone: unregister its ports and forget it """
+        self._operations.journal.delete([iface['vmi']
+                                         for iface in state['interfaces']])
+        for iface in state['interfaces']:
+            self._operations.manager.interface_release(iface['master'])
+        self._operations.state_store.remove(daemon)
+        logging.info('%s: namespace removed, ports unregistered', daemon)
+
+    def _kernel_check(self, daemon, state, links):
+        """
+        Verify a daemon against the host interface dump, and against its
+        namespace when something changed. Returns True if the kernel
+        matches the checkpoint (after fixing the mac addresses).
+        """
+        manager = self._operations.manager
+        mtime = self._operations.state_store.modified(daemon)
+        known = self._known.get(daemon)
+        unchanged = (known is not None and known[0] == mtime and
+                     all(links.get(iface['master'], {}).get('index') ==
+                         iface['master_ifindex']
+                         for iface in state['interfaces']))
+        if unchanged:
+            return True
+
+        for iface in state['interfaces']:
+            if not manager.interface_repair(daemon, iface['name'],
+                                            iface['mac'], iface['master'],
+                                            iface['master_ifindex']):
+                return False
+        self._known[daemon] = (mtime, state)
+        self._unregistered.add(daemon)
+        return True
+
+    def _api_check(self, states):
+        """ Return the daemons whose interfaces changed in the API server """
+        macs = {}
+        for state in states.values():
+            for iface in state['interfaces']:
+                macs[iface['vmi']] = iface['mac']
+        current = self._operations.provisioner.vmi_mac_addresses(macs.keys())
+        return [daemon for daemon, state in states.items()
+                if any(current.get(iface['vmi']) != macs[iface['vmi']]
+                       for iface in state['interfaces'])]
+
+    def run_once(self):
+        """
+        Perform a single reconciliation pass. Returns the daemons that
+        were provisioned again.
+        """
+        operations = self._operations
+        manager = operations.manager
+        state_store = operations.state_store
+        self._passes += 1
+
+        busy = operations.busy()
+        namespaces = set(manager.namespace_daemons())
+        links = manager.host_interfaces()
+        for ifname in manager.clear_stray_interfaces(links):
+            logging.info('Deleted stray interface %s', ifname)
+
+        states = {}
+        for daemon in state_store.daemons():
+            if daemon in busy:
+                continue
+            state = self._known.get(daemon, (None, None))[1]
+            if (state is None or
+                    state_store.modified(daemon) != self._known[daemon][0]):
+                state = state_store.load(daemon)
+            if state is None:
+                continue
+            if daemon not in namespaces:
+                self._record_drop(daemon, state)
+                continue
+            states[daemon] = state
+
+        for daemon in self._known.keys():
+            if daemon not in states:
+                del self._known[daemon]
+        self._unregistered &= set(states)
+
+        reprovision = [daemon for daemon, state in states.items()
+                       if not self._kernel_check(daemon, state, links)]
+        self._ports_register()
+
+        if states and (self._passes - 1) % self._api_interval == 0:
+            try:
+                changed = self._api_check(states)
+            except Exception:
+                logging.exception('Unable to query the API server')
+                changed = []
+            reprovision.extend(set(changed) - set(reprovision))
+
+        # skip the daemons that have been stopped in the meantime
+        busy = operations.busy()
+        reprovision = [daemon for daemon in reprovision
+                       if daemon not in busy and
+                       state_store.modified(daemon) is not None]
+        if reprovision:
+            logging.info('Provisioning again: %s', ', '.join(reprovision))
+            # one start per tuning profile the daemons were started with
+            groups = {}
+            for daemon in reprovision:
+                tuning = states[daemon].get('tuning')
+                key = json.dumps(tuning, sort_keys=True)
+                groups.setdefault(key, (tuning, []))[1].append(
+                    [daemon, states[daemon]['network'],
+                     states[daemon]['outbound']])
+            for tuning, entries in groups.values():
+                operations.start(entries, restore=False, tuning=tuning)
+            for daemon in reprovision:
+                self._known.pop(daemon, None)
+                self._unregistered.discard(daemon)
+        return reprovision
+
+    def _ports_register(self):
+        restarted = self._agent_restarted()
+        if restarted is None:
+            return
+        if restarted:
+            self._unregistered = set(self._known)
+        if not self._unregistered:
+            return
+        for daemon in self._unregistered:
+            state = self._known[daemon][1]
+            self._operations.journal.add(daemon, [
+                (iface['master'], iface['vmi'], state['vm'], iface['mac'])
+                for iface in state['interfaces']])
+        self._operations.ports_flush()
+        logging.info('Registering the ports of %d daemons',
+                     len(self._unregistered))
+        self._unregistered.clear()
+
+    def _loop(self):
+        while not self._stop.wait(self._interval):
+            try:
+                self.run_once()
+            except Exception:
+                logging.exception('Reconciliation failed')
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,117 @@
+"""
+Timeline of a single invocation in the Chrome trace event format (load
+the file in chrome://tracing or https://ui.perfetto.dev), and cProfile
+statistics. Both are written when the process exits.
+
+Spans nest by time within a thread: the startup of the process (the
+interpreter and the module imports), the daemon runs and their phases
+(see metrics), API server requests, forked commands and vrouter RPCs.
+Spans cost a function call when tracing is not enabled.
+"""
+
+import atexit
+import contextlib
+import json
+import os
+import threading
+import time
+
+_tracer = None
+
+
+class Tracer(object):
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = threading.Lock()
+        self._events = []
+        self._threads = {}
+
+    def add(self, name, category, start, end, args=None):
+        thread = threading.current_thread()
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': int(start * 1e6),
+            'dur': int((end - start) * 1e6),
+            'pid': os.getpid(),
+            'tid': thread.ident,
+        }
+        if args:
+            event['args'] = args
+        with self._lock:
+            self._events.append(event)
+            self._threads[thread.ident] = thread.name
+
+    def write(self):
+        with self._lock:
+            events = [{'name': 'thread_name', 'ph': 'M',
+                       'pid': os.getpid(), 'tid': tid,
+                       'args': {'name': name}}
+                      for tid, name in self._threads.items()]
+            events.extend(self._events)
+        with open(self._filename, 'w') as fp:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fp)
+
+
+def process_started():
+    """ Return the time the process was started, None if unknown """
+    try:
+        with open('/proc/self/stat') as fp:
+            stat = fp.read()
+        with open('/proc/uptime') as fp:
+            uptime = float(fp.read().split()[0])
+    except (IOError, ValueError):
+        return None
+    # starttime, in clock ticks since boot, is the 22nd field; the
+    # command name before it may contain spaces
+    ticks = int(stat.rsplit(')', 1)[1].split()[19])
+    return time.time() - uptime + ticks / float(os.sysconf('SC_CLK_TCK'))
+
+
+def trace_start(filename):
+    """
+    Record spans from now on and write them to filename at exit. The
+    startup of the process is recorded as a first span.
+    """
+    global _tracer
+    _tracer = Tracer(filename)
+    atexit.register(_tracer.write)
+    started = process_started()
+    if started is not None:
+        _tracer.add('process_startup', 'startup', started, time.time())
+
+
+def span_add(name, category, start, end=None, **args):
+    """ Record a span that has already completed (e.g. before tracing) """
+    if _tracer is not None:
+        _tracer.add(name, category, start,
+                    time.time() if end is None else end, args)
+
+
+@contextlib.contextmanager
+def span(name, category, **args):
+    if _tracer is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        _tracer.add(name, category, start, time.time(), args)
+
+
+def profile_start(filename):
+    """
+    Profile the calling thread with cProfile and dump the statistics to
+    filename at exit (read them with pstats). Worker threads are not
+    profiled: use a single worker to include their work.
+    """
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+    def dump():
+        profiler.disable()
+        profiler.dump_stats(filename)
+    atexit.register(dump)
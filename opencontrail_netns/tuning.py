@@ -0,0 +1,95 @@
+"""
+Data-plane tuning profiles of the veth pairs. A profile is a dictionary
+of the optional keys:
+
+- mtu: an MTU, or 'auto' for the MTU of the virtual network when it sets
+  one and otherwise underlay_mtu less the encap overhead;
+- underlay_mtu (1500) and encap (MPLSoUDP), used by 'auto';
+- txqueuelen;
+- queues: number of TX and RX queues of the veths, set at creation;
+- offloads: ethtool features, e.g. {"gro": "on", "tso": "off"}.
+
+Absent keys leave the kernel defaults. Profiles can be added or replaced
+with a JSON file of {"name": profile, ...}.
+"""
+
+import json
+
+
+# bytes the vrouter adds to a packet, counting the inner ethernet header
+# of bridged traffic: outer IPv4 + GRE + MPLS, + UDP + MPLS, + UDP + VXLAN
+ENCAP_OVERHEAD = {
+    'MPLSoGRE': 20 + 4 + 4 + 14,
+    'MPLSoUDP': 20 + 8 + 4 + 14,
+    'VXLAN': 20 + 8 + 8 + 14,
+}
+
+PROFILES = {
+    'default': {},
+    'overlay': {'mtu': 'auto'},
+    'throughput': {
+        'mtu': 'auto',
+        'txqueuelen': 10000,
+        'queues': 4,
+        'offloads': {'gro': 'on', 'gso': 'on', 'tso': 'on'},
+    },
+    'latency': {
+        'mtu': 'auto',
+        'txqueuelen': 256,
+        'offloads': {'gro': 'off'},
+    },
+}
+
+_KEYS = set(['mtu', 'underlay_mtu', 'encap', 'txqueuelen', 'queues',
+             'offloads'])
+
+
+def _profile_check(name, profile):
+    unknown = set(profile) - _KEYS
+    if unknown:
+        raise ValueError('profile %s: unknown keys %s' %
+                         (name, ', '.join(sorted(unknown))))
+    if profile.get('encap', 'MPLSoUDP') not in ENCAP_OVERHEAD:
+        raise ValueError('profile %s: encap must be one of %s' %
+                         (name, ', '.join(sorted(ENCAP_OVERHEAD))))
+    mtu = profile.get('mtu')
+    if mtu is not None and mtu != 'auto' and not isinstance(mtu, int):
+        raise ValueError('profile %s: mtu must be an integer or auto' %
+                         name)
+    for key in ('underlay_mtu', 'txqueuelen', 'queues'):
+        value = profile.get(key)
+        if value is not None and (not isinstance(value, int) or value < 1):
+            raise ValueError('profile %s: %s must be a positive integer' %
+                             (name, key))
+    for feature, state in profile.get('offloads', {}).items():
+        if state not in ('on', 'off'):
+            raise ValueError('profile %s: offload %s must be on or off' %
+                             (name, feature))
+
+
+def profile_load(name, filename=None):
+    """
+    Return the profile called name, from filename or the built-in ones.
+    Raises ValueError when it is unknown or invalid.
+    """
+    profiles = dict(PROFILES)
+    if filename:
+        with open(filename) as fp:
+            profiles.update(json.load(fp))
+    if name not in profiles:
+        raise ValueError('unknown tuning profile %s (known: %s)' %
+                         (name, ', '.join(sorted(profiles))))
+    profile = profiles[name]
+    _profile_check(name, profile)
+    return profile
+
+
+def interface_mtu(profile, network_mtu=None):
+    """ Return the MTU of an interface of a network, None to leave it """
+    mtu = profile.get('mtu')
+    if mtu != 'auto':
+        return mtu
+    if network_mtu:
+        return network_mtu
+    return (profile.get('underlay_mtu', 1500) -
+            ENCAP_OVERHEAD[profile.get('encap', 'MPLSoUDP')])
@@ -4,13 +4,13 @@ import getopt
 import logging
 import socket
 
-from contrail_lib import rpc_client_instance, uuid_from_string
+from contrail_lib import RPC_ERRORS, rpc_client_shared, uuid_from_string
 import nova_contrail_vif.gen_py.instance_service
 
 
-def add_interface(interface_name, vmi, vm, mac):
+def port_data(interface_name, vmi, vm, mac):
     from nova_contrail_vif.gen_py.instance_service import ttypes
-    data = ttypes.Port(
+    return ttypes.Port(
         uuid_from_string(vmi),
         uuid_from_string(vm),
         interface_name,
@@ -18,32 +18,69 @@ def add_interface(interface_name, vmi, vm, mac):
         [0] * 16,
         mac)
 
-    logging.debug(data)
-    rpc = rpc_client_instance()
-    if not rpc:
-        return
+
+def add_ports(ports, client=None):
+    """ Register a list of ports with a single AddPort call """
+    if not ports:
+        return True
+    for data in ports:
+        logging.debug(data)
+    rpc = client or rpc_client_shared()
     try:
-        rpc.AddPort([data])
-    except socket.error:
+        rpc.call('AddPort', ports)
+    except RPC_ERRORS:
         logging.error('RPC failure')
+        return False
+    return True
+
 
+def add_interface(interface_name, vmi, vm, mac, client=None):
+    data = port_data(interface_name, vmi, vm, mac)
+    return add_ports([data], client=client)
 
-def del_interface(vmi):
-    rpc = rpc_client_instance()
-    if not rpc:
-        return
+
+def del_interface(vmi, client=None):
+    rpc = client or rpc_client_shared()
     try:
-        rpc.DeletePort(uuid_from_string(vmi))
-    except socket.error:
+        rpc.call('DeletePort', uuid_from_string(vmi))
+    except RPC_ERRORS:
         logging.error('RPC failure')
+        return False
 
     logging.info('Deleted virtual-machine-interface uuid = ' + vmi)
+    return True
+
+
+def del_ports(vmi_list, client=None):
+    """
+    Unregister several ports. InstanceService has no bulk DeletePort:
+    the calls are issued back to back on the shared connection.
+    """
+    if not vmi_list:
+        return True
+    rpc = client or rpc_client_shared()
+    try:
+        rpc.call_batch('DeletePort',
+                       [(uuid_from_string(vmi),) for vmi in vmi_list])
+    except RPC_ERRORS:
+        logging.error('RPC failure')
+        return False
+
+    logging.info('Deleted %d virtual-machine-interfaces', len(vmi_list))
+    return True
 
 
-def interface_register(vm, vmi, iface_name):
-    mac = vmi.virtual_machine_interface_mac_addresses.mac_address[0]
-    add_interface(iface_name, vmi.uuid, vm.uuid, mac)
+def interface_register_batch(entries, client=None):
+    """
+    entries: list of (vm, vmi, iface_name) tuples, possibly belonging to
+    different daemons.
+    """
+    ports = []
+    for vm, vmi, iface_name in entries:
+        mac = vmi.virtual_machine_interface_mac_addresses.mac_address[0]
+        ports.append(port_data(iface_name, vmi.uuid, vm.uuid, mac))
+    return add_ports(ports, client=client)
 
 
-def interface_unregister(vmi_uuid):
-    del_interface(vmi_uuid)
+def interface_unregister(vmi_uuid, client=None):
+    return del_interface(vmi_uuid, client=client)
@@ -4,11 +4,17 @@ setuptools.setup(
     name = "opencontrail-netns",
     version = "0.1",
     packages = setuptools.find_packages(),
+    extras_require = {
+        'netlink': ['pyroute2'],
+    },
 
     entry_points = {
         'console_scripts': [
             'netns-daemon-start = opencontrail_netns.daemon_start.daemon_start',
-            'netns-daemon-stop = opencontrail_netns.daemon_stop.daemon_stop'
+            'netns-daemon-stop = opencontrail_netns.daemon_stop.daemon_stop',
+            'netns-agent = opencontrail_netns.agent:agent_main',
+            'netns-gc = opencontrail_netns.netns_gc:gc_main',
+            'netns-benchmark = opencontrail_netns.benchmark.run:main',
         ],
     }
     )